@@ -21,7 +21,10 @@ files and caches results.
 __license__ = "Apache License, Version 2.0"
 __copyright__ = "Signal Analysis and Interpretation Laboratory, University of Southern California"
 __version__ = 0.1
-__all__ = ["KaldiContext", "KaldiError"]
+__all__ = ["KaldiContext", "AsyncKaldiContext", "Handle", "DecodeServer",
+  "KaldiError", "CancelledError", "ServerBusyError"]
 
-from .context import KaldiContext
-from .util import KaldiError
+from .context import KaldiContext, AsyncKaldiContext
+from .scheduler import Handle
+from .server import DecodeServer, ServerBusyError
+from .util import KaldiError, CancelledError
@@ -0,0 +1,282 @@
+# Copyright 2013 Signal Analysis and Interpretation Laboratory,
+# University of Southern California
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Defines methods for bounding the disk space used by cached objects
+and reclaiming files no cached object references.
+"""
+
+from os import path,listdir,remove,walk,sep,stat
+from ast import literal_eval
+from time import time
+
+from util import (_INDEX_FILENAME, _INDEX_LOCKNAME, _loadIndex,
+  _readIdxFile, _removeIndexEntries, _lock, _removeLock, _paramsLockFile)
+
+# stage directories that hold uncached results, which are swept even
+# if no object has been cached in them yet
+_UNCACHED_DIRNAMES = ("audio_hypotheses",)
+
+
+
+
+def _stageDirs(dirname):
+  """
+  Returns the cache directories in the context directory *dirname*.
+  """
+  stageDirs = []
+  try:
+    names = listdir(dirname)
+  except OSError:
+    return stageDirs
+
+  for name in names:
+    stageDir = path.join(dirname, name)
+    if not path.isdir(stageDir):
+      continue
+    if name in _UNCACHED_DIRNAMES:
+      stageDirs.append(stageDir)
+      continue
+    fnames = listdir(stageDir)
+    if _INDEX_FILENAME in fnames or [f for f in fnames if f.endswith(".idx")]:
+      stageDirs.append(stageDir)
+  return stageDirs
+
+
+
+
+def _objectFiles(members, dirname):
+  """
+  Returns the set of files inside *dirname* named by the cached
+  object *members*, searching strings in nested containers too.
+  """
+  files = set()
+  prefix = path.abspath(dirname) + sep
+  pending = [members]
+  while pending:
+    value = pending.pop()
+    if isinstance(value, dict):
+      pending.extend(value.keys())
+      pending.extend(value.values())
+    elif isinstance(value, (list, tuple, set)):
+      pending.extend(value)
+    elif isinstance(value, basestring):
+      fname = path.abspath(value)
+      if fname.startswith(prefix) and path.isfile(fname):
+        files.add(fname)
+  return files
+
+
+
+
+def _cachedEntries(dirname):
+  """
+  Returns a list of the objects cached in the context directory
+  *dirname*. Each element is a tuple containing the last access time
+  of the object, its .idx file, the set of files it references and
+  its params string.
+  """
+  entries = []
+  for stageDir in _stageDirs(dirname):
+    for (params, fname) in _loadIndex(stageDir).items():
+      idxFile = path.join(stageDir, fname)
+      try:
+        idx = _readIdxFile(idxFile)
+        atime = path.getmtime(idxFile)
+      except (IOError, OSError):
+        continue
+      if idx is None or idx[0] != params or len(idx[1]) == 0:
+        continue
+      files = _objectFiles(literal_eval(idx[1]), dirname)
+      entries.append((atime, idxFile, files, params))
+  return entries
+
+
+
+
+def _diskUsage(dirname):
+  """
+  Returns the total size in bytes of the files in *dirname*.
+  """
+  total = 0
+  for (dirpath, dirnames, filenames) in walk(dirname):
+    for f in filenames:
+      try:
+        total += path.getsize(path.join(dirpath, f))
+      except OSError:
+        pass
+  return total
+
+
+
+
+def _evict(entries, usage, maxBytes):
+  """
+  Removes the least recently used objects in *entries*, as returned
+  by _cachedEntries, until *usage* bytes fit within *maxBytes*.
+  Objects being built or refreshed are skipped. Returns the number
+  of bytes freed.
+  """
+  freed = 0
+  evicted = {}
+  buildLocks = []
+
+  for (atime, idxFile, files, params) in sorted(entries):
+    if usage - freed <= maxBytes:
+      break
+    buildLock = _lock(_paramsLockFile(path.dirname(idxFile), params), False)
+    if buildLock is None:
+      continue
+    buildLocks.append(buildLock)
+    for fname in files | set([idxFile]):
+      try:
+        size = path.getsize(fname)
+        remove(fname)
+        freed += size
+      except OSError:
+        pass
+    evicted.setdefault(path.dirname(idxFile), set()).add(path.basename(idxFile))
+
+  try:
+    for (stageDir, fnames) in evicted.iteritems():
+      _removeIndexEntries(stageDir, fnames)
+  finally:
+    for buildLock in buildLocks:
+      buildLock.close()
+
+  return freed
+
+
+
+
+def trimContext(dirname, maxBytes):
+  """
+  Evicts the least recently used objects cached in the context
+  directory *dirname* until the files in it take up at most
+  *maxBytes* bytes. Returns the number of bytes freed.
+  """
+  usage = _diskUsage(dirname)
+  if usage <= maxBytes:
+    return 0
+  return _evict(_cachedEntries(dirname), usage, maxBytes)
+
+
+
+
+def trimContexts(contextsDir, maxBytes):
+  """
+  Evicts the least recently used objects cached in any context
+  in *contextsDir* until all contexts together take up at most
+  *maxBytes* bytes. Returns the number of bytes freed.
+  """
+  usage = _diskUsage(contextsDir)
+  if usage <= maxBytes:
+    return 0
+
+  entries = []
+  for name in listdir(contextsDir):
+    entries.extend(_cachedEntries(path.join(contextsDir, name)))
+  return _evict(entries, usage, maxBytes)
+
+
+
+
+def findOrphans(dirname, minage=3600):
+  """
+  Returns the list of files in the context directory *dirname* that
+  no cached object references, such as files left behind by refreshes
+  and interrupted builds or uncached results, along with .idx files
+  missing from their directory index. Files created or modified
+  within the last *minage* seconds are skipped since they may belong
+  to builds in progress. Log and lock files are never included.
+  """
+  referenced = set()
+  for (atime, idxFile, files, params) in _cachedEntries(dirname):
+    referenced.update(files)
+
+  stageDirs = _stageDirs(dirname)
+  for stageDir in stageDirs:
+    for fname in _loadIndex(stageDir).itervalues():
+      referenced.add(path.abspath(path.join(stageDir, fname)))
+
+  orphans = []
+  cutoff = time() - minage
+  for stageDir in stageDirs:
+    for fname in listdir(stageDir):
+      if (fname in (_INDEX_FILENAME, _INDEX_LOCKNAME)
+        or fname.endswith(".log") or fname.endswith(".lock")):
+        continue
+      fname = path.abspath(path.join(stageDir, fname))
+      try:
+        if (fname not in referenced and path.isfile(fname)
+          and max(path.getmtime(fname), path.getctime(fname)) < cutoff):
+          orphans.append(fname)
+      except OSError:
+        pass
+  return orphans
+
+
+
+
+def sweepOrphans(dirname, minage=3600):
+  """
+  Deletes the files returned by findOrphans for the context directory
+  *dirname* and *minage*, and the build lock files older than *minage*
+  seconds that no build holds. Returns the number of bytes freed.
+  """
+  freed = 0
+  for fname in findOrphans(dirname, minage):
+    try:
+      size = path.getsize(fname)
+      remove(fname)
+      freed += size
+    except OSError:
+      pass
+
+  cutoff = time() - minage
+  for stageDir in _stageDirs(dirname):
+    for fname in listdir(stageDir):
+      if fname == _INDEX_LOCKNAME or not fname.endswith(".lock"):
+        continue
+      fname = path.join(stageDir, fname)
+      try:
+        if max(path.getmtime(fname), path.getctime(fname)) < cutoff:
+          _removeLock(fname)
+      except OSError:
+        pass
+  return freed
+
+
+
+
+def sweepStore(storeDir, minage=3600):
+  """
+  Deletes the artifacts in the shared store *storeDir* that are no
+  longer linked from any context directory. Artifacts created or
+  modified within the last *minage* seconds are kept. Returns the
+  number of bytes freed.
+  """
+  freed = 0
+  cutoff = time() - minage
+  for (dirpath, dirnames, filenames) in walk(storeDir):
+    for fname in filenames:
+      fname = path.join(dirpath, fname)
+      try:
+        st = stat(fname)
+        if st.st_nlink == 1 and max(st.st_mtime, st.st_ctime) < cutoff:
+          remove(fname)
+          freed += st.st_size
+      except OSError:
+        pass
+  return freed
@@ -17,6 +17,7 @@ Defines a configuration object that stores paths and constants.
 """
 
 from os import path
+from multiprocessing import cpu_count
 
 class ConfigObject(object):
   """
@@ -54,6 +55,40 @@ class ConfigObject(object):
     configMap["DECODE_OOV_WORD"] = "<SPOKEN_NOISE>"
     configMap["DECODE_OOV_PHONE"] = "SPN"
 
+    # cache validation of input files, either "mtime" to compare
+    # modification times or "content" to also compare content hashes
+    # when stat data changes
+    configMap["CACHE_VALIDATION"] = "mtime"
+
+    # whether input files are reflinked or hard linked into context
+    # directories instead of copied when possible
+    configMap["LINK_INPUTS"] = True
+
+    # maximum bytes of files to keep cached in a context directory and
+    # in all contexts together, or None for no limit
+    configMap["CONTEXT_MAX_BYTES"] = None
+    configMap["CONTEXTS_MAX_BYTES"] = None
+
+    # maximum number of results each context remembers in memory
+    configMap["MEMO_SIZE"] = 256
+
+    # number of jobs asynchronous contexts run at once
+    configMap["MAX_JOBS"] = cpu_count()
+
+    # decoders each persistent decoder pool keeps loaded, seconds before
+    # idle decoders shut down, and seconds without output before a
+    # decoder is restarted
+    configMap["DECODER_POOL_SIZE"] = 1
+    configMap["DECODER_POOL_IDLE"] = 300
+    configMap["DECODER_POOL_TIMEOUT"] = 600
+
+    # seconds to wait for online decoders to load before connecting
+    configMap["ONLINE_START_TIMEOUT"] = 120
+
+    # directory of artifacts shared by all contexts, keyed by their
+    # inputs and parameters, or None to not share artifacts
+    configMap["SHARED_STORE_DIR"] = None
+
     # paths
     configMap["KALDI_DIR"] = kaldiDir
     configMap["CONTEXTS_DIR"] = path.join(path.dirname(__file__), "contexts")
@@ -64,6 +99,7 @@ class ConfigObject(object):
     configMap["arpa2fst"] = "{0}/src/bin/arpa2fst".format(configMap["KALDI_DIR"])
     configMap["fstprint"] = "{0}/src/bin/fstprint".format(configMap["OPENFST_DIR"])
     configMap["fstrmepsilon"] = "{0}/src/bin/fstrmepsilon".format(configMap["OPENFST_DIR"])
+    configMap["fstproject"] = "{0}/src/bin/fstproject".format(configMap["OPENFST_DIR"])
     configMap["makehtransducer"] = "{0}/src/bin/make-h-transducer".format(configMap["KALDI_DIR"])
     configMap["fsttablecompose"] = "{0}/src/fstbin/fsttablecompose".format(configMap["KALDI_DIR"])
     configMap["fstdeterminizestar"] = "{0}/src/fstbin/fstdeterminizestar".format(configMap["KALDI_DIR"])
@@ -73,17 +109,20 @@ class ConfigObject(object):
     configMap["fstrmepslocal"] = "{0}/src/fstbin/fstrmepslocal".format(configMap["KALDI_DIR"])
     configMap["addselfloops"] = "{0}/src/bin/add-self-loops".format(configMap["KALDI_DIR"])
     configMap["computemfccfeats"] = "{0}/src/featbin/compute-mfcc-feats".format(configMap["KALDI_DIR"])
+    configMap["copyfeats"] = "{0}/src/featbin/copy-feats".format(configMap["KALDI_DIR"])
     configMap["adddeltas"] = "{0}/src/featbin/add-deltas".format(configMap["KALDI_DIR"])
     configMap["extractsegments"] = "{0}/src/featbin/extract-segments".format(configMap["KALDI_DIR"])
     configMap["extractfeaturesegments"] = "{0}/src/featbin/extract-feature-segments".format(configMap["KALDI_DIR"])
     configMap["computecmvnstats"] = "{0}/src/featbin/compute-cmvn-stats".format(configMap["KALDI_DIR"])
     configMap["applycmvn"] = "{0}/src/featbin/apply-cmvn".format(configMap["KALDI_DIR"])
     configMap["gmmdecode"] = "{0}/src/gmmbin/gmm-decode-faster".format(configMap["KALDI_DIR"])
+    configMap["onlineaudioserver"] = "{0}/src/onlinebin/online-audio-server-decode-faster".format(configMap["KALDI_DIR"])
     configMap["gmmlatgen"] = "{0}/src/gmmbin/gmm-latgen-faster".format(configMap["KALDI_DIR"])
     configMap["latticewordalign"] = "{0}/src/latbin/lattice-word-align".format(configMap["KALDI_DIR"])
     configMap["latticetonbest"] = "{0}/src/latbin/lattice-to-nbest".format(configMap["KALDI_DIR"])
     configMap["latticembrdecode"] = "{0}/src/latbin/lattice-mbr-decode".format(configMap["KALDI_DIR"])
     configMap["nbesttolinear"] = "{0}/src/latbin/nbest-to-linear".format(configMap["KALDI_DIR"])
+    configMap["latticelmrescore"] = "{0}/src/latbin/lattice-lmrescore".format(configMap["KALDI_DIR"])
     configMap["gmmalign"] = "{0}/src/gmmbin/gmm-align".format(configMap["KALDI_DIR"])
     configMap["alitophones"] = "{0}/src/bin/ali-to-phones".format(configMap["KALDI_DIR"])
     configMap["phonestoprons"] = "{0}/src/bin/phones-to-prons".format(configMap["KALDI_DIR"])
@@ -16,12 +16,43 @@
 Defines objects and methods for interacting with Kaldi contexts.
 """
 
-from os import path,remove,walk
+from os import path,remove,walk,stat
 from shutil import rmtree
+from copy import copy
+from threading import Lock
 
 from util import KaldiObject
 from config import ConfigObject
 from kaldi import *
+from scheduler import Scheduler
+import cache
+
+# methods of KaldiContext that build objects, which AsyncKaldiContext
+# runs with its scheduler
+_STAGE_METHODS = frozenset(["makeL", "addL", "makeGText", "makeGArpa",
+  "addG", "makeHCLG", "addHCLG", "composeGraphs", "makeGMM", "addGMM",
+  "makeFeatures", "addFeatures", "segmentFeatures", "decodeNbest",
+  "rescore", "decode", "decodeAudio", "align"])
+
+
+
+def _memoDependencies(obj, args):
+  """
+  Returns the files a memoized result *obj* of a call with *args*
+  depends on: the arguments naming files, the files named by the
+  members of *obj*, and files recorded in *_times members, such
+  as wave files.
+  """
+  deps = set()
+  for value in args:
+    if isinstance(value, basestring) and path.isfile(value):
+      deps.add(value)
+  for (name, value) in obj.__dict__.iteritems():
+    if isinstance(value, basestring) and path.isfile(value):
+      deps.add(value)
+    elif isinstance(value, dict) and name.endswith("_times"):
+      deps.update(value.keys())
+  return deps
 
 
 
@@ -36,6 +67,14 @@ class KaldiContext(object):
   a new directory is created in config.CONTEXTS_DIR to store its files.
   Subsequent initializations and function calls with the same parameters
   return cached results.
+
+  Results are also remembered in memory, up to config.MEMO_SIZE of
+  them, and returned without touching the cache directories as long
+  as the files they depend on are unchanged.
+
+  If config.CONTEXT_MAX_BYTES or config.CONTEXTS_MAX_BYTES is set,
+  least recently used results are evicted upon initialization and
+  whenever trim() is called to keep the cache within those limits.
   """
 
 
@@ -49,7 +88,75 @@ class KaldiContext(object):
     """
     self.config = ConfigObject(kaldiDir, userConfig)
     self.dirname = path.join(self.config.CONTEXTS_DIR, name)
-    
+    self._memo = {}
+    self._memoLock = Lock()
+    self._memoClock = 0
+    self.trim()
+
+
+
+  def _memoized(self, func, *args, **options):
+    """
+    Returns the result of calling the Kaldi function *func* with
+    the context directory, config, *args* and keyword *options*,
+    using the in-memory memo table when a previous result is still
+    valid. A result is valid while all files it names or was created
+    from have the same size and modification time as when it was
+    remembered. *options* must not change the result, such as the
+    number of jobs, and are not part of the memo key.
+    """
+    key = (func.__module__, func.__name__) + args
+
+    with self._memoLock:
+      try:
+        (obj, deps, lastUse) = self._memo[key]
+      except KeyError:
+        obj = None
+
+    if obj is not None:
+      try:
+        for (fname, statKey) in deps:
+          st = stat(fname)
+          if (st.st_size, st.st_mtime) != statKey:
+            raise OSError(fname)
+        with self._memoLock:
+          self._memoClock += 1
+          if key in self._memo:
+            self._memo[key][2] = self._memoClock
+        return copy(obj)
+      except OSError:
+        with self._memoLock:
+          self._memo.pop(key, None)
+
+    obj = func(self.dirname, self.config, *args, **options)
+
+    if self.config.MEMO_SIZE > 0:
+      deps = []
+      for fname in _memoDependencies(obj, args):
+        try:
+          st = stat(fname)
+          deps.append((fname, (st.st_size, st.st_mtime)))
+        except OSError:
+          pass
+
+      with self._memoLock:
+        if key not in self._memo and len(self._memo) >= self.config.MEMO_SIZE:
+          oldest = min(self._memo.iterkeys(), key=lambda k: self._memo[k][2])
+          del self._memo[oldest]
+        self._memoClock += 1
+        self._memo[key] = [copy(obj), deps, self._memoClock]
+
+    return obj
+
+
+
+  def forget(self):
+    """
+    Removes all results from the in-memory memo table so the
+    next calls go back to the cache directories.
+    """
+    with self._memoLock:
+      self._memo.clear()
 
 
 
@@ -58,6 +165,7 @@ class KaldiContext(object):
     Removes the directory associated with the context and
     destroys all its files.
     """
+    self.forget()
     try:
       rmtree(self.dirname)
     except OSError:
@@ -65,6 +173,55 @@ class KaldiContext(object):
 
 
 
+  def trim(self):
+    """
+    Evicts the least recently used cached objects until the files of
+    the context take up at most config.CONTEXT_MAX_BYTES bytes and the
+    files of all contexts take up at most config.CONTEXTS_MAX_BYTES
+    bytes. Limits that are None are not enforced.
+
+    Returns the number of bytes freed.
+    """
+    freed = 0
+    if self.config.CONTEXT_MAX_BYTES is not None:
+      freed += cache.trimContext(self.dirname, self.config.CONTEXT_MAX_BYTES)
+    if self.config.CONTEXTS_MAX_BYTES is not None:
+      freed += cache.trimContexts(self.config.CONTEXTS_DIR,
+        self.config.CONTEXTS_MAX_BYTES)
+    return freed
+
+
+
+  def sweep(self, minage=3600):
+    """
+    Deletes the files in the context directory that no cached object
+    references, such as artifacts left by interrupted builds, and
+    build lock files no build holds. Files created or modified in the
+    last *minage* seconds are kept since they may belong to builds in
+    progress. If config.SHARED_STORE_DIR
+    is set, shared artifacts no context links to are deleted as well.
+
+    Returns the number of bytes freed.
+    """
+    freed = cache.sweepOrphans(self.dirname, minage)
+    if self.config.SHARED_STORE_DIR:
+      freed += cache.sweepStore(self.config.SHARED_STORE_DIR, minage)
+    return freed
+
+
+
+  def asynchronous(self, maxjobs=None):
+    """
+    Returns an AsyncKaldiContext running the methods of this context
+    concurrently, with up to *maxjobs* jobs at once, or
+    config.MAX_JOBS if *maxjobs* is None.
+    """
+    if maxjobs is None:
+      maxjobs = self.config.MAX_JOBS
+    return AsyncKaldiContext(self, Scheduler(maxjobs))
+
+
+
   def rmlogs(self):
     """
     Deletes all log files associated with the context.
@@ -99,7 +256,7 @@ class KaldiContext(object):
 
     Returns an object representing the L graph.
     """
-    return graph.makeLGraph(self.dirname, self.config, phonesfile, wordsfile,
+    return self._memoized(graph.makeLGraph, phonesfile, wordsfile,
       lexiconfile, addsilence, silenceprobability)
 
 
@@ -140,13 +297,14 @@ class KaldiContext(object):
 
     Returns an object representing the G graph.
     """
-    return graph.makeGGraphTextFst(self.dirname, self.config, wordsfile,
+    return self._memoized(graph.makeGGraphTextFst, wordsfile,
         fstfile, arcsort)
 
 
 
 
-  def makeGArpa(self, wordsfile, arpafile, arcsort=False):
+  def makeGArpa(self, wordsfile, arpafile, arcsort=False,
+    prunethreshold=0, maxorder=None):
     """
     Creates a grammar FST for decoding graph creation from the
     specified ARPA model. Discards illegal word sequences and
@@ -159,10 +317,16 @@ class KaldiContext(object):
 
     If *arcsort* is True, arcs will be sorted by output label.
 
+    If *maxorder* is given, n-grams longer than *maxorder* words are
+    discarded. If *prunethreshold* is positive, n-grams whose removal
+    increases the model's perplexity by less than this fraction are
+    pruned and backoff weights renormalized, as with SRILM's -prune.
+    Lower orders are held in memory while pruning.
+
     Returns an object representing the G graph.
     """
-    return graph.makeGGraphArpa(self.dirname, self.config, wordsfile,
-        arpafile, arcsort)
+    return self._memoized(graph.makeGGraphArpa, wordsfile,
+        arpafile, arcsort, prunethreshold, maxorder)
 
 
 
@@ -207,7 +371,7 @@ class KaldiContext(object):
 
     Returns an object representing the HCLG graph.
     """
-    return graph.makeHCLGGraph(self.dirname, self.config, L.filename, L.phonesfile,
+    return self._memoized(graph.makeHCLGGraph, L.filename, L.phonesfile,
       G.filename, mdl.filename, mdl.treefile, transitionscale,
       loopscale, contextsize, centralposition)
 
@@ -236,7 +400,7 @@ class KaldiContext(object):
 
     Returns A o B
     """
-    return graph.composeGraphs(self.dirname, self.config, A.filename, B.filename)
+    return self._memoized(graph.composeGraphs, A.filename, B.filename)
 
 
 
@@ -275,7 +439,7 @@ class KaldiContext(object):
   def makeFeatures(self, wavscp, segmentsfile=None, samplefreq=16000,
     feattype="mfcc", useenergy=False, framelength=25,
     frameshift=10, numceps=13, applycmvn=True,
-    normvars=False, utt2spk=None, spk2utt=None, deltaorder=2):
+    normvars=False, utt2spk=None, spk2utt=None, deltaorder=2, numjobs=1):
     """
     Creates features for the wave files specified by *wavscp*.
 
@@ -299,12 +463,18 @@ class KaldiContext(object):
     *deltaorder* specifies the order of delta computation
     if greater than zero.
 
-    Returns an object representing the features.
+    If *numjobs* is greater than one, the utterances are split into
+    up to *numjobs* shards of about equal audio duration, keeping
+    each speaker in a single shard if *utt2spk* and *spk2utt* are
+    given, and the shards are computed concurrently.
+
+    Returns an object representing the features, with the archive
+    in its filename member and the scp index into it in scpfile.
     """
     if feattype == "mfcc":
-      return feat.makeMfccFeats(self.dirname, self.config, wavscp, segmentsfile,
+      return self._memoized(feat.makeMfccFeats, wavscp, segmentsfile,
         samplefreq, useenergy, framelength, frameshift, numceps, applycmvn,
-        normvars, utt2spk, spk2utt, deltaorder)
+        normvars, utt2spk, spk2utt, deltaorder, numjobs=numjobs)
 
     elif feattype == "plp":
       raise NotImplementedError() 
@@ -343,13 +513,14 @@ class KaldiContext(object):
 
     Returns an object representing the feature segments.
     """
-    return feat.segmentFeats(self.dirname, self.config, feats.filename,
+    return self._memoized(feat.segmentFeats, feats.filename,
       segfile, framerate)
 
 
 
   def decodeNbest(self, n, feats, HCLG, wordsfile, lexiconfile, mdl, 
-    Lalign=None, beam=16, allowpartial=False, acousticscale=0.1, mbr=False):
+    Lalign=None, beam=16, allowpartial=False, acousticscale=0.1, mbr=False,
+    numjobs=1):
     """
     Decodes the features corresponding to the specified
     features object *feats* and returns the *n* best
@@ -374,6 +545,9 @@ class KaldiContext(object):
     If *mbr* is True, Minimum Bayes Risk decoding is performed
     on the lattice as well.
 
+    If *numjobs* is greater than one, the features are split into
+    up to *numjobs* shards by utterance that are decoded concurrently.
+
     Returns an object representing up to *n* best hypothesis
     transcriptions and/or alignments generated by Kaldi.
     """
@@ -384,15 +558,49 @@ class KaldiContext(object):
       phonesfilealign = Lalign.phonesfile
       lexfstalign = Lalign.filename
 
-    return gmmdecode.decodeNbestFeats(self.dirname, self.config, n, feats.filename,
+    return self._memoized(gmmdecode.decodeNbestFeats, n, feats.filename,
       HCLG.filename, wordsfile, lexiconfile, mdl.filename, mdl.treefile,
-      phonesfilealign, lexfstalign, beam, allowpartial, acousticscale, mbr)
+      phonesfilealign, lexfstalign, beam, allowpartial, acousticscale, mbr,
+      featsscp=getattr(feats, "scpfile", None), numjobs=numjobs)
+
+
+
+
+  def rescore(self, hypCollection, Gsmall, Gbig, n, wordsfile, mdl,
+    Lalign=None, acousticscale=0.1, mbr=False):
+    """
+    Rescores the lattices of the hypotheses *hypCollection* returned
+    by decodeNbest with a bigger language model, so decoding can use
+    a graph built from a small or pruned one.
+
+    *Gsmall* must be the grammar object the decoding graph was made
+    with and *Gbig* the grammar object to rescore with, both created
+    from the same word symbol table *wordsfile*.
+
+    *mdl* must be the kaldi object representing the GMM-based
+    acoustic model used to decode.
+
+    *n*, *Lalign*, *acousticscale* and *mbr* are as for decodeNbest.
+
+    Returns an object representing the rescored lattice and up to
+    *n* best hypothesis transcriptions and/or alignments.
+    """
+    phonesfilealign = None
+    lexfstalign = None
+
+    if Lalign:
+      phonesfilealign = Lalign.phonesfile
+      lexfstalign = Lalign.filename
+
+    return self._memoized(gmmdecode.rescoreNbestLattices, n,
+      hypCollection.latfile, Gsmall.filename, Gbig.filename, wordsfile,
+      mdl.filename, phonesfilealign, lexfstalign, acousticscale, mbr)
 
 
 
 
   def decode(self, feats, HCLG, wordsfile, mdl, Lalign=None, beam=16,
-    allowpartial=True, acousticscale=0.1):
+    allowpartial=True, acousticscale=0.1, numjobs=1, pooled=False):
     """
     Decodes the features corresponding to the specified
     features object *feats*.
@@ -411,6 +619,18 @@ class KaldiContext(object):
     The parameters *beam*, *allowpartial*, and *acousticscale*
     are passed to Kaldi's decoder
 
+    If *numjobs* is greater than one, the features are split into
+    up to *numjobs* shards by utterance that are decoded concurrently.
+
+    If *pooled* is True, the features are decoded by a persistent
+    decoder that keeps *HCLG* and *mdl* loaded between calls, which
+    saves loading them for each call when decoding many small feature
+    sets. *numjobs* is then ignored, and *Lalign* is not supported. See
+    the DECODER_POOL_* configuration entries. Utterances the persistent
+    decoder fails on are decoded once more without it, so the
+    hypotheses are the same as without *pooled* and are cached
+    regardless of it.
+
     Returns an object representing the hypothesis transcriptions
     and/or alignments generated by Kaldi.
     """
@@ -418,17 +638,126 @@ class KaldiContext(object):
     lexfstalign = None
 
     if Lalign:
+      if pooled:
+        raise ValueError("Lalign is not supported by pooled decoding.")
       phonesfilealign = Lalign.phonesfile
       lexfstalign = Lalign.filename
 
-    return gmmdecode.decodeFeats(self.dirname, self.config, feats.filename,
+    return self._memoized(gmmdecode.decodeFeats, feats.filename,
       HCLG.filename, wordsfile, mdl.filename, mdl.treefile,
+      phonesfilealign, lexfstalign, beam, allowpartial, acousticscale,
+      featsscp=getattr(feats, "scpfile", None), numjobs=numjobs,
+      pooled=pooled)
+
+
+
+  def iterDecode(self, feats, HCLG, wordsfile, mdl, Lalign=None, beam=16,
+    allowpartial=True, acousticscale=0.1):
+    """
+    Decodes the features corresponding to the specified features
+    object *feats* as decode does, but returns an iterator yielding
+    a result for each utterance as soon as Kaldi outputs it instead
+    of waiting for all of them.
+
+    Each result has the members uttId and words, the list of words
+    decoded. If *Lalign* is specified, wordlens and phonelens are
+    lists of (word or phone, length in frames) tuples, otherwise they
+    are None. Results are not cached, and closing the iterator early
+    stops Kaldi.
+    """
+    phonesfilealign = None
+    lexfstalign = None
+
+    if Lalign:
+      phonesfilealign = Lalign.phonesfile
+      lexfstalign = Lalign.filename
+
+    return gmmdecode.iterDecodeFeats(self.dirname, self.config,
+      feats.filename, HCLG.filename, wordsfile, mdl.filename,
       phonesfilealign, lexfstalign, beam, allowpartial, acousticscale)
 
 
 
+  def onlineDecoder(self, HCLG, wordsfile, mdl, silencephones,
+    wordboundaryfile, lda=None, beam=16, maxactive=7000, acousticscale=0.1,
+    batchsize=27, interutt=50, cmnwindow=600, mincmnwindow=100):
+    """
+    Starts an online decoder that keeps the decoding graph *HCLG*,
+    the word symbol table *wordsfile* and the model *mdl* loaded and
+    decodes audio as it arrives, with online CMVN and deltas.
+
+    *silencephones* must be the colon-separated ids of the silence
+    phones, such as "1:2:3", and *wordboundaryfile* the word boundary
+    table of the phones. If *lda* is given, it must be the file of an
+    LDA transform to use instead of deltas.
+
+    Partial results are produced every *batchsize* frames, so the
+    default of 27 frames keeps their latency well under a second.
+    Utterances end after *interutt* frames of silence. *cmnwindow* and
+    *mincmnwindow* set the online CMVN window in frames. *beam*,
+    *maxactive* and *acousticscale* are passed to the decoder.
+
+    Returns the decoder. Its session method starts an audio stream to
+    push chunks of 16 kHz, 16-bit PCM to and returns partial and final
+    hypotheses. Call close to stop it.
+    """
+    return online.OnlineDecoder(self.config, path.join(self.dirname,
+      "online"), HCLG.filename, wordsfile, mdl.filename, silencephones,
+      wordboundaryfile, lda, beam, maxactive, acousticscale, batchsize,
+      interutt, cmnwindow, mincmnwindow)
+
+
+
+  def decodeAudio(self, wavscp, HCLG, wordsfile, mdl, segmentsfile=None,
+    samplefreq=16000, useenergy=False, framelength=25, frameshift=10,
+    numceps=13, applycmvn=True, normvars=False, utt2spk=None, spk2utt=None,
+    deltaorder=2, Lalign=None, beam=16, allowpartial=True,
+    acousticscale=0.1, cache=True):
+    """
+    Decodes the wave files specified by *wavscp*, computing their
+    features in a pipeline that feeds the decoder directly so that
+    no feature archive is written.
+
+    *segmentsfile*, *samplefreq*, *useenergy*, *framelength*,
+    *frameshift*, *numceps*, *applycmvn*, *normvars*, *utt2spk*,
+    *spk2utt* and *deltaorder* are as for makeFeatures, and *HCLG*,
+    *wordsfile*, *mdl*, *Lalign*, *beam*, *allowpartial* and
+    *acousticscale* as for decode. File names must not contain spaces.
+
+    *wavscp* must be sorted by utterance id and, if *utt2spk* and
+    *spk2utt* are given, utterance ids must start with their speaker
+    id, so that each speaker's utterances are contiguous. The features
+    are then normalized while they stream, without holding those of
+    the whole corpus in memory.
+
+    If *cache* is False, the hypotheses are not cached and are
+    recomputed on every call. Their files are deleted by sweep() once
+    they are older than its *minage*.
+
+    Returns an object representing the hypothesis transcriptions
+    and/or alignments generated by Kaldi.
+    """
+    phonesfilealign = None
+    lexfstalign = None
+
+    if Lalign:
+      phonesfilealign = Lalign.phonesfile
+      lexfstalign = Lalign.filename
+
+    args = (wavscp, segmentsfile, samplefreq, useenergy, framelength,
+      frameshift, numceps, applycmvn, normvars, utt2spk, spk2utt, deltaorder,
+      HCLG.filename, wordsfile, mdl.filename, mdl.treefile, phonesfilealign,
+      lexfstalign, beam, allowpartial, acousticscale)
+
+    if not cache:
+      return gmmdecode.decodeAudio(self.dirname, self.config, *args,
+        cache=False)
+    return self._memoized(gmmdecode.decodeAudio, *args)
+
+
+
   def align(self, feats, transfile, L, Lalign, mdl, beam=200, retrybeam=0,
-    acousticscale=1.0, selfloopscale=1.0, transitionscale=1.0):
+    acousticscale=1.0, selfloopscale=1.0, transitionscale=1.0, numjobs=1):
     """
     Aligns the features corresponding to the specified
     features object *feats* to the transcripts specified
@@ -444,11 +773,70 @@ class KaldiContext(object):
     The parameters *beam*, *retrybeam*, *acousticscale*, *selfloopscale*,
     and *transitionscale*, are passed to Kaldi's aligner
 
+    If *numjobs* is greater than one, the features and transcripts
+    are split into up to *numjobs* shards by utterance that are
+    aligned concurrently. The overall log-likelihood per frame is
+    then the average of the shards' weighted by their frames.
+
     Returns an object representing the hypothesis alignments
     generated by Kaldi.
     """
-    return gmmdecode.alignFeats(self.dirname, self.config, feats.filename,
+    return self._memoized(gmmdecode.alignFeats, feats.filename,
       transfile, L.wordsfile, L.filename, Lalign.phonesfile, Lalign.filename,
       mdl.filename, mdl.treefile, beam, retrybeam, acousticscale,
-      selfloopscale, transitionscale)
+      selfloopscale, transitionscale,
+      featsscp=getattr(feats, "scpfile", None), numjobs=numjobs)
+
+
+
 
+class AsyncKaldiContext(object):
+  """
+  Provides the methods of a KaldiContext, but each method building
+  an object returns a Handle immediately instead of its result, and
+  accepts handles returned by other methods in place of their
+  results. Methods run concurrently once the handles they were given
+  have finished, each taking *numjobs* jobs, or one job, from the
+  scheduler's budget. Other methods, such as iterDecode and destroy,
+  are those of the context.
+
+  For example, L and G are built at the same time here, and the HCLG
+  graph as soon as both are done:
+
+    actx = context.asynchronous()
+    L = actx.makeL("phones.txt", "words.txt", "lexicon.txt")
+    G = actx.makeGArpa("words.txt", "lm.arpa")
+    HCLG = actx.makeHCLG(L, G, mdl)
+    hyp = actx.decode(feats, HCLG, L.wordsfile, mdl).result()
+  """
+
+
+  def __init__(self, context, scheduler):
+    """
+    Initializes the asynchronous interface to the KaldiContext
+    *context*, running methods with *scheduler*.
+    """
+    self.context = context
+    self.scheduler = scheduler
+
+
+
+  def __getattr__(self, name):
+    member = getattr(self.context, name)
+    if name not in _STAGE_METHODS:
+      return member
+
+    def submit(*args, **kwargs):
+      return self.scheduler.submit(member, args, kwargs,
+        kwargs.get("numjobs", 1))
+    submit.__name__ = name
+    submit.__doc__ = member.__doc__
+    return submit
+
+
+
+  def wait(self):
+    """
+    Waits for all methods called so far to finish.
+    """
+    self.scheduler.wait()
@@ -15,8 +15,12 @@
 """
 Defines methods for interfacing with Kaldi binaries.
 """
-__all__ = ["graph", "feat", "gmmdecode"]
+__all__ = ["graph", "feat", "gmmdecode", "pool", "table", "online", "arpa"]
 
+import arpa
 import graph
 import feat
+import table
 import gmmdecode
+import pool
+import online
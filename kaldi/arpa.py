@@ -0,0 +1,377 @@
+# Copyright 2013 Signal Analysis and Interpretation Laboratory,
+# University of Southern California
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Defines methods for limiting the order of ARPA language models and
+pruning them without an external toolkit.
+"""
+
+from math import log10
+from string import split,strip
+
+
+
+# log10 probability of words missing from the unigrams
+_LOG_ZERO = -99.0
+
+# sentence start word of ARPA models
+_SOS_WORD = "<s>"
+
+
+
+
+def _sectionOrder(line):
+  """
+  Returns the order of the n-gram section started by the ARPA header
+  *line*, such as "\\2-grams:", or None if it starts no section.
+  """
+  line = strip(line)
+  if line.startswith("\\") and line.endswith("-grams:"):
+    return int(line[1:-len("-grams:")])
+  return None
+
+
+
+
+def _parseNgram(line, order):
+  """
+  Returns a tuple of the log10 probability, the key and the log10
+  backoff weight of the n-gram of *order* on the ARPA *line*, or None
+  if the line holds no n-gram. Keys are the words joined by spaces.
+  """
+  parts = split(line)
+  if len(parts) <= order:
+    return None
+  bow = 0.0
+  if len(parts) > order + 1:
+    bow = float(parts[order + 1])
+  return (float(parts[0]), " ".join(parts[1:order + 1]), bow)
+
+
+
+
+def _formatNgram(prob, key, bow):
+  if bow:
+    return "{0:.7g}\t{1}\t{2:.7g}\n".format(prob, key, bow)
+  return "{0:.7g}\t{1}\n".format(prob, key)
+
+
+
+
+class _Pruner(object):
+  """
+  Prunes the ARPA LM file *lmIn* with the relative entropy criterion
+  of Stolcke, "Entropy-based Pruning of Backoff Language Models",
+  as SRILM's -prune does. N-grams are pruned from the highest order
+  down, and never while a longer kept n-gram extends them. Orders
+  below the highest are held in memory; the highest order is read
+  from the file again for each pass.
+  """
+
+  def __init__(self, lmIn, counts, order, threshold):
+    self.lmIn = lmIn
+    self.order = order
+    self.truncated = order < max(counts)
+    self.limit = log10(1.0 + threshold)
+
+    self.probs = {}
+    self.bows = {}
+    self.keys = dict([(k, []) for k in range(1, order)])
+    self.contextProbs = {}
+    self.counts = {}
+    self.highestOffset = None
+
+
+  def _logProb(self, words, probs, bows):
+    """
+    Returns the log10 probability of the last of *words* given the
+    others in the model of *probs* and *bows*.
+    """
+    logProb = 0.0
+    while True:
+      key = " ".join(words)
+      if key in probs:
+        return logProb + probs[key]
+      if len(words) == 1:
+        return logProb + _LOG_ZERO
+      logProb += bows.get(" ".join(words[:-1]), 0.0)
+      words = words[1:]
+
+
+  def _contextProb(self, context):
+    """
+    Returns the probability of the word sequence *context* in the
+    original model. A leading sentence start is given, with
+    probability one, as SRILM treats it.
+    """
+    try:
+      return self.contextProbs[context]
+    except KeyError:
+      pass
+    words = context.split(" ")
+    logProb = 0.0
+    start = 1 if words[0] == _SOS_WORD else 0
+    for i in range(start, len(words)):
+      logProb += self._logProb(words[:i + 1], self.probs, self.bows)
+    self.contextProbs[context] = 10 ** logProb
+    return self.contextProbs[context]
+
+
+  def _highestNgrams(self):
+    """
+    Yields the line and parsed n-gram of each n-gram of the highest
+    kept order, reading them from the file.
+    """
+    self.lmIn.seek(self.highestOffset)
+    for line in iter(self.lmIn.readline, ""):
+      if strip(line).startswith("\\"):
+        break
+      ngram = _parseNgram(line, self.order)
+      if ngram is not None:
+        yield (line, ngram)
+
+
+  def load(self):
+    """
+    Reads the orders below the highest into memory and sums the
+    probabilities of the explicit n-grams of each context, in the
+    original model and backed off.
+    """
+    order = None
+    for line in iter(self.lmIn.readline, ""):
+      sectionOrder = _sectionOrder(line)
+      if sectionOrder is not None:
+        order = sectionOrder
+        if order == self.order:
+          self.highestOffset = self.lmIn.tell()
+          break
+        continue
+      if order is None:
+        continue
+      ngram = _parseNgram(line, order)
+      if ngram is not None:
+        (prob, key, bow) = ngram
+        self.probs[key] = prob
+        if bow:
+          self.bows[key] = bow
+        self.keys[order].append(key)
+
+    if self.highestOffset is None:
+      raise ValueError("no {0}-grams section in ARPA file".format(self.order))
+
+    self.totals = {}
+    for k in range(2, self.order):
+      for key in self.keys[k]:
+        self._addTotal(key, self.probs[key])
+    for (line, (prob, key, bow)) in self._highestNgrams():
+      self._addTotal(key, prob)
+
+
+  def _addTotal(self, key, prob):
+    words = key.split(" ")
+    context = " ".join(words[:-1])
+    lowerProb = self._logProb(words[1:], self.probs, self.bows)
+    try:
+      total = self.totals[context]
+    except KeyError:
+      total = self.totals[context] = [0.0, 0.0]
+    total[0] += 10 ** prob
+    total[1] += 10 ** lowerProb
+
+
+  def _prunable(self, prob, key):
+    """
+    Returns True if removing the n-gram *key* with log10 probability
+    *prob* from the original model increases its perplexity by less
+    than the threshold.
+    """
+    words = key.split(" ")
+    context = " ".join(words[:-1])
+    lowerProb = self._logProb(words[1:], self.probs, self.bows)
+    (explicit, explicitLower) = self.totals[context]
+
+    numerator = 1.0 - explicit
+    denominator = 1.0 - explicitLower
+    p = 10 ** prob
+    q = 10 ** lowerProb
+    if numerator + p <= 0 or denominator + q <= 0:
+      return False
+
+    oldBow = self.bows.get(context, 0.0)
+    newBow = log10((numerator + p) / (denominator + q))
+    entropy = -self._contextProb(context) * (p * (lowerProb + newBow - prob)
+      + numerator * (newBow - oldBow))
+    return entropy < self.limit
+
+
+  def prune(self):
+    """
+    Decides which n-grams to keep, from the highest order down, and
+    recomputes the backoff weights of the kept n-grams.
+    """
+    extended = set()
+    self.counts[self.order] = 0
+    for (line, (prob, key, bow)) in self._highestNgrams():
+      if not self._prunable(prob, key):
+        extended.add(key[:key.rindex(" ")])
+        self.counts[self.order] += 1
+
+    self.pruned = set()
+    for k in range(self.order - 1, 1, -1):
+      for key in self.keys[k]:
+        if key in extended or not self._prunable(self.probs[key], key):
+          extended.add(key[:key.rindex(" ")])
+        else:
+          self.pruned.add(key)
+
+    # the pruned model, with backoff weights renormalized from the
+    # lowest order up so that each context's probabilities sum to one
+    self.newProbs = dict([(key, prob) for (key, prob)
+      in self.probs.iteritems() if key not in self.pruned])
+    self.newBows = {}
+    sums = {}
+    for k in range(2, self.order + 1):
+      if k < self.order:
+        ngrams = [(self.probs[key], key) for key in self.keys[k]
+          if key not in self.pruned]
+      else:
+        ngrams = ((prob, key) for (line, (prob, key, bow))
+          in self._highestNgrams() if not self._prunable(prob, key))
+
+      for (prob, key) in ngrams:
+        words = key.split(" ")
+        context = " ".join(words[:-1])
+        lowerProb = self._logProb(words[1:], self.newProbs, self.newBows)
+        try:
+          total = sums[context]
+        except KeyError:
+          total = sums[context] = [0.0, 0.0]
+        total[0] += 10 ** prob
+        total[1] += 10 ** lowerProb
+
+      for context in self.keys[k - 1]:
+        if context in self.pruned:
+          continue
+        (explicit, explicitLower) = sums.get(context, (0.0, 0.0))
+        if explicit < 1.0 and explicitLower < 1.0:
+          self.newBows[context] = log10((1.0 - explicit) / (1.0 - explicitLower))
+        else:
+          self.newBows[context] = self.bows.get(context, 0.0)
+
+    for k in range(1, self.order):
+      self.counts[k] = len(self.keys[k]) - len([key for key in self.keys[k]
+        if key in self.pruned])
+
+
+  def lines(self):
+    """
+    Yields the lines of the pruned model.
+    """
+    yield "\\data\\\n"
+    for k in range(1, self.order + 1):
+      yield "ngram {0}={1}\n".format(k, self.counts[k])
+
+    for k in range(1, self.order):
+      yield "\n\\{0}-grams:\n".format(k)
+      for key in self.keys[k]:
+        if key not in self.pruned:
+          yield _formatNgram(self.probs[key], key, self.newBows.get(key, 0.0))
+
+    yield "\n\\{0}-grams:\n".format(self.order)
+    for (line, (prob, key, bow)) in self._highestNgrams():
+      if not self._prunable(prob, key):
+        if self.truncated:
+          line = _formatNgram(prob, key, 0.0)
+        yield line
+
+    yield "\n\\end\\\n"
+
+
+
+
+def _truncatedLines(lmIn, order):
+  """
+  Yields the lines of the ARPA LM file *lmIn* without the n-grams
+  above *order*, whose backoff weights are no longer used.
+  """
+  sectionOrder = None
+  truncated = False
+  for line in lmIn:
+    stripped = strip(line)
+    if stripped.startswith("ngram ") and "=" in stripped:
+      if int(stripped[len("ngram "):stripped.index("=")]) > order:
+        truncated = True
+        continue
+    elif stripped.startswith("\\"):
+      sectionOrder = _sectionOrder(line)
+    elif sectionOrder == order and truncated:
+      ngram = _parseNgram(line, order)
+      if ngram is not None:
+        line = _formatNgram(ngram[0], ngram[1], 0.0)
+
+    if sectionOrder is None or sectionOrder <= order:
+      yield line
+
+
+
+
+def pruneArpa(lmIn, threshold=0, maxorder=None):
+  """
+  Yields the lines of the ARPA LM file *lmIn*, open for reading,
+  without the n-grams above *maxorder* if given. If *threshold* is
+  positive, n-grams whose removal increases the perplexity of the
+  model by less than *threshold*, relative to its original
+  perplexity, are pruned as by SRILM's -prune and the backoff weights
+  are renormalized. Lines are yielded unchanged if neither is given.
+  """
+  if not threshold and not maxorder:
+    for line in lmIn:
+      yield line
+    return
+
+  # read the n-gram counts from the header
+  counts = {}
+  preamble = []
+  for line in iter(lmIn.readline, ""):
+    stripped = strip(line)
+    if stripped.startswith("ngram ") and "=" in stripped:
+      (order, count) = stripped[len("ngram "):].split("=")
+      counts[int(order)] = int(count)
+    elif counts and _sectionOrder(line) is not None:
+      break
+    elif not counts:
+      preamble.append(line)
+  if not counts:
+    raise ValueError("no n-gram counts in ARPA header")
+
+  order = max(counts)
+  if maxorder:
+    if maxorder < 1:
+      raise ValueError("maxorder must be at least 1")
+    order = min(order, maxorder)
+
+  lmIn.seek(0)
+  if threshold <= 0 or order == 1:
+    for line in _truncatedLines(lmIn, order):
+      yield line
+    return
+
+  pruner = _Pruner(lmIn, counts, order, threshold)
+  pruner.load()
+  pruner.prune()
+  for line in preamble:
+    if strip(line) != "\\data\\":
+      yield line
+  for line in pruner.lines():
+    yield line
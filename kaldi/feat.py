@@ -16,100 +16,309 @@
 Defines methods for generating features with Kaldi.
 """
 
-from os import path,remove
-from shutil import copy2
+from os import path,remove,rename
+from hashlib import sha1
 from string import strip
-from subprocess import Popen
-from tempfile import NamedTemporaryFile
 
 from skip.util import (KaldiObject, _randFilename, _getCachedObject,
-  _cacheObject, _refreshRequired, KaldiError)
+  _cacheObject, _refreshRequired, _singleFlight, _inputsChanged,
+  _stampInputs, _fileChanged, _fileStamp, _artifactKey, _fetchArtifact,
+  _storeArtifact, _snapshot, _shardBounds, _tmpFilename, _removeFiles,
+  _popen, KaldiError)
 
 
 
-def makeMfccFeats(directory, config, wavscp, segmentsfile, samplefreq,
-  useenergy, framelength, frameshift, numceps, applycmvn, normvars,
-  utt2spk, spk2utt, deltaorder):
+def _wavStamps(wavscp, config):
+  """
+  Returns a dictionary mapping the wave files in the table *wavscp*
+  to their stamps, as returned by _fileStamp. Commands in the table
+  are ignored.
+  """
+  stamps = {}
+  with open(wavscp, "r") as wavsIn:
+    for line in wavsIn:
+      if strip(line):
+        if "|" not in line: # ignore commands in the table
+          fname = strip(line[line.index(" "):])
+          stamps[fname] = _fileStamp(fname, config)
+  return stamps
 
-  Mfccdir = path.join(directory, "mfcc_feats")
-  (feats, idxFile) = _getCachedObject(Mfccdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
-  
 
-  # check wave files to make sure they are up to date
-  wavsOld = False
-  try:
-    mtimes = feats.wav_times
-    for wavFile in mtimes.keys():
-      if int(path.getmtime(wavFile)) > mtimes[wavFile]:
-        wavsOld = True
-        break
-  except AttributeError:
-    pass
 
 
-  # check file modification time to see if a refresh is required
-  origNames = []
-  copyNames = []
+def _wavsChanged(obj, idxFile, config):
+  """
+  Tests the wave files recorded in obj.wav_times, as returned by
+  _wavStamps, and returns True if any of them changed. Renewed
+  stamps are saved by caching *obj* to *idxFile* again.
+  """
   try:
-    origNames.append(wavscp)
-    copyNames.append(feats.wavscp)
+    stamps = obj.wav_times
   except AttributeError:
-    copyNames.append(None)
+    return False
 
-  if segmentsfile:
-    try:
-      origNames.append(segmentsfile)
-      copyNames.append(feats.segmentsfile)
-    except AttributeError:
-      copyNames.append(None)
+  renewed = False
+  for wavFile in stamps.keys():
+    (changed, stamp) = _fileChanged(wavFile, stamps[wavFile], config)
+    if changed:
+      return True
+    if stamp != stamps[wavFile]:
+      stamps[wavFile] = stamp
+      renewed = True
+  if renewed:
+    _cacheObject(obj, idxFile)
+  return False
 
-  if utt2spk and spk2utt:
-    try:
-      origNames.append(utt2spk)
-      copyNames.append(feats.utt2spk)
-    except AttributeError:
-      copyNames.append(None)
-    try:
-      origNames.append(spk2utt)
-      copyNames.append(feats.spk2utt)
-    except AttributeError:
-      copyNames.append(None)
 
-  if not _refreshRequired(zip(origNames, copyNames)) and not wavsOld:
-    return feats
 
 
-  feats.filename = path.join(Mfccdir, _randFilename("feats-", ".ark"))
-  feats.wavscp = path.join(Mfccdir, _randFilename("wav-", ".scp"))
-  
-  copy2(wavscp, feats.wavscp)
+def _featsPipe(config, wavscp, segmentsfile, utt2spk, spk2utt, samplefreq,
+  useenergy, framelength, frameshift, numceps, applycmvn, normvars,
+  deltaorder):
+  """
+  Returns a Kaldi rspecifier reading the features of the wave files
+  in *wavscp* from a pipeline computing them as makeMfccFeats does,
+  without writing any archive. CMVN statistics are read from a second
+  pipeline over the same audio. File names must not contain spaces.
+
+  All pipes are read as sorted, so *wavscp* must be sorted and, with
+  *utt2spk* and *spk2utt*, each speaker's utterances must be sorted
+  and contiguous in it, as Kaldi requires of utterance ids prefixed by
+  their speaker. Kaldi then holds only the current speaker's features
+  in memory.
+  """
+  mfccCmd = "{0} --sample-frequency={1} --use-energy={2} \
+    --frame-length={3} --frame-shift={4} --num-ceps={5}".format(
+    config.computemfccfeats, samplefreq, str(useenergy).lower(),
+    framelength, frameshift, numceps)
+
   if segmentsfile:
-    feats.segmentsfile = path.join(Mfccdir, _randFilename("seg-", ".txt"))
-    copy2(segmentsfile, feats.segmentsfile)
+    mfccCmd = "{0} scp:{1} {2} ark:- | {3} ark:- ark:-".format(
+      config.extractsegments, wavscp, segmentsfile, mfccCmd)
+  else:
+    mfccCmd = "{0} scp:{1} ark:-".format(mfccCmd, wavscp)
 
-  feats.wav_times = {}
-  with open(feats.wavscp, "r") as wavsIn:
-    for line in wavsIn:
-      if strip(line):
-        if "|" not in line: # ignore commands in the table
-          fname = strip(line[line.index(" "):])
-          feats.wav_times[fname] = int(path.getmtime(fname))
+  featsCmd = mfccCmd
+  if applycmvn:
+    spk2uttStr = ""
+    utt2spkStr = ""
+    if utt2spk and spk2utt:
+      spk2uttStr = "--spk2utt=ark:{0}".format(spk2utt)
+      utt2spkStr = "--utt2spk=ark:{0}".format(utt2spk)
 
+    statsSpec = "'ark,s,cs:{0} | {1} {2} ark,s,cs:- ark:- |'".format(
+      mfccCmd, config.computecmvnstats, spk2uttStr)
+    featsCmd = "{0} | {1} --norm-vars={2} {3} {4} ark:- ark:-".format(
+      featsCmd, config.applycmvn, str(normvars).lower(), utt2spkStr,
+      statsSpec)
+
+  if deltaorder > 0:
+    featsCmd = "{0} | {1} --delta-order={2} ark:- ark:-".format(featsCmd,
+      config.adddeltas, deltaorder)
+
+  return "ark,s,cs:{0} |".format(featsCmd)
+
+
+
+
+def _readTable(fname):
+  """
+  Returns the list of (key, value) tuples in the lines of the
+  Kaldi text table *fname*, skipping empty lines.
+  """
+  table = []
+  with open(fname, "r") as f:
+    for line in f:
+      line = strip(line)
+      if line:
+        fields = line.split(None, 1)
+        table.append((fields[0], fields[1] if len(fields) > 1 else ""))
+  return table
 
-  if utt2spk and spk2utt:
-    feats.utt2spk = path.join(Mfccdir, _randFilename("utt2spk-", ".ark"))
-    copy2(utt2spk, feats.utt2spk)
-    feats.spk2utt = path.join(Mfccdir, _randFilename("spk2utt-", ".ark"))
-    copy2(spk2utt, feats.spk2utt)
 
-  tmp = NamedTemporaryFile(suffix=".ark", delete=False)
-  wavSegmentsFile = tmp.name
-  tmp.close()
 
-  tmp = NamedTemporaryFile(suffix=".ark", delete=False)
-  rawfeatsFile = tmp.name
-  tmp.close()
 
+def _writeTable(table, suffix, tmpFiles):
+  """
+  Writes the (key, value) tuples in *table* to a new temporary
+  file, as for _tmpFilename, and returns its name.
+  """
+  fname = _tmpFilename(suffix, tmpFiles)
+  with open(fname, "w") as f:
+    for (key, value) in table:
+      f.write("{0} {1}\n".format(key, value))
+  return fname
+
+
+
+
+def _relocateScp(scpfile, arkfile):
+  """
+  Rewrites the scp index *scpfile* so its entries point into
+  *arkfile*, keeping their offsets.
+  """
+  tmpFile = "{0}.tmp".format(scpfile)
+  with open(scpfile, "r") as fin:
+    with open(tmpFile, "w") as fout:
+      for line in fin:
+        line = strip(line)
+        if line:
+          (key, value) = line.split(None, 1)
+          fout.write("{0} {1}:{2}\n".format(key, arkfile, value[value.rindex(":") + 1:]))
+  rename(tmpFile, scpfile)
+
+
+
+
+def _uttManifest(feats, applycmvn):
+  """
+  Returns a list of (utterance, group, signature) tuples for the
+  utterances of the features object *feats*, in archive order. The
+  signature digests the utterance's segment, its wave file entry and
+  the stamp of the wave file in feats.wav_times. Utterances normalized
+  together, all those of a speaker if speaker files are used, share
+  their group.
+  """
+  wavs = _readTable(feats.wavscp)
+  segmentsfile = getattr(feats, "segmentsfile", None)
+  if segmentsfile:
+    recordings = dict(wavs)
+    utts = [(utt, value, value.split()[0]) for (utt, value)
+      in _readTable(segmentsfile)]
+  else:
+    recordings = dict(wavs)
+    utts = [(utt, "", utt) for (utt, value) in wavs]
+
+  speakers = {}
+  if applycmvn and getattr(feats, "utt2spk", None):
+    speakers = dict(_readTable(feats.utt2spk))
+
+  manifest = []
+  for (utt, segment, recording) in utts:
+    wav = recordings.get(recording, "")
+    stamp = feats.wav_times.get(wav)
+    if isinstance(stamp, tuple):
+      stamp = stamp[2] # the content hash
+    signature = sha1(repr((segment, wav, stamp))).hexdigest()
+    manifest.append((utt, speakers.get(utt, utt), signature))
+  return manifest
+
+
+
+
+def _changedUtts(oldManifest, manifest):
+  """
+  Returns the set of utterances in *manifest* whose features cannot
+  be reused from features described by *oldManifest*, as returned by
+  _uttManifest. These are all the utterances of every group that
+  gained, lost or changed an utterance, since their normalization
+  changes too.
+  """
+  def members(m):
+    groups = {}
+    for (utt, group, signature) in m:
+      groups.setdefault(group, []).append((utt, signature))
+    return groups
+
+  oldGroups = members(oldManifest)
+  changed = set()
+  for (group, utts) in members(manifest).iteritems():
+    if sorted(oldGroups.get(group, [])) != sorted(utts):
+      changed.update([utt for (utt, signature) in utts])
+  return changed
+
+
+
+
+def _mfccShards(feats, numjobs, tmpFiles, subset=None):
+  """
+  Splits the utterances of the features object *feats*, or only
+  those in the set *subset* if given, into at most *numjobs*
+  contiguous shards of about equal audio duration. If the features
+  use speaker files, a speaker never spans shards. Returns a list of
+  (wavscp, segmentsfile, utt2spk, spk2utt) tuples of temporary files
+  as for _tmpFilename, with None for files not used. Segments are
+  extracted from the full wav.scp in all shards.
+  """
+  wavs = _readTable(feats.wavscp)
+  segmentsfile = getattr(feats, "segmentsfile", None)
+  if segmentsfile:
+    utts = _readTable(segmentsfile)
+  else:
+    utts = wavs
+  if subset is not None:
+    utts = [(utt, value) for (utt, value) in utts if utt in subset]
+
+  # weigh utterances by duration, or by wave file size without segments
+  weights = []
+  if segmentsfile:
+    for (utt, value) in utts:
+      fields = value.split()
+      try:
+        weights.append(max(float(fields[2]) - float(fields[1]), 0.0) or None)
+      except (IndexError, ValueError):
+        weights.append(None)
+  else:
+    for (utt, value) in utts:
+      try:
+        weights.append(path.getsize(value) if "|" not in value else None)
+      except OSError:
+        weights.append(None)
+
+  known = [w for w in weights if w is not None]
+  meanWeight = sum(known) / len(known) if known else 1.0
+  weights = [meanWeight if w is None else w for w in weights]
+
+  # only cut after the last utterance of all speakers seen so far
+  cuts = None
+  spk2utt = getattr(feats, "spk2utt", None)
+  if spk2utt:
+    utt2spkTable = _readTable(feats.utt2spk)
+    speakers = dict(utt2spkTable)
+    lastIndex = {}
+    for (i, (utt, value)) in enumerate(utts):
+      lastIndex[speakers.get(utt, utt)] = i
+    cuts = []
+    lastNeeded = 0
+    for (i, (utt, value)) in enumerate(utts):
+      lastNeeded = max(lastNeeded, lastIndex[speakers.get(utt, utt)])
+      cuts.append(lastNeeded == i)
+
+  shards = []
+  for (start, end) in _shardBounds(weights, numjobs, cuts):
+    shardUtts = utts[start:end]
+    if segmentsfile:
+      shard = [feats.wavscp, _writeTable(shardUtts, ".txt", tmpFiles)]
+    else:
+      shard = [_writeTable(shardUtts, ".scp", tmpFiles), None]
+
+    if spk2utt:
+      uttNames = set([utt for (utt, value) in shardUtts])
+      shardUtt2spk = [(u, s) for (u, s) in utt2spkTable if u in uttNames]
+      spkNames = set([s for (u, s) in shardUtt2spk])
+      shardSpk2utt = [(s, u) for (s, u) in _readTable(spk2utt) if s in spkNames]
+      shard.append(_writeTable(shardUtt2spk, ".ark", tmpFiles))
+      shard.append(_writeTable(shardSpk2utt, ".ark", tmpFiles))
+    else:
+      shard.extend([None, None])
+    shards.append(tuple(shard))
+
+  return shards
+
+
+
+
+def _mfccCmd(config, shard, featsDest, tmpFiles, samplefreq, useenergy,
+  framelength, frameshift, numceps, applycmvn, normvars, deltaorder):
+  """
+  Returns the shell command that computes the features of the
+  (wavscp, segmentsfile, utt2spk, spk2utt) tuple *shard*, as
+  returned by _mfccShards, and writes them to the Kaldi wspecifier
+  *featsDest*. Intermediate files are added to *tmpFiles*.
+  """
+  (wavscp, segmentsfile, utt2spk, spk2utt) = shard
+  rawfeatsFile = _tmpFilename(".ark", tmpFiles)
+  cmds = []
 
   # prepare commands
   rawfeatsDest = "\"ark:{0}\"".format(rawfeatsFile)
@@ -117,23 +326,24 @@ def makeMfccFeats(directory, config, wavscp, segmentsfile, samplefreq,
   if deltaorder > 0:
     deltaStr = "ark:- | {0} --delta-order={1} ark:-".format(config.adddeltas, deltaorder)
     if not applycmvn:
-      rawfeatsDest = "{0} \"ark:{1}\"".format(deltaStr, feats.filename)
+      rawfeatsDest = "{0} \"{1}\"".format(deltaStr, featsDest)
   elif not applycmvn:
-    rawfeatsDest = "\"ark:{0}\"".format(feats.filename)
+    rawfeatsDest = "\"{0}\"".format(featsDest)
 
   if segmentsfile:
+    wavSegmentsFile = _tmpFilename(".ark", tmpFiles)
     sourceSpecifier = "ark:{0}".format(wavSegmentsFile)
 
-    makeSegmentsCmd = "{0} \"scp:{1}\" \"{2}\" \"ark:{3}\"".format(config.extractsegments,
-      feats.wavscp, feats.segmentsfile, wavSegmentsFile)
+    cmds.append("{0} \"scp:{1}\" \"{2}\" \"ark:{3}\"".format(config.extractsegments,
+      wavscp, segmentsfile, wavSegmentsFile))
   else:
-    sourceSpecifier = "scp:{0}".format(feats.wavscp)
+    sourceSpecifier = "scp:{0}".format(wavscp)
 
-  makeRawFeatCmd = "{0} --sample-frequency={1} --use-energy={2} \
+  cmds.append("{0} --sample-frequency={1} --use-energy={2} \
     --frame-length={3} --frame-shift={4} --num-ceps={5} \
     \"{6}\" {7}".format(config.computemfccfeats,
     samplefreq, str(useenergy).lower(), framelength, frameshift,
-    numceps, sourceSpecifier, rawfeatsDest)
+    numceps, sourceSpecifier, rawfeatsDest))
 
 
   if applycmvn:
@@ -143,41 +353,238 @@ def makeMfccFeats(directory, config, wavscp, segmentsfile, samplefreq,
       spk2uttStr = "--spk2utt=\"ark:{0}\"".format(spk2utt)
       utt2spkStr = "--utt2spk=\"ark:{0}\"".format(utt2spk)
 
-    applyCmvnCmd = "{0} {1} \"ark:{2}\" ark:- | {3} --norm-vars={4} \
-      {5} ark:- \"ark:{2}\" {6} \"ark:{7}\"".format(config.computecmvnstats,
+    cmds.append("{0} {1} \"ark:{2}\" ark:- | {3} --norm-vars={4} \
+      {5} ark:- \"ark:{2}\" {6} \"{7}\"".format(config.computecmvnstats,
       spk2uttStr, rawfeatsFile, config.applycmvn, str(normvars).lower(),
-      utt2spkStr, deltaStr, feats.filename)
+      utt2spkStr, deltaStr, featsDest))
 
+  return " && ".join(["( {0} )".format(cmd) for cmd in cmds])
 
-  # compute and return the features
-  logFile = open(path.join(Mfccdir, _randFilename(suffix=".log")), "w")
 
-  try:
-    if segmentsfile:
-      segmentProc = Popen(makeSegmentsCmd, stderr=logFile, shell=True)
-      segmentProc.communicate()
-      retCode = segmentProc.poll()
-      if retCode:
-        raise KaldiError(logFile.name)
 
-    featProc = Popen(makeRawFeatCmd, stderr=logFile, shell=True)
-    featProc.communicate()
-    retCode = featProc.poll()
-    if retCode:
-      raise KaldiError(logFile.name)
 
-    if applycmvn:
-      featProc = Popen(applyCmvnCmd, stderr=logFile, shell=True)
+def _computeMfcc(config, feats, Mfccdir, arkfile, scpfile, subset, numjobs,
+  tmpFiles, samplefreq, useenergy, framelength, frameshift, numceps,
+  applycmvn, normvars, deltaorder):
+  """
+  Computes the features of the utterances of the features object
+  *feats*, or only those in the set *subset* if given, in up to
+  *numjobs* concurrent shards and writes them to *arkfile* indexed
+  by *scpfile*. Intermediate files are added to *tmpFiles*.
+  """
+  if numjobs > 1 or subset is not None:
+    shards = _mfccShards(feats, numjobs, tmpFiles, subset)
+  else:
+    shards = [(feats.wavscp, getattr(feats, "segmentsfile", None),
+      getattr(feats, "utt2spk", None), getattr(feats, "spk2utt", None))]
+
+  if len(shards) == 1:
+    featsDests = ["ark,scp:{0},{1}".format(arkfile, scpfile)]
+  else:
+    featsDests = []
+    for shard in shards:
+      featsDests.append("ark:{0}".format(_tmpFilename(".ark", tmpFiles)))
+
+  shardCmds = []
+  for (shard, featsDest) in zip(shards, featsDests):
+    shardCmds.append(_mfccCmd(config, shard, featsDest, tmpFiles,
+      samplefreq, useenergy, framelength, frameshift, numceps, applycmvn,
+      normvars, deltaorder))
+
+
+  # compute the features
+  logFiles = []
+  try:
+    featProcs = []
+    for shardCmd in shardCmds:
+      logFile = open(path.join(Mfccdir, _randFilename(suffix=".log")), "w")
+      logFiles.append(logFile)
+      featProcs.append(_popen(shardCmd, stderr=logFile))
+
+    failedLog = None
+    for (featProc, logFile) in zip(featProcs, logFiles):
       featProc.communicate()
       retCode = featProc.poll()
+      if retCode and failedLog is None:
+        failedLog = logFile.name
+    if failedLog:
+      raise KaldiError(failedLog)
+
+    if len(shards) > 1:
+      copyCmd = "{0} \"ark:cat {1} |\" \"ark,scp:{2},{3}\"".format(
+        config.copyfeats, " ".join([d[4:] for d in featsDests]),
+        arkfile, scpfile)
+      copyProc = _popen(copyCmd, stderr=logFiles[0])
+      copyProc.communicate()
+      retCode = copyProc.poll()
       if retCode:
-        raise KaldiError(logFile.name)
+        raise KaldiError(logFiles[0].name)
   finally:
-    logFile.close()
+    for logFile in logFiles:
+      logFile.close()
 
-  remove(rawfeatsFile)
 
 
+
+@_singleFlight
+def makeMfccFeats(directory, config, wavscp, segmentsfile, samplefreq,
+  useenergy, framelength, frameshift, numceps, applycmvn, normvars,
+  utt2spk, spk2utt, deltaorder, numjobs=1):
+
+  Mfccdir = path.join(directory, "mfcc_feats")
+  (feats, idxFile) = _getCachedObject(Mfccdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems() if k != "numjobs"]))
+  
+
+  # check wave files to make sure they are up to date
+  wavsOld = _wavsChanged(feats, idxFile, config)
+
+
+  # check file modification time to see if a refresh is required
+  origNames = []
+  copyNames = []
+  try:
+    origNames.append(wavscp)
+    copyNames.append(feats.wavscp)
+  except AttributeError:
+    copyNames.append(None)
+
+  if segmentsfile:
+    try:
+      origNames.append(segmentsfile)
+      copyNames.append(feats.segmentsfile)
+    except AttributeError:
+      copyNames.append(None)
+
+  if utt2spk and spk2utt:
+    try:
+      origNames.append(utt2spk)
+      copyNames.append(feats.utt2spk)
+    except AttributeError:
+      copyNames.append(None)
+    try:
+      origNames.append(spk2utt)
+      copyNames.append(feats.spk2utt)
+    except AttributeError:
+      copyNames.append(None)
+
+  if (not _refreshRequired(zip(origNames, copyNames), config=config,
+    snapshots=getattr(feats, "snapshot_times", None)) and not wavsOld):
+    return feats
+
+
+  # keep the old features to reuse unchanged utterances, and remove
+  # the old copies of the inputs
+  oldFiles = [getattr(feats, attr, None) for attr in ("filename",
+    "scpfile", "manifest")]
+  oldManifest = None
+  if None not in oldFiles and len([f for f in oldFiles if path.isfile(f)]) == 3:
+    with open(oldFiles[2], "r") as manifestIn:
+      oldManifest = [tuple(line.split()) for line in manifestIn]
+  for copyName in copyNames:
+    try:
+      remove(copyName)
+    except (OSError, TypeError):
+      pass
+
+
+  feats.filename = path.join(Mfccdir, _randFilename("feats-", ".ark"))
+  feats.wavscp = path.join(Mfccdir, _randFilename("wav-", ".scp"))
+  feats.snapshot_times = {}
+  
+  _snapshot(wavscp, feats.wavscp, feats, config)
+  if segmentsfile:
+    feats.segmentsfile = path.join(Mfccdir, _randFilename("seg-", ".txt"))
+    _snapshot(segmentsfile, feats.segmentsfile, feats, config)
+
+  feats.wav_times = _wavStamps(feats.wavscp, config)
+
+
+  if utt2spk and spk2utt:
+    feats.utt2spk = path.join(Mfccdir, _randFilename("utt2spk-", ".ark"))
+    _snapshot(utt2spk, feats.utt2spk, feats, config)
+    feats.spk2utt = path.join(Mfccdir, _randFilename("spk2utt-", ".ark"))
+    _snapshot(spk2utt, feats.spk2utt, feats, config)
+
+  feats.scpfile = path.join(Mfccdir, _randFilename("feats-", ".scp"))
+
+  # record a signature of each utterance for later refreshes
+  manifest = _uttManifest(feats, applycmvn)
+  feats.manifest = path.join(Mfccdir, _randFilename("manifest-", ".txt"))
+  with open(feats.manifest, "w") as manifestOut:
+    for entry in manifest:
+      manifestOut.write("{0} {1} {2}\n".format(*entry))
+
+  # reuse the features if another context already computed them
+  storeKey = None
+  if config.SHARED_STORE_DIR:
+    wavsDigest = sha1()
+    for item in sorted(feats.wav_times.iteritems()):
+      wavsDigest.update(str(item))
+    storeKey = _artifactKey("mfcc", (samplefreq, useenergy, framelength,
+      frameshift, numceps, applycmvn, normvars, deltaorder,
+      wavsDigest.hexdigest()), (wavscp, segmentsfile, utt2spk, spk2utt))
+    if _fetchArtifact(config, storeKey, feats.scpfile):
+      if _fetchArtifact(config, storeKey, feats.filename):
+        _relocateScp(feats.scpfile, feats.filename)
+        _removeFiles(oldFiles)
+        return _cacheObject(feats, idxFile)
+      remove(feats.scpfile)
+
+
+  # only compute the utterances of changed groups if the old features
+  # can be reused, otherwise compute all of them
+  changed = None
+  if oldManifest is not None:
+    changed = _changedUtts(oldManifest, manifest)
+    if len(changed) == len(manifest):
+      changed = None
+
+  tmpFiles = []
+  try:
+    if changed is None:
+      (computedArk, computedScp) = (feats.filename, feats.scpfile)
+    else:
+      computedArk = _tmpFilename(".ark", tmpFiles)
+      computedScp = _tmpFilename(".scp", tmpFiles)
+
+    logFile = open(path.join(Mfccdir, _randFilename(suffix=".log")), "w")
+    try:
+      if changed is None or changed:
+        _computeMfcc(config, feats, Mfccdir, computedArk, computedScp,
+          changed, numjobs, tmpFiles, samplefreq, useenergy, framelength,
+          frameshift, numceps, applycmvn, normvars, deltaorder)
+
+
+      # merge the computed features with the unchanged old ones
+      if changed is not None:
+        entries = dict(_readTable(oldFiles[1]))
+        if changed:
+          entries.update(_readTable(computedScp))
+        merged = [(utt, entries[utt]) for (utt, group, signature) in manifest
+          if utt in entries]
+        mergedScp = _writeTable(merged, ".scp", tmpFiles)
+
+        copyCmd = "{0} \"scp:{1}\" \"ark,scp:{2},{3}\"".format(
+          config.copyfeats, mergedScp, feats.filename, feats.scpfile)
+        copyProc = _popen(copyCmd, stderr=logFile)
+        copyProc.communicate()
+        retCode = copyProc.poll()
+        if retCode:
+          raise KaldiError(logFile.name)
+    finally:
+      logFile.close()
+  finally:
+    for tmpFile in tmpFiles:
+      try:
+        remove(tmpFile)
+      except OSError:
+        pass
+
+  _removeFiles(oldFiles)
+  if storeKey:
+    _storeArtifact(config, storeKey, feats.scpfile)
+    _storeArtifact(config, storeKey, feats.filename)
+
   return _cacheObject(feats, idxFile)
 
 
@@ -187,40 +594,41 @@ def makeMfccFeats(directory, config, wavscp, segmentsfile, samplefreq,
 
 
 
+@_singleFlight
 def segmentFeats(directory, config, featsfile, segfile, framerate):
 
   segDir = path.join(directory, "feat_segments")
   (feats, idxFile) = _getCachedObject(segDir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
   
-  refreshRequired = False
-  try:
-    if int(path.getmtime(featsfile)) > feats.featsfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(segfile)) > feats.segfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
+  inputs = (("featsfile_time", featsfile), ("segfile_time", segfile))
 
-  if not refreshRequired:
+  if not _inputsChanged(feats, idxFile, inputs, config):
     return feats
 
-  feats.featsfile_time = int(path.getmtime(featsfile))
-  feats.segfile_time = int(path.getmtime(segfile))
+  # remove old files
+  try:
+    remove(feats.filename)
+  except (OSError, AttributeError):
+    pass
+  try:
+    remove(feats.scpfile)
+  except (OSError, AttributeError):
+    pass
+
+  _stampInputs(feats, inputs, config)
   feats.filename = path.join(segDir, _randFilename("feats-", ".ark"))
+  feats.scpfile = path.join(segDir, _randFilename("feats-", ".scp"))
 
   segFeatsCmd = "{0} --frame-rate={1} \"ark:{2}\" \"{3}\" \
-    \"ark:{4}\"".format(config.extractfeaturesegments, framerate,
-      featsfile, segfile, feats.filename)
+    \"ark,scp:{4},{5}\"".format(config.extractfeaturesegments, framerate,
+      featsfile, segfile, feats.filename, feats.scpfile)
 
 
   # segment and return the features
   logFile = open(path.join(segDir, _randFilename(suffix=".log")), "w")
 
   try:
-    featProc = Popen(segFeatsCmd, stderr=logFile, shell=True)
+    featProc = _popen(segFeatsCmd, stderr=logFile)
     featProc.communicate()
     retCode = featProc.poll()
     if retCode:
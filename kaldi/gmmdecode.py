@@ -16,17 +16,62 @@
 Defines methods for decoding and aligning with GMM-based models.
 """
 
-from os import path,remove
-from subprocess import Popen,PIPE
+from os import path,remove,rename,makedirs,mkfifo,close,O_RDWR,O_NONBLOCK
+from os import open as osopen
+from subprocess import PIPE
 from string import split,strip
-from tempfile import NamedTemporaryFile
-from shutil import copy2
+from tempfile import NamedTemporaryFile,mkdtemp
+from shutil import copy2,copyfileobj,rmtree
+from threading import Thread
+from hashlib import sha1
+from ast import literal_eval
+from Queue import Queue,Empty
 
 from skip.util import (KaldiObject, _randFilename, _getCachedObject,
-  _cacheObject, _refreshRequired, KaldiError)
+  _cacheObject, _refreshRequired, _singleFlight, _inputsChanged,
+  _stampInputs, _fileChanged, _shardBounds, _runConcurrently, _tmpFilename,
+  _removeFiles, _popen, _killTree, KaldiError)
+from skip.kaldi.feat import _featsPipe, _readTable, _wavStamps, _wavsChanged
+from skip.kaldi import pool, table
 
 
 
+# members of hypothesis objects naming per-utterance output files
+_HYP_FILES = ("filename", "intfilename", "wordlens", "intwordlens",
+  "phonelens", "intphonelens", "latfile", "intmbr", "mbr", "stats",
+  "mbrtimes", "risk")
+
+# members of alignment objects naming files written by each shard
+_ALIGN_FILES = ("wordlens", "intwordlens", "phonelens", "intphonelens")
+
+
+
+
+
+
+def _outputLines(cmd, logFile):
+  """
+  Runs the shell command *cmd* and yields the lines of its standard
+  output as they are written, so they are processed while it runs.
+  Raises KaldiError naming *logFile* if the command fails. Closing
+  the generator early kills the command.
+  """
+  proc = _popen(cmd, stdout=PIPE, stderr=logFile)
+  finished = False
+  try:
+    for line in iter(proc.stdout.readline, ""):
+      yield line
+    finished = True
+  finally:
+    if not finished:
+      _killTree(proc)
+    proc.stdout.close()
+    retCode = proc.wait()
+
+  if retCode:
+    raise KaldiError(logFile.name)
+
+
 
 
 
@@ -39,33 +84,20 @@ def _align(config, logFile, mdlfile, intfilename, lexfstalign,
 
 
   # align phones and translate to text
-  phoneLensFile = NamedTemporaryFile(mode="w+", suffix=".txt")
-  makePhonelensProc = Popen(makePhonelensCmd, stdout=phoneLensFile,
-    stderr=logFile, shell=True)
-  makePhonelensProc.communicate()
-  retCode = makePhonelensProc.poll()
-  if retCode:
-    raise KaldiError(logFile.name)
-
-  phoneLensFile.seek(0)
-
+  phoneLensLines = _outputLines(makePhonelensCmd, logFile)
   with open(intphonelens, "w") as lensIntOut:
     with open(phonelens, "w") as lensOut:
-      for line in phoneLensFile:
+      for line in phoneLensLines:
         sp = line.index(" ")
         uttId = line[:sp]
         pairsStr = []
         for pair in line[sp+1:].split(";"):
           parts = split(pair)
-          try:
-            sym = phoneSymbols[parts[0]]
-          except KeyError:
-            sym = config.DECODE_OOV_PHONE
+          sym = phoneSymbols.symbol(parts[0], config.DECODE_OOV_PHONE)
           pairsStr.append("{0} {1}".format(sym, parts[1]))
 
         lensIntOut.write(line)
         lensOut.write("{0} {1}\n".format(uttId, " ; ".join(pairsStr)))
-  phoneLensFile.close()
 
   
 
@@ -77,91 +109,286 @@ def _align(config, logFile, mdlfile, intfilename, lexfstalign,
 
 
   # align words and translate to text
-  wordLensFile = NamedTemporaryFile(mode="w+", suffix=".txt")
-  makeWordlensProc = Popen(makeWordlensCmd, stdout=wordLensFile,
-    stderr=logFile, shell=True)
-  makeWordlensProc.communicate()
-  retCode = makeWordlensProc.poll()
-  if retCode:
-    raise KaldiError(logFile.name)
-
-  wordLensFile.seek(0)
-
+  wordLensLines = _outputLines(makeWordlensCmd, logFile)
   with open(intwordlens, "w") as lensIntOut:
     with open(wordlens, "w") as lensOut:
-      for line in wordLensFile:
+      for line in wordLensLines:
         sp = line.index(" ")
         uttId = line[:sp]
         pairsStr = []
         for pair in line[sp+1:].split(";"):
           parts = split(pair)
-          try:
-            sym = wordSymbols[parts[0]]
-          except KeyError:
-            sym = config.DECODE_OOV_WORD
+          sym = wordSymbols.symbol(parts[0], config.DECODE_OOV_WORD)
           pairsStr.append("{0} {1}".format(sym, parts[1]))
 
         lensIntOut.write(line)
         lensOut.write("{0} {1}\n".format(uttId, " ; ".join(pairsStr)))
-  wordLensFile.close()
   
 
 
 
+def _featShards(config, logdir, featsfile, featsscp, numjobs, tmpFiles):
+  """
+  Returns the Kaldi rspecifiers of up to *numjobs* contiguous shards
+  of the features in the archive *featsfile*, balanced by their size
+  in bytes. *featsscp* must be the scp index of *featsfile*, or None
+  to index a temporary copy of the archive. Temporary files are
+  added to *tmpFiles*.
+  """
+  if numjobs <= 1:
+    return ["ark:{0}".format(featsfile)]
+
+  if not featsscp:
+    featsscp = _tmpFilename(".scp", tmpFiles)
+    copyCmd = "{0} \"ark:{1}\" \"ark,scp:{2},{3}\"".format(config.copyfeats,
+      featsfile, _tmpFilename(".ark", tmpFiles), featsscp)
+
+    logFile = open(path.join(logdir, _randFilename(suffix=".log")), "w")
+    try:
+      copyProc = _popen(copyCmd, stderr=logFile)
+      copyProc.communicate()
+      retCode = copyProc.poll()
+      if retCode:
+        raise KaldiError(logFile.name)
+    finally:
+      logFile.close()
+
+  with open(featsscp, "r") as scpIn:
+    entries = [line for line in scpIn if strip(line)]
+
+  # weigh utterances by the distance to the next offset in the archive
+  locations = []
+  for line in entries:
+    location = strip(split(line, None, 1)[1]).rsplit(":", 1)
+    try:
+      locations.append((location[0], int(location[1])))
+    except (IndexError, ValueError):
+      locations.append((None, 0))
+
+  weights = []
+  for (i, (arkfile, offset)) in enumerate(locations):
+    try:
+      if i + 1 < len(locations) and locations[i + 1][0] == arkfile:
+        end = locations[i + 1][1]
+      else:
+        end = path.getsize(arkfile)
+      weights.append(max(end - offset, 1))
+    except (OSError, TypeError):
+      weights.append(1)
+
+  shards = []
+  for (start, end) in _shardBounds(weights, numjobs):
+    shardscp = _tmpFilename(".scp", tmpFiles)
+    with open(shardscp, "w") as scpOut:
+      scpOut.writelines(entries[start:end])
+    shards.append("scp:{0}".format(shardscp))
+  return shards
+
+
+
+
+def _transcriptShards(transfile, featsSpecs, tmpFiles):
+  """
+  Splits the transcripts in *transfile* to match the shards of
+  features *featsSpecs* returned by _featShards. Returns the list
+  of temporary files holding the transcripts of each shard.
+  """
+  shardIndex = {}
+  for (i, featsSpec) in enumerate(featsSpecs):
+    with open(featsSpec[len("scp:"):], "r") as scpIn:
+      for line in scpIn:
+        if strip(line):
+          shardIndex[split(line)[0]] = i
+
+  transFiles = [_tmpFilename(".int", tmpFiles) for featsSpec in featsSpecs]
+  transOuts = [open(fname, "w") for fname in transFiles]
+  try:
+    with open(transfile, "r") as transIn:
+      for line in transIn:
+        if strip(line):
+          try:
+            transOuts[shardIndex[split(line)[0]]].write(line)
+          except KeyError:
+            pass
+  finally:
+    for transOut in transOuts:
+      transOut.close()
+  return transFiles
+
+
+
+
+def _shardOutputs(obj, count, tmpFiles, attrs=_HYP_FILES):
+  """
+  Returns *count* objects with the output file members of *obj*
+  listed in *attrs*, naming temporary files for each shard to
+  write instead. Returns [*obj*] if *count* is one.
+  """
+  if count == 1:
+    return [obj]
+
+  outs = []
+  for i in range(count):
+    out = KaldiObject()
+    for attr in attrs:
+      if attr in obj.__dict__:
+        suffix = path.splitext(getattr(obj, attr))[1]
+        setattr(out, attr, _tmpFilename(suffix, tmpFiles))
+    outs.append(out)
+  return outs
+
+
+
+
+def _mergeOutputs(obj, outs, attrs=_HYP_FILES):
+  """
+  Concatenates the files written by the shards in *outs*, as
+  returned by _shardOutputs, into the output files of *obj*
+  listed in *attrs*.
+  """
+  if outs == [obj]:
+    return
+
+  for attr in attrs:
+    if attr in obj.__dict__:
+      with open(getattr(obj, attr), "wb") as fout:
+        for out in outs:
+          with open(getattr(out, attr), "rb") as fin:
+            copyfileobj(fin, fout)
+
+
+
+
+def _writeHyps(config, lines, hyp, wordSymbols):
+  """
+  Writes the decoded *lines* in Kaldi text archive format to the file
+  named by hyp.intfilename, and their words translated with the
+  SymbolTable *wordSymbols* to the file named by hyp.filename.
+  """
+  with open(hyp.intfilename, "w") as hypIntOut:
+    with open(hyp.filename, "w") as hypOut:
+      for line in lines:
+        parts = split(line)
+        uttId = parts[0]
+        words = wordSymbols.symbols(parts[1:], config.DECODE_OOV_WORD)
+        hypIntOut.write(line)
+        hypOut.write("{0} {1}\n".format(uttId, " ".join(words)))
+
+
+
+
+
+def _wordAlignOptions(config, phoneSymbols):
+  """
+  Returns the options of Kaldi's lattice-word-align giving the word
+  boundary class of each phone in the SymbolTable *phoneSymbols*.
+  """
+  internals = []
+  begins = []
+  ends = []
+  singletons = []
+  silences = []
+  for (phoneInt, phone) in phoneSymbols.iteritems():
+    phoneInt = str(phoneInt)
+    if phone == config.EPS or phone.startswith("#"):
+      continue
+
+    if (phone in (config.SIL_PHONE,
+      config.SPN_PHONE, config.NSN_PHONE)):
+      silences.append(phoneInt)
+    elif phone.endswith("_S"):
+      singletons.append(phoneInt)
+    elif phone.endswith("_B"):
+      begins.append(phoneInt)
+    elif phone.endswith("_E"):
+      ends.append(phoneInt)
+    else:
+      internals.append(phoneInt)
+
+  return "--silence-phones={0} --wbegin-phones={1} --wend-phones={2} \
+    --winternal-phones={3} --wbegin-and-end-phones={4}".format(
+    ":".join(silences), ":".join(begins), ":".join(ends),
+    ":".join(internals), ":".join(singletons))
+
+
+
+
+def _latticeOutputs(config, logFile, out, numHypotheses, mdlfile,
+  lexfstalign, acousticscale, mbrdecode, phoneSymbols, wordSymbols,
+  wordLeftSym, wordRightSym):
+  """
+  Writes the *numHypotheses* best hypotheses of the lattices in the
+  file named by out.latfile to the files named by the members of
+  *out*, with their word and phone lengths if *lexfstalign* is given
+  and the Minimum Bayes Risk outputs if *mbrdecode* is True.
+  """
+  tmp = NamedTemporaryFile(suffix=".ark", delete=False)
+  alignFile = tmp.name
+  tmp.close()
+
+  try:
+    decodeCmd = "{0} --acoustic-scale={1} --n={2} \"ark,t:{3}\" ark:- | \
+      {4} ark,t:- \"ark:{5}\" ark,t:-".format(config.latticetonbest, acousticscale,
+        numHypotheses, out.latfile, config.nbesttolinear, alignFile)
+
+    # decode hypothesis transcripts and translate to text
+    _writeHyps(config, _outputLines(decodeCmd, logFile), out, wordSymbols)
+
+
+
+    # if alignment symbols were given, compute word and phone lengths
+    if lexfstalign:
+      _align(config, logFile, mdlfile, out.intfilename, lexfstalign,
+        alignFile, out.intphonelens, out.phonelens, out.intwordlens,
+        out.wordlens, phoneSymbols, wordSymbols, wordLeftSym, wordRightSym)
+
+
+
+    if mbrdecode:
+      decodeCmd = "{0} --acoustic-scale={1} \"ark,t:{2}\" \"ark,t:{3}\" \
+        \"ark,t:{4}\" \"ark,t:{5}\" \"ark,t:{6}\"".format(config.latticembrdecode, acousticscale,
+          out.latfile, out.intmbr, out.risk, out.stats, out.mbrtimes)
+
+      # decode hypothesis transcripts and translate to text
+      decodeProc = _popen(decodeCmd, stderr=logFile)
+      decodeProc.communicate()
+      retCode = decodeProc.poll()
+      if retCode:
+        raise KaldiError(logFile.name)
+
+      with open(out.intmbr, "r") as mbrIntIn:
+        with open(out.mbr, "w") as mbrOut:
+          for line in mbrIntIn:
+            parts = split(line)
+            if parts:
+              words = wordSymbols.symbols(parts[1:], config.DECODE_OOV_WORD)
+              mbrOut.write("{0} {1}\n".format(parts[0], " ".join(words)))
+
+  finally:
+    remove(alignFile)
+
+
+
+
+
+@_singleFlight
 def decodeNbestFeats(directory, config, numHypotheses, featsfile, graphfile,
   wordsfile, lexiconfile, mdlfile, treefile, phonesfilealign, lexfstalign, beam,
-  allowpartial, acousticscale, mbrdecode):
+  allowpartial, acousticscale, mbrdecode, featsscp=None, numjobs=1):
 
   hypdir = path.join(directory, "nbest-hypotheses")
-  (hypCollection, idxFile) = _getCachedObject(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
+  (hypCollection, idxFile) = _getCachedObject(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems() if k not in ("featsscp", "numjobs")]))
   
 
-  # check file modification times to see if refresh is required
-  refreshRequired = False
-  try:
-    if int(path.getmtime(featsfile)) > hypCollection.featsfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(graphfile)) > hypCollection.graphfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(wordsfile)) > hypCollection.wordsfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(lexiconfile)) > hypCollection.lexiconfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(mdlfile)) > hypCollection.mdlfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(treefile)) > hypCollection.treefile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-
+  # check input files to see if refresh is required
+  inputs = [("featsfile_time", featsfile), ("graphfile_time", graphfile),
+    ("wordsfile_time", wordsfile), ("lexiconfile_time", lexiconfile),
+    ("mdlfile_time", mdlfile), ("treefile_time", treefile)]
   if phonesfilealign and lexfstalign:
-    try:
-      if int(path.getmtime(phonesfilealign)) > hypCollection.phonesfilealign_time:
-        refreshRequired = True
-    except AttributeError:
-      refreshRequired = True
-    try:
-      if int(path.getmtime(lexfstalign)) > hypCollection.lexfstalign_time:
-        refreshRequired = True
-    except AttributeError:
-      refreshRequired = True
+    inputs.append(("phonesfilealign_time", phonesfilealign))
+    inputs.append(("lexfstalign_time", lexfstalign))
 
-  if not refreshRequired:
+  if not _inputsChanged(hypCollection, idxFile, inputs, config):
     return hypCollection
 
 
@@ -190,17 +417,18 @@ def decodeNbestFeats(directory, config, numHypotheses, featsfile, graphfile,
     remove(hypCollection.intphonelens)
   except (OSError, AttributeError):
     pass
+  try:
+    remove(hypCollection.latfile)
+  except (OSError, AttributeError):
+    pass
+  for attr in ("intmbr", "mbr", "stats", "mbrtimes", "risk"):
+    try:
+      remove(getattr(hypCollection, attr))
+    except (OSError, AttributeError):
+      pass
 
 
-  hypCollection.featsfile_time = int(path.getmtime(featsfile))
-  hypCollection.graphfile_time = int(path.getmtime(graphfile))
-  hypCollection.wordsfile_time = int(path.getmtime(wordsfile))
-  hypCollection.lexiconfile_time = int(path.getmtime(lexiconfile))
-  hypCollection.mdlfile_time = int(path.getmtime(mdlfile))
-  hypCollection.treefile_time = int(path.getmtime(treefile))
-  if phonesfilealign and lexfstalign:
-    hypCollection.phonesfilealign_time = int(path.getmtime(phonesfilealign))
-    hypCollection.lexfstalign_time = int(path.getmtime(lexfstalign))
+  _stampInputs(hypCollection, inputs, config)
   
   
 
@@ -222,133 +450,159 @@ def decodeNbestFeats(directory, config, numHypotheses, featsfile, graphfile,
 
 
 
-  logFile = open(path.join(hypdir, _randFilename(suffix=".log")), "w")
+  # read word/phone symbol tables
+  wordSymbols = table.getSymbolTable(wordsfile)
+  phoneSymbols = table.getSymbolTable(phonesfilealign)
+  wordLeftSym = str(phoneSymbols.requiredId(config.WORD_BOUND_L))
+  wordRightSym = str(phoneSymbols.requiredId(config.WORD_BOUND_R))
+
+
+
+  # phone boundaries for word aligning the lattice
+  wordAlignOpts = _wordAlignOptions(config, phoneSymbols)
+
+
+
+  def decodeShard(featsSpec, out):
+    logFile = open(path.join(hypdir, _randFilename(suffix=".log")), "w")
 
+    try:
+      # prepare lattice generator command
+      latgenCmd = "{0} --beam={1} --allow-partial=true \
+        --acoustic-scale={3} {4} {5} \"{6}\" ark:- | \
+        {7} {8} \"{4}\" ark:- \"ark,t:{9}\"".format(config.gmmlatgen,
+        beam, str(allowpartial).lower(), acousticscale, mdlfile,
+        graphfile, featsSpec, config.latticewordalign, wordAlignOpts,
+        out.latfile)
+
+
+
+      latgenProc = _popen(latgenCmd, stderr=logFile)
+      latgenProc.communicate()
+      retCode = latgenProc.poll()
+
+      _latticeOutputs(config, logFile, out, numHypotheses, mdlfile,
+        lexfstalign, acousticscale, mbrdecode, phoneSymbols, wordSymbols,
+        wordLeftSym, wordRightSym)
+
+    finally:
+      logFile.close()
+
+
+
+  # decode shards of the features concurrently and merge their outputs
+  tmpFiles = []
   try:
-    # read word/phone symbol tables
-    wordSymbols = {}
-    with open(wordsfile, "r") as symTableIn:
-      for line in symTableIn:
-        parts = split(line)
-        wordSymbols[parts[1]] = parts[0]
+    featsSpecs = _featShards(config, hypdir, featsfile, featsscp, numjobs, tmpFiles)
+    outs = _shardOutputs(hypCollection, len(featsSpecs), tmpFiles)
+    _runConcurrently(decodeShard, zip(featsSpecs, outs))
+    _mergeOutputs(hypCollection, outs)
+  finally:
+    for tmpFile in tmpFiles:
+      try:
+        remove(tmpFile)
+      except OSError:
+        pass
 
-    phoneSymbols = {}
-    with open(phonesfilealign, "r") as symTableIn:
-      for line in symTableIn:
-        parts = split(line)
-        phoneSymbols[parts[1]] = parts[0]
-        if parts[0] == config.WORD_BOUND_L:
-          wordLeftSym = parts[1]
-        elif parts[0] == config.WORD_BOUND_R:
-          wordRightSym = parts[1]
-
-
-
-    # write phone boundaries file for word aligning the lattice
-    internals = []
-    begins = []
-    ends = []
-    singletons = []
-    silences = []
-    for phoneInt in sorted(phoneSymbols.keys()):
-      if phoneSymbols[phoneInt] == config.EPS or phoneSymbols[phoneInt].startswith("#"):
-        continue
 
-      if (phoneSymbols[phoneInt] in (config.SIL_PHONE,
-        config.SPN_PHONE, config.NSN_PHONE)):
-        silences.append(phoneInt)
-      elif phoneSymbols[phoneInt].endswith("_S"):
-        singletons.append(phoneInt)
-      elif phoneSymbols[phoneInt].endswith("_B"):
-        begins.append(phoneInt)
-      elif phoneSymbols[phoneInt].endswith("_E"):
-        ends.append(phoneInt)
-      else:
-        internals.append(phoneInt)
+  return _cacheObject(hypCollection, idxFile)
 
 
 
-    # prepare lattice generator command
-    latgenCmd = "{0} --beam={1} --allow-partial=true \
-      --acoustic-scale={3} {4} {5} \"ark:{6}\" ark:- | \
-      {7} --silence-phones={8} --wbegin-phones={9} \
-      --wend-phones={10} --winternal-phones={11} --wbegin-and-end-phones={12} \
-      \"{4}\" ark:- \"ark,t:{13}\"".format(config.gmmlatgen,
-      beam, str(allowpartial).lower(), acousticscale, mdlfile,
-      graphfile, featsfile, config.latticewordalign, ":".join(silences), ":".join(begins),
-      ":".join(ends), ":".join(internals), ":".join(singletons), hypCollection.latfile)
 
 
 
-    latgenProc = Popen(latgenCmd, stderr=logFile, shell=True)
-    latgenProc.communicate()
-    retCode = latgenProc.poll()
+@_singleFlight
+def rescoreNbestLattices(directory, config, numHypotheses, latfile,
+  smallgraphfile, biggraphfile, wordsfile, mdlfile, phonesfilealign,
+  lexfstalign, acousticscale, mbrdecode):
+  """
+  Rescores the lattices in *latfile*, as written by decodeNbestFeats,
+  replacing the scores of the grammar *smallgraphfile* they were
+  decoded with by those of the grammar *biggraphfile*. Writes the
+  rescored lattices and their *numHypotheses* best hypotheses, word
+  and phone lengths if alignment symbols are given, and Minimum Bayes
+  Risk outputs if *mbrdecode* is True, as decodeNbestFeats does.
+  """
+  hypdir = path.join(directory, "rescored-hypotheses")
+  (hypCollection, idxFile) = _getCachedObject(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
 
-    tmp = NamedTemporaryFile(suffix=".ark", delete=False)
-    alignFile = tmp.name
-    tmp.close()
 
-    decodeCmd = "{0} --acoustic-scale={1} --n={2} \"ark,t:{3}\" ark:- | \
-      {4} ark,t:- \"ark:{5}\" ark,t:-".format(config.latticetonbest, acousticscale,
-        numHypotheses, hypCollection.latfile, config.nbesttolinear, alignFile)
+  # check input files to see if refresh is required
+  inputs = [("latfile_time", latfile), ("smallgraphfile_time", smallgraphfile),
+    ("biggraphfile_time", biggraphfile), ("wordsfile_time", wordsfile),
+    ("mdlfile_time", mdlfile)]
+  if phonesfilealign and lexfstalign:
+    inputs.append(("phonesfilealign_time", phonesfilealign))
+    inputs.append(("lexfstalign_time", lexfstalign))
 
-    # decode hypothesis transcripts and translate to text
-    decodedFile = NamedTemporaryFile(mode="w+", suffix=".txt")
-    decodeProc = Popen(decodeCmd, stdout=decodedFile, stderr=logFile, shell=True)
-    decodeProc.communicate()
-    retCode = decodeProc.poll()
-    if retCode:
-      raise KaldiError(logFile.name)
+  if not _inputsChanged(hypCollection, idxFile, inputs, config):
+    return hypCollection
 
-    decodedFile.seek(0)
-    
-    with open(hypCollection.intfilename, "w") as hypIntOut:
-      with open(hypCollection.filename, "w") as hypOut:
-        for line in decodedFile:
-          parts = split(line)
-          uttId = parts[0]
-          words = parts[1:]
-          for i in range(len(words)):
-            try:
-              words[i] = wordSymbols[words[i]]
-            except KeyError:
-              words[i] = config.DECODE_OOV_WORD
-          hypIntOut.write(line)
-          hypOut.write("{0} {1}\n".format(uttId, " ".join(words)))
-    decodedFile.close()
-    
 
+  # remove old files
+  for attr in _HYP_FILES:
+    try:
+      remove(getattr(hypCollection, attr))
+    except (OSError, AttributeError):
+      pass
 
-    # if alignment symbols were given, compute word and phone lengths
-    if phonesfilealign and lexfstalign:
-      _align(config, logFile, mdlfile, hypCollection.intfilename, lexfstalign,
-        alignFile, hypCollection.intphonelens, hypCollection.phonelens, hypCollection.intwordlens,
-        hypCollection.wordlens, phoneSymbols, wordSymbols, wordLeftSym, wordRightSym)
+  _stampInputs(hypCollection, inputs, config)
 
 
+  _nameHyps(hypCollection, hypdir, phonesfilealign and lexfstalign)
+  hypCollection.latfile = path.join(hypdir, _randFilename("lat-", ".ark"))
+  if mbrdecode:
+    hypCollection.intmbr = path.join(hypdir, _randFilename("mbr-", ".int"))
+    hypCollection.mbr = path.join(hypdir, _randFilename("mbr-", ".txt"))
+    hypCollection.stats = path.join(hypdir, _randFilename("sausagestats-", ".ark"))
+    hypCollection.mbrtimes = path.join(hypdir, _randFilename("mbrtimes-", ".ark"))
+    hypCollection.risk = path.join(hypdir, _randFilename("risk-", ".ark"))
 
-    if mbrdecode:
-      decodeCmd = "{0} --acoustic-scale={1} \"ark,t:{2}\" \"ark,t:{3}\" \
-        \"ark,t:{4}\" \"ark,t:{5}\" \"ark,t:{6}\"".format(config.latticembrdecode, acousticscale,
-          hypCollection.latfile, hypCollection.intmbr, hypCollection.risk, hypCollection.stats,
-          hypCollection.mbrtimes)
 
-      # decode hypothesis transcripts and translate to text
-      decodeProc = Popen(decodeCmd, stderr=logFile, shell=True)
-      decodeProc.communicate()
-      retCode = decodeProc.poll()
-      if retCode:
-        raise KaldiError(logFile.name)
+  # read word/phone symbol tables
+  wordSymbols = table.getSymbolTable(wordsfile)
+  phoneSymbols = None
+  wordLeftSym = None
+  wordRightSym = None
+  if phonesfilealign and lexfstalign:
+    phoneSymbols = table.getSymbolTable(phonesfilealign)
+    wordLeftSym = str(phoneSymbols.requiredId(config.WORD_BOUND_L))
+    wordRightSym = str(phoneSymbols.requiredId(config.WORD_BOUND_R))
 
 
+  # subtract the small grammar's scores and add the big grammar's,
+  # using their output labels so disambiguation symbols match nothing
+  rescoreCmd = "{0} --lm-scale=-1.0 \"ark,t:{1}\" \
+    \"{2} --project_output=true {3} |\" ark:- | \
+    {0} --lm-scale=1.0 ark:- \"{2} --project_output=true {4} |\"".format(
+    config.latticelmrescore, latfile, config.fstproject, smallgraphfile,
+    biggraphfile)
 
+  # word align the rescored lattices again if alignment symbols were given
+  if phoneSymbols is not None:
+    rescoreCmd = "{0} ark:- | {1} {2} \"{3}\" ark:- \"ark,t:{4}\"".format(
+      rescoreCmd, config.latticewordalign,
+      _wordAlignOptions(config, phoneSymbols), mdlfile, hypCollection.latfile)
+  else:
+    rescoreCmd = "{0} \"ark,t:{1}\"".format(rescoreCmd, hypCollection.latfile)
 
 
+  logFile = open(path.join(hypdir, _randFilename(suffix=".log")), "w")
+  try:
+    rescoreProc = _popen(rescoreCmd, stderr=logFile)
+    rescoreProc.communicate()
+    retCode = rescoreProc.poll()
+    if retCode:
+      raise KaldiError(logFile.name)
+
+    _latticeOutputs(config, logFile, hypCollection, numHypotheses, mdlfile,
+      lexfstalign if phoneSymbols is not None else None, acousticscale,
+      mbrdecode, phoneSymbols, wordSymbols, wordLeftSym, wordRightSym)
+
   finally:
     logFile.close()
 
-  remove(alignFile)
-
 
   return _cacheObject(hypCollection, idxFile)
 
@@ -358,236 +612,674 @@ def decodeNbestFeats(directory, config, numHypotheses, featsfile, graphfile,
 
 
 
-def decodeFeats(directory, config, featsfile, graphfile, wordsfile, mdlfile,
-  treefile, phonesfilealign, lexfstalign, beam, allowpartial,
-  acousticscale, numHypotheses=1):
+def _nameHyps(hyp, hypdir, align):
+  """
+  Sets the members of *hyp* naming new hypothesis files in *hypdir*,
+  and word and phone length files if *align* is True.
+  """
+  hyp.filename = path.join(hypdir, _randFilename("hyp-", ".txt"))
+  hyp.intfilename = path.join(hypdir, _randFilename("hyp-", ".int"))
+  if align:
+    hyp.wordlens = path.join(hypdir, _randFilename("wordlens-", ".txt"))
+    hyp.intwordlens = path.join(hypdir, _randFilename("wordlens-", ".int"))
+    hyp.phonelens = path.join(hypdir, _randFilename("phonelens-", ".txt"))
+    hyp.intphonelens = path.join(hypdir, _randFilename("phonelens-", ".int"))
 
-  hypdir = path.join(directory, "hypotheses")
-  (hyp, idxFile) = _getCachedObject(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
-  
 
-  # check file modification times to see if refresh is required
-  refreshRequired = False
-  try:
-    if int(path.getmtime(featsfile)) > hyp.featsfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(graphfile)) > hyp.graphfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(wordsfile)) > hyp.wordsfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(mdlfile)) > hyp.mdlfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(treefile)) > hyp.treefile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
 
+
+def _mergeHyps(hyp, decoded, oldFiles, utts, changed):
+  """
+  Writes the output files of *hyp* with the lines of the utterances
+  in *utts*, in order. Lines of utterances in the set *changed* are
+  taken from the output files of *decoded*, or None if nothing was
+  decoded, and the others from the old output files *oldFiles*, a
+  dictionary mapping each member of *hyp* to its previous file.
+  """
+  for attr in _HYP_FILES:
+    if attr not in hyp.__dict__:
+      continue
+
+    lines = {}
+    sources = [(oldFiles.get(attr), False)]
+    if decoded is not None:
+      sources.append((getattr(decoded, attr), True))
+    for (fname, isDecoded) in sources:
+      with open(fname, "r") as fin:
+        for line in fin:
+          if strip(line):
+            utt = split(line, None, 1)[0]
+            if (utt in changed) == isDecoded:
+              lines[utt] = line
+
+    with open(getattr(hyp, attr), "w") as fout:
+      for utt in utts:
+        if utt in lines:
+          fout.write(lines[utt])
+
+
+
+
+def _decode(config, hyp, hypdir, featsSpecs, graphfile, wordsfile, mdlfile,
+  phonesfilealign, lexfstalign, beam, allowpartial, acousticscale):
+  """
+  Decodes the features read by the Kaldi rspecifiers in *featsSpecs*
+  concurrently and merges the hypotheses, and word and phone lengths
+  if alignment symbols are given, into new files in *hypdir* named
+  by the members of *hyp*.
+  """
+  _nameHyps(hyp, hypdir, phonesfilealign and lexfstalign)
+
+
+  # read word/phone symbol tables
+  wordSymbols = table.getSymbolTable(wordsfile)
+  phoneSymbols = None
   if phonesfilealign and lexfstalign:
+    phoneSymbols = table.getSymbolTable(phonesfilealign)
+    wordLeftSym = str(phoneSymbols.requiredId(config.WORD_BOUND_L))
+    wordRightSym = str(phoneSymbols.requiredId(config.WORD_BOUND_R))
+
+
+
+  def decodeShard(featsSpec, out):
+    # prepare decode command
+    tmp = NamedTemporaryFile(suffix=".ark", delete=False)
+    alignFile = tmp.name
+    tmp.close()
+
+    decodeCmd = "{0} --beam={1} --allow-partial={2} --acoustic-scale={3} \
+      {4} {5} \"{6}\" \"ark,t:-\" \"ark:{7}\"".format(config.gmmdecode,
+      beam, str(allowpartial).lower(), acousticscale, mdlfile,
+      graphfile, featsSpec, alignFile)
+
+
+    logFile = open(path.join(hypdir, _randFilename(suffix=".log")), "w")
+
     try:
-      if int(path.getmtime(phonesfilealign)) > hyp.phonesfilealign_time:
-        refreshRequired = True
-    except AttributeError:
-      refreshRequired = True
-    try:
-      if int(path.getmtime(lexfstalign)) > hyp.lexfstalign_time:
-        refreshRequired = True
-    except AttributeError:
-      refreshRequired = True
+      # decode hypothesis transcripts and translate to text
+      _writeHyps(config, _outputLines(decodeCmd, logFile), out, wordSymbols)
+      
 
-  if not refreshRequired:
-    return hyp
 
+      # if alignment symbols were given, compute word and phone lengths
+      if phonesfilealign and lexfstalign:
+        _align(config, logFile, mdlfile, out.intfilename, lexfstalign,
+          alignFile, out.intphonelens, out.phonelens, out.intwordlens,
+          out.wordlens, phoneSymbols, wordSymbols, wordLeftSym, wordRightSym)
 
-  # remove old files
-  try:
-    remove(hyp.filename)
-  except (OSError, AttributeError):
-    pass
-  try:
-    remove(hyp.intfilename)
-  except (OSError, AttributeError):
-    pass
-  try:
-    remove(hyp.wordlens)
-  except (OSError, AttributeError):
-    pass
+
+    finally:
+      logFile.close()
+      remove(alignFile)
+
+
+
+  # decode the shards concurrently and merge their outputs
+  tmpFiles = []
   try:
-    remove(hyp.intwordlens)
-  except (OSError, AttributeError):
-    pass
+    outs = _shardOutputs(hyp, len(featsSpecs), tmpFiles)
+    _runConcurrently(decodeShard, zip(featsSpecs, outs))
+    _mergeOutputs(hyp, outs)
+  finally:
+    for tmpFile in tmpFiles:
+      try:
+        remove(tmpFile)
+      except OSError:
+        pass
+
+
+
+
+
+def _retryFailed(config, hypdir, results, failed, featsfile, graphfile,
+  wordsfile, mdlfile, beam, allowpartial, acousticscale):
+  """
+  Decodes the utterances in *failed*, which a persistent decoder did
+  not output, once more with a new decoder as unpooled decoding does,
+  and returns the result lines of *results* and of those decoded, in
+  the order of the archive *featsfile*. All of the archive is decoded
+  again if it cannot be parsed.
+  """
+  tmpFiles = []
+  retried = KaldiObject()
   try:
-    remove(hyp.phonelens)
-  except (OSError, AttributeError):
-    pass
+    failed = set(failed)
+    try:
+      entries = list(table.scanArchive(featsfile))
+    except ValueError:
+      entries = None
+
+    if entries is None:
+      featsSpec = "ark:{0}".format(featsfile)
+      results = []
+    else:
+      scpfile = _tmpFilename(".scp", tmpFiles)
+      featsSpec = "scp:{0}".format(scpfile)
+      with open(scpfile, "w") as scpOut:
+        for (utt, offset, size) in entries:
+          if utt in failed:
+            scpOut.write("{0} {1}:{2}\n".format(utt, featsfile, offset))
+
+    _decode(config, retried, hypdir, [featsSpec], graphfile, wordsfile,
+      mdlfile, None, None, beam, allowpartial, acousticscale)
+
+    utts = [utt for (utt, offset, size) in entries or []]
+    lines = dict([(split(line, None, 1)[0], line) for line in results])
+    with open(retried.intfilename, "r") as hypIn:
+      for line in hypIn:
+        if strip(line):
+          utt = split(line, None, 1)[0]
+          lines[utt] = line
+          if entries is None:
+            utts.append(utt)
+  finally:
+    _removeFiles(tmpFiles + [retried.__dict__.get(attr) for attr in _HYP_FILES])
+
+  return [lines[utt] for utt in utts if utt in lines]
+
+
+
+
+def _latestFile(hypdir, params):
+  """
+  Returns the file in *hypdir* naming the latest hypotheses decoded
+  with *params*, the cache key of decodeFeats without the features.
+  """
+  return path.join(hypdir, "latest-{0}.txt".format(sha1(params).hexdigest()))
+
+
+
+
+def _readLatest(latestFile, inputs, config):
+  """
+  Returns the dictionary of the hypothesis files and manifest named
+  by *latestFile*, or None if it names none, any of them is missing
+  or any of the files in *inputs*, (attribute, filename) pairs as for
+  _inputsChanged, changed since they were decoded.
+  """
   try:
-    remove(hyp.intphonelens)
-  except (OSError, AttributeError):
-    pass
+    with open(latestFile, "r") as latestIn:
+      latest = literal_eval(latestIn.read())
+  except (IOError, SyntaxError, ValueError):
+    return None
 
+  for (attr, fname) in inputs:
+    if attr not in latest or _fileChanged(fname, latest[attr], config)[0]:
+      return None
+  files = dict([(attr, latest[attr]) for attr in _HYP_FILES + ("manifest",)
+    if attr in latest])
+  if "manifest" not in files or [f for f in files.itervalues()
+    if not path.isfile(f)]:
+    return None
+  return files
 
-  hyp.featsfile_time = int(path.getmtime(featsfile))
-  hyp.graphfile_time = int(path.getmtime(graphfile))
-  hyp.wordsfile_time = int(path.getmtime(wordsfile))
-  hyp.mdlfile_time = int(path.getmtime(mdlfile))
-  hyp.treefile_time = int(path.getmtime(treefile))
-  if phonesfilealign and lexfstalign:
-    hyp.phonesfilealign_time = int(path.getmtime(phonesfilealign))
-    hyp.lexfstalign_time = int(path.getmtime(lexfstalign))
-  
+
+
+
+def _writeLatest(hyp, latestFile, inputs):
+  """
+  Makes *latestFile* name the hypothesis files and manifest of *hyp*
+  and the stamps of the files in *inputs*, as read by _readLatest.
+  """
+  attrs = _HYP_FILES + ("manifest",) + tuple([attr for (attr, fname)
+    in inputs])
+  latest = dict([(attr, hyp.__dict__[attr]) for attr in attrs
+    if attr in hyp.__dict__])
+  tmpFile = path.join(path.dirname(latestFile), _randFilename(".", ".tmp"))
+  with open(tmpFile, "w") as latestOut:
+    latestOut.write(str(latest))
+  rename(tmpFile, latestFile)
+
+
+
+
+@_singleFlight
+def decodeFeats(directory, config, featsfile, graphfile, wordsfile, mdlfile,
+  treefile, phonesfilealign, lexfstalign, beam, allowpartial,
+  acousticscale, numHypotheses=1, featsscp=None, numjobs=1, pooled=False):
+
+  # pooled decoding outputs the same hypotheses, so is not in the key
+  hypdir = path.join(directory, "hypotheses")
+  latestFile = _latestFile(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems() if k not in ("featsfile", "featsscp", "numjobs", "pooled")]))
+  (hyp, idxFile) = _getCachedObject(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems() if k not in ("featsscp", "numjobs", "pooled", "latestFile")]))
   
 
-  hyp.filename = path.join(hypdir, _randFilename("hyp-", ".txt"))
-  hyp.intfilename = path.join(hypdir, _randFilename("hyp-", ".int"))
+  # check input files to see if refresh is required
+  inputs = [("featsfile_time", featsfile), ("graphfile_time", graphfile),
+    ("wordsfile_time", wordsfile), ("mdlfile_time", mdlfile),
+    ("treefile_time", treefile)]
   if phonesfilealign and lexfstalign:
-    hyp.wordlens = path.join(hypdir, _randFilename("wordlens-", ".txt"))
-    hyp.intwordlens = path.join(hypdir, _randFilename("wordlens-", ".int"))
-    hyp.phonelens = path.join(hypdir, _randFilename("phonelens-", ".txt"))
-    hyp.intphonelens = path.join(hypdir, _randFilename("phonelens-", ".int"))
+    inputs.append(("phonesfilealign_time", phonesfilealign))
+    inputs.append(("lexfstalign_time", lexfstalign))
 
+  if not _inputsChanged(hyp, idxFile, inputs, config):
+    return hyp
 
-  # prepare decode command
-  tmp = NamedTemporaryFile(suffix=".ark", delete=False)
-  alignFile = tmp.name
-  tmp.close()
 
-  decodeCmd = "{0} --beam={1} --allow-partial={2} --acoustic-scale={3} \
-    {4} {5} \"ark:{6}\" \"ark,t:-\" \"ark:{7}\"".format(config.gmmdecode,
-    beam, str(allowpartial).lower(), acousticscale, mdlfile,
-    graphfile, featsfile, alignFile)
+  # the hypotheses of unchanged utterances are reused if only the
+  # features changed, otherwise all old files are removed
+  oldFiles = dict([(attr, hyp.__dict__[attr]) for attr
+    in _HYP_FILES + ("manifest",) if attr in hyp.__dict__])
+  oldManifest = None
+  if (not pooled and "manifest" in oldFiles
+    and not [f for f in oldFiles.itervalues() if not path.isfile(f)]
+    and not _inputsChanged(hyp, idxFile, inputs[1:], config)):
+    oldManifest = dict(_readTable(oldFiles["manifest"]))
+  if oldManifest is None:
+    _removeFiles(oldFiles.values())
+  staleFiles = oldFiles.values()
+
+  # new feature archives, such as those of refreshed features, reuse
+  # the latest hypotheses decoded with the same graph, model and
+  # options, whose files belong to another cached object
+  if oldManifest is None and not pooled:
+    oldFiles = _readLatest(latestFile, inputs[1:], config)
+    if oldFiles is not None:
+      oldManifest = dict(_readTable(oldFiles["manifest"]))
+    staleFiles = []
+
+
+  _stampInputs(hyp, inputs, config)
+  
+  
 
+  # decode with a persistent decoder, which computes no alignments
+  if pooled:
+    hyp.__dict__.pop("manifest", None)
+    hyp.__dict__.pop("latest", None)
+    hyp.filename = path.join(hypdir, _randFilename("hyp-", ".txt"))
+    hyp.intfilename = path.join(hypdir, _randFilename("hyp-", ".int"))
+
+    wordSymbols = table.getSymbolTable(wordsfile)
+    decoderPool = pool.getPool(config, hypdir, graphfile, mdlfile, beam,
+      allowpartial, acousticscale)
+    (results, failed) = decoderPool.decode(featsfile)
+    if failed:
+      results = _retryFailed(config, hypdir, results, failed, featsfile,
+        graphfile, wordsfile, mdlfile, beam, allowpartial, acousticscale)
+    _writeHyps(config, results, hyp, wordSymbols)
+    return _cacheObject(hyp, idxFile)
+
+
+  # fingerprint the features of each utterance to find those changed,
+  # decoding all of them if the archive cannot be parsed
+  hyp.__dict__.pop("manifest", None)
+  hyp.__dict__.pop("latest", None)
+  try:
+    manifest = list(table.fingerprints(featsfile))
+  except ValueError:
+    manifest = None
+  if manifest is not None:
+    hyp.manifest = path.join(hypdir, _randFilename("manifest-", ".txt"))
+    with open(hyp.manifest, "w") as manifestOut:
+      for (utt, offset, digest) in manifest:
+        manifestOut.write("{0} {1}\n".format(utt, digest))
+
+  changed = None
+  if oldManifest is not None and manifest is None:
+    _removeFiles(staleFiles)
+  elif oldManifest is not None:
+    changed = set([utt for (utt, offset, digest) in manifest
+      if oldManifest.get(utt) != digest])
+    if len(changed) == len(manifest):
+      _removeFiles(staleFiles)
+      changed = None
+
+
+  # decode shards of the features, or of the changed utterances only
+  # and merge their hypotheses with the old ones
+  tmpFiles = []
+  try:
+    if changed is None:
+      featsSpecs = _featShards(config, hypdir, featsfile, featsscp, numjobs, tmpFiles)
+      _decode(config, hyp, hypdir, featsSpecs, graphfile, wordsfile, mdlfile,
+        phonesfilealign, lexfstalign, beam, allowpartial, acousticscale)
+    else:
+      decoded = None
+      if changed:
+        changedscp = _tmpFilename(".scp", tmpFiles)
+        with open(changedscp, "w") as scpOut:
+          for (utt, offset, digest) in manifest:
+            if utt in changed:
+              scpOut.write("{0} {1}:{2}\n".format(utt, featsfile, offset))
+        if numjobs > 1:
+          featsSpecs = _featShards(config, hypdir, featsfile, changedscp,
+            numjobs, tmpFiles)
+        else:
+          featsSpecs = ["scp:{0}".format(changedscp)]
+
+        decoded = KaldiObject()
+        _decode(config, decoded, hypdir, featsSpecs, graphfile, wordsfile,
+          mdlfile, phonesfilealign, lexfstalign, beam, allowpartial,
+          acousticscale)
+        tmpFiles.extend([getattr(decoded, attr) for attr in _HYP_FILES
+          if attr in decoded.__dict__])
+
+      _nameHyps(hyp, hypdir, phonesfilealign and lexfstalign)
+      _mergeHyps(hyp, decoded, oldFiles,
+        [utt for (utt, offset, digest) in manifest], changed)
+      _removeFiles(staleFiles)
+  finally:
+    for tmpFile in tmpFiles:
+      try:
+        remove(tmpFile)
+      except OSError:
+        pass
+
+  if manifest is not None:
+    hyp.latest = latestFile
+    _writeLatest(hyp, latestFile, inputs[1:])
+  return _cacheObject(hyp, idxFile)
 
-  logFile = open(path.join(hypdir, _randFilename(suffix=".log")), "w")
 
-  try:
-    # read word/phone symbol tables
-    wordSymbols = {}
-    with open(wordsfile, "r") as symTableIn:
-      for line in symTableIn:
-        parts = split(line)
-        wordSymbols[parts[1]] = parts[0]
 
-    phoneSymbols = {}
-    with open(phonesfilealign, "r") as symTableIn:
-      for line in symTableIn:
-        parts = split(line)
-        phoneSymbols[parts[1]] = parts[0]
-        if parts[0] == config.WORD_BOUND_L:
-          wordLeftSym = parts[1]
-        elif parts[0] == config.WORD_BOUND_R:
-          wordRightSym = parts[1]
 
 
-    # decode hypothesis transcripts and translate to text
-    decodedFile = NamedTemporaryFile(mode="w+", suffix=".txt")
-    decodeProc = Popen(decodeCmd, stdout=decodedFile, stderr=logFile, shell=True)
-    decodeProc.communicate()
-    retCode = decodeProc.poll()
-    if retCode:
-      raise KaldiError(logFile.name)
+@_singleFlight
+def decodeAudio(directory, config, wavscp, segmentsfile, samplefreq,
+  useenergy, framelength, frameshift, numceps, applycmvn, normvars,
+  utt2spk, spk2utt, deltaorder, graphfile, wordsfile, mdlfile, treefile,
+  phonesfilealign, lexfstalign, beam, allowpartial, acousticscale,
+  cache=True):
 
-    decodedFile.seek(0)
-    
-    with open(hyp.intfilename, "w") as hypIntOut:
-      with open(hyp.filename, "w") as hypOut:
-        for line in decodedFile:
-          parts = split(line)
-          uttId = parts[0]
-          words = parts[1:]
-          for i in range(len(words)):
-            try:
-              words[i] = wordSymbols[words[i]]
-            except KeyError:
-              words[i] = config.DECODE_OOV_WORD
-          hypIntOut.write(line)
-          hypOut.write("{0} {1}\n".format(uttId, " ".join(words)))
-    decodedFile.close()
+  hypdir = path.join(directory, "audio_hypotheses")
+  if not cache:
+    # results are not indexed, so they are swept as orphans later
+    try:
+      makedirs(hypdir)
+    except OSError:
+      pass
+    hyp = KaldiObject()
+
+  else:
+    (hyp, idxFile) = _getCachedObject(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems() if k != "cache"]))
     
+    # check input files to see if refresh is required
+    inputs = [("wavscp_time", wavscp), ("graphfile_time", graphfile),
+      ("wordsfile_time", wordsfile), ("mdlfile_time", mdlfile),
+      ("treefile_time", treefile)]
+    for (name, fname) in (("segmentsfile_time", segmentsfile),
+      ("utt2spk_time", utt2spk), ("spk2utt_time", spk2utt),
+      ("phonesfilealign_time", phonesfilealign),
+      ("lexfstalign_time", lexfstalign)):
+      if fname:
+        inputs.append((name, fname))
+
+    wavsOld = _wavsChanged(hyp, idxFile, config)
+    if not _inputsChanged(hyp, idxFile, inputs, config) and not wavsOld:
+      return hyp
+
+
+    # remove old files
+    for attr in _HYP_FILES:
+      try:
+        remove(getattr(hyp, attr))
+      except (OSError, AttributeError):
+        pass
+
+    _stampInputs(hyp, inputs, config)
+    hyp.wav_times = _wavStamps(wavscp, config)
+
+
+  # decode features piped from their computation
+  if not (utt2spk and spk2utt):
+    utt2spk = None
+    spk2utt = None
+
+  featsSpec = _featsPipe(config, wavscp, segmentsfile, utt2spk, spk2utt,
+    samplefreq, useenergy, framelength, frameshift, numceps, applycmvn,
+    normvars, deltaorder)
+  _decode(config, hyp, hypdir, [featsSpec], graphfile, wordsfile, mdlfile,
+    phonesfilealign, lexfstalign, beam, allowpartial, acousticscale)
+
+  if not cache:
+    return hyp
+  return _cacheObject(hyp, idxFile)
+
 
 
-    # if alignment symbols were given, compute word and phone lengths
-    if phonesfilealign and lexfstalign:
-      _align(config, logFile, mdlfile, hyp.intfilename, lexfstalign,
-        alignFile, hyp.intphonelens, hyp.phonelens, hyp.intwordlens,
-        hyp.wordlens, phoneSymbols, wordSymbols, wordLeftSym, wordRightSym)
 
 
+def _relayLines(source, kind, results, sinks, renumber):
+  """
+  Reads the Kaldi text archive lines of *source*, a file object or
+  the name of a FIFO to open, and writes them to each of *sinks*,
+  file objects or FIFO names. If *renumber* is True, each line's key
+  is replaced by its zero-padded index, so that downstream readers
+  see sorted keys, otherwise the key must already be an index. Unless
+  *kind* is None, a (kind, index, key, rest of the line) tuple is put
+  on the queue *results* for each line, and (kind, None, None, None)
+  at the end.
+  """
+  outs = []
+  try:
+    if isinstance(source, basestring):
+      source = open(source, "r")
+    for sink in sinks:
+      outs.append(open(sink, "w") if isinstance(sink, basestring) else sink)
+
+    index = 0
+    for line in iter(source.readline, ""):
+      if not strip(line):
+        continue
+      parts = split(line, None, 1)
+      rest = parts[1] if len(parts) > 1 else "\n"
+      if renumber:
+        line = "{0:012d} {1}".format(index, rest)
+      else:
+        index = int(parts[0])
+
+      for out in outs:
+        out.write(line)
+        out.flush()
+      if kind is not None:
+        results.put((kind, index, parts[0], strip(rest)))
+      index += 1
+  except (IOError, OSError, ValueError):
+    pass # a process exited, which the caller reports
   finally:
-    logFile.close()
+    for out in outs:
+      try:
+        out.close()
+      except IOError:
+        pass
+    if kind is not None:
+      results.put((kind, None, None, None))
+
+
+
+
+def _lengthPairs(rest, symbols, oov):
+  """
+  Returns the list of (symbol, length) tuples in the text lengths
+  *rest* written by Kaldi, translated with the SymbolTable *symbols*
+  or *oov*.
+  """
+  pairs = []
+  for pair in rest.split(";"):
+    parts = split(pair)
+    if len(parts) == 2:
+      pairs.append((symbols.symbol(parts[0], oov), int(parts[1])))
+  return pairs
+
+
+
+
+def iterDecodeFeats(directory, config, featsfile, graphfile, wordsfile,
+  mdlfile, phonesfilealign, lexfstalign, beam, allowpartial, acousticscale):
+  """
+  Decodes the features in the archive *featsfile* and yields a result
+  object for each utterance as soon as Kaldi outputs it, in archive
+  order. Results have the members uttId and words, and wordlens and
+  phonelens as lists of (symbol, frames) tuples if alignment symbols
+  are given, otherwise None. Results are not cached, and the log is
+  only kept if KaldiError is raised. Utterances that could not be
+  decoded are skipped, and lengths that could not be computed are None.
+
+  Word and phone lengths are computed by long-lived pipelines reading
+  the decoder's alignments through FIFOs, with utterances renamed by
+  their index so Kaldi can read them sequentially.
+  """
+  streamdir = path.join(directory, "stream_hypotheses")
+  try:
+    makedirs(streamdir)
+  except OSError:
+    pass
+  align = bool(phonesfilealign and lexfstalign)
 
 
-  remove(alignFile)
+  # read word/phone symbol tables
+  wordSymbols = table.getSymbolTable(wordsfile)
+  phoneSymbols = None
+  if align:
+    phoneSymbols = table.getSymbolTable(phonesfilealign)
+    wordLeftSym = str(phoneSymbols.requiredId(config.WORD_BOUND_L))
+    wordRightSym = str(phoneSymbols.requiredId(config.WORD_BOUND_R))
 
 
-  return _cacheObject(hyp, idxFile)
+  fifodir = mkdtemp()
+  fifos = []
+  procs = []
+  results = Queue()
+  logFile = open(path.join(streamdir, _randFilename(suffix=".log")), "w")
+  failed = False
+
+  try:
+    decodeCmd = "{0} --beam={1} --allow-partial={2} --acoustic-scale={3} \
+      \"{4}\" \"{5}\" \"ark:{6}\" ark,t,f:-".format(config.gmmdecode, beam,
+      str(allowpartial).lower(), acousticscale, mdlfile, graphfile, featsfile)
+
+    relays = []
+    kinds = ["hyp"]
+    if align:
+      for name in ("ali", "words", "phonelens"):
+        fifos.append(path.join(fifodir, name))
+        mkfifo(fifos[-1])
+      (aliFifo, wordsFifo, phoneLensFifo) = fifos
+      decodeCmd = "{0} \"ark,t,f:{1}\"".format(decodeCmd, aliFifo)
+
+      phoneLensCmd = "{0} --write-lengths=true \"{1}\" ark:- \
+        ark,t,f:-".format(config.alitophones, mdlfile)
+      wordLensCmd = "{0} \"{1}\" ark:- ark,f:- | {2} \"{3}\" {4} {5} ark:- \
+        \"ark,s,cs:{6}\" ark,f:- | {7} ark:- \"ark,s,cs:{8}\" \
+        ark,t,f:-".format(config.alitophones, mdlfile, config.phonestoprons,
+        lexfstalign, wordLeftSym, wordRightSym, wordsFifo,
+        config.pronstowordali, phoneLensFifo)
+
+      phoneLensProc = _popen(phoneLensCmd, stdin=PIPE, stdout=PIPE, stderr=logFile)
+      procs.append(phoneLensProc)
+      wordLensProc = _popen(wordLensCmd, stdin=PIPE, stdout=PIPE, stderr=logFile)
+      procs.append(wordLensProc)
+
+      relays.append((aliFifo, None, [phoneLensProc.stdin, wordLensProc.stdin], True))
+      relays.append((phoneLensProc.stdout, "phonelens", [phoneLensFifo], False))
+      relays.append((wordLensProc.stdout, "wordlens", [], False))
+      kinds.extend(["phonelens", "wordlens"])
+
+    decodeProc = _popen(decodeCmd, stdout=PIPE, stderr=logFile)
+    procs.append(decodeProc)
+    relays.append((decodeProc.stdout, "hyp", [wordsFifo] if align else [], True))
+
+    for (source, kind, sinks, renumber) in relays:
+      thread = Thread(target=_relayLines, args=(source, kind, results, sinks,
+        renumber))
+      thread.daemon = True
+      thread.start()
+
+
+    # yield each utterance once all its outputs arrived, or are known
+    # to be missing because a later utterance's output arrived
+    pending = {}
+    latest = dict([(kind, -1) for kind in kinds])
+    nextIndex = 0
+    while True:
+      try:
+        (kind, index, key, rest) = results.get(True, 1.0)
+      except Empty:
+        for proc in procs:
+          if proc.poll():
+            raise KaldiError(logFile.name)
+        continue
+
+      if index is None:
+        latest[kind] = float("inf")
+      else:
+        latest[kind] = index
+        pending.setdefault(index, {})[kind] = (key, rest)
+
+      while pending and min(latest.values()) >= nextIndex:
+        outputs = pending.pop(nextIndex, {})
+        nextIndex += 1
+        if "hyp" not in outputs:
+          continue
+
+        (uttId, rest) = outputs["hyp"]
+        result = KaldiObject()
+        result.uttId = uttId
+        result.words = wordSymbols.symbols(split(rest),
+          config.DECODE_OOV_WORD)
+        result.wordlens = None
+        result.phonelens = None
+        if "wordlens" in outputs:
+          result.wordlens = _lengthPairs(outputs["wordlens"][1], wordSymbols,
+            config.DECODE_OOV_WORD)
+        if "phonelens" in outputs:
+          result.phonelens = _lengthPairs(outputs["phonelens"][1],
+            phoneSymbols, config.DECODE_OOV_PHONE)
+        yield result
+
+      if min(latest.values()) == float("inf"):
+        break
+
+    for proc in procs:
+      proc.wait()
+      if proc.returncode:
+        raise KaldiError(logFile.name)
+
+  except KaldiError:
+    failed = True
+    raise
+
+  finally:
+    for proc in procs:
+      if proc.poll() is None:
+        _killTree(proc)
+        proc.wait()
+
+    # unblock relays still waiting to open a FIFO
+    for fifo in fifos:
+      try:
+        close(osopen(fifo, O_RDWR | O_NONBLOCK))
+      except OSError:
+        pass
+    logFile.close()
+    rmtree(fifodir, True)
+
+    # the log is only kept for the KaldiError naming it
+    if not failed:
+      _removeFiles([logFile.name])
 
 
 
 
 
+@_singleFlight
 def alignFeats(directory, config, featsfile, transfile, wordsfile, lexfst,
   phonesfilealign, lexfstalign, mdlfile, treefile, beam,
-  retrybeam, acousticscale, selfloopscale, transitionscale):
+  retrybeam, acousticscale, selfloopscale, transitionscale, featsscp=None,
+  numjobs=1):
 
   hypdir = path.join(directory, "align_hypotheses")
-  (hyp, idxFile) = _getCachedObject(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
+  (hyp, idxFile) = _getCachedObject(hypdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems() if k not in ("featsscp", "numjobs")]))
   
 
-  # check file modification times to see if refresh is required
-  refreshRequired = False
-  try:
-    if int(path.getmtime(featsfile)) > hyp.featsfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(transfile)) > hyp.transfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(wordsfile)) > hyp.wordsfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(mdlfile)) > hyp.mdlfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(treefile)) > hyp.treefile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(phonesfilealign)) > hyp.phonesfilealign_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(lexfst)) > hyp.lexfst_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(lexfstalign)) > hyp.lexfstalign_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
+  # check input files to see if refresh is required
+  inputs = [("featsfile_time", featsfile), ("transfile_time", transfile),
+    ("wordsfile_time", wordsfile), ("mdlfile_time", mdlfile),
+    ("treefile_time", treefile), ("phonesfilealign_time", phonesfilealign),
+    ("lexfst_time", lexfst), ("lexfstalign_time", lexfstalign)]
 
-  if not refreshRequired:
+  if not _inputsChanged(hyp, idxFile, inputs, config):
     return hyp
 
 
@@ -618,14 +1310,7 @@ def alignFeats(directory, config, featsfile, transfile, wordsfile, lexfst,
     pass
 
 
-  hyp.featsfile_time = int(path.getmtime(featsfile))
-  hyp.transfile_time = int(path.getmtime(transfile))
-  hyp.wordsfile_time = int(path.getmtime(wordsfile))
-  hyp.mdlfile_time = int(path.getmtime(mdlfile))
-  hyp.treefile_time = int(path.getmtime(treefile))
-  hyp.phonesfilealign_time = int(path.getmtime(phonesfilealign))
-  hyp.lexfst_time = int(path.getmtime(lexfst))
-  hyp.lexfstalign_time = int(path.getmtime(lexfstalign))
+  _stampInputs(hyp, inputs, config)
   
   
 
@@ -639,41 +1324,11 @@ def alignFeats(directory, config, featsfile, transfile, wordsfile, lexfst,
   copy2(transfile, hyp.filename)
 
 
-  # prepare align command
-  tmp = NamedTemporaryFile(suffix=".ark", delete=False)
-  alignFile = tmp.name
-  tmp.close()
-
-
-  alignCmd = "{0} --transition-scale={1} --acoustic-scale={2} \
-    --self-loop-scale={3} --beam={4} --retry-beam={5} \"{6}\" \"{7}\" \
-    \"{8}\" \"ark:{9}\" ark,t:- \"ark:{10}\"".format(config.gmmalign,
-    transitionscale, acousticscale, selfloopscale, beam, retrybeam, treefile,
-    mdlfile, lexfst, featsfile, alignFile)
-
-
-  logFile = open(path.join(hypdir, _randFilename(suffix=".log")), "w")
-  hypFile = NamedTemporaryFile(mode="w+", suffix=".txt")
-
-  
   # read word/phone symbol tables
-  wordIntSymbols = {}
-  wordSymbols = {}
-  with open(wordsfile, "r") as symTableIn:
-    for line in symTableIn:
-      parts = split(line)
-      wordIntSymbols[parts[0]] = parts[1]
-      wordSymbols[parts[1]] = parts[0]
-
-  phoneSymbols = {}
-  with open(phonesfilealign, "r") as symTableIn:
-    for line in symTableIn:
-      parts = split(line)
-      phoneSymbols[parts[1]] = parts[0]
-      if parts[0] == config.WORD_BOUND_L:
-        wordLeftSym = parts[1]
-      elif parts[0] == config.WORD_BOUND_R:
-        wordRightSym = parts[1]
+  wordSymbols = table.getSymbolTable(wordsfile)
+  phoneSymbols = table.getSymbolTable(phonesfilealign)
+  wordLeftSym = str(phoneSymbols.requiredId(config.WORD_BOUND_L))
+  wordRightSym = str(phoneSymbols.requiredId(config.WORD_BOUND_R))
 
 
   # translate transcripts to int symbols
@@ -684,47 +1339,95 @@ def alignFeats(directory, config, featsfile, transfile, wordsfile, lexfst,
         uttId = parts[0]
         words = parts[1:]
         for i in range(len(words)):
-          try:
-            words[i] = wordIntSymbols[words[i]]
-          except KeyError:
-            words[i] = wordIntSymbols[config.DECODE_OOV_WORD]
+          if words[i] not in wordSymbols:
+            words[i] = config.DECODE_OOV_WORD
+          words[i] = str(wordSymbols.requiredId(words[i]))
         translated = "{0} {1}\n".format(uttId, " ".join(words))
         hypOut.write(translated)
-        hypFile.write(translated)
-    
-  try:
-    hypFile.seek(0)
-    alignProc = Popen(alignCmd, stdin=hypFile, stdout=PIPE, stderr=PIPE, shell=True)
-    (out, err) = alignProc.communicate()
-    logFile.write(out)
-    logFile.write(err)
-    retCode = alignProc.poll()
-    if retCode:
-      raise KaldiError(logFile.name)
 
-    search = "Overall log-likelihood per frame is "
-    for line in err.splitlines():
 
-      if line.startswith("LOG"):
-        if search in line:
-          ll = line[line.index(search) + len(search):]
-          hyp.loglikelihood = ll[:ll.index(" over")]
 
+  # log-likelihoods per frame and frame counts of each shard
+  likelihoods = {}
 
-    _align(config, logFile, mdlfile, hyp.intfilename, lexfstalign,
-        alignFile, hyp.intphonelens, hyp.phonelens, hyp.intwordlens,
-        hyp.wordlens, phoneSymbols, wordSymbols, wordLeftSym, wordRightSym)
-      
+  def alignShard(featsSpec, out, transFile):
+    # prepare align command
+    tmp = NamedTemporaryFile(suffix=".ark", delete=False)
+    alignFile = tmp.name
+    tmp.close()
 
-  finally:
-    hypFile.close()
-    logFile.close()
+    alignCmd = "{0} --transition-scale={1} --acoustic-scale={2} \
+      --self-loop-scale={3} --beam={4} --retry-beam={5} \"{6}\" \"{7}\" \
+      \"{8}\" \"{9}\" ark,t:- \"ark:{10}\"".format(config.gmmalign,
+      transitionscale, acousticscale, selfloopscale, beam, retrybeam, treefile,
+      mdlfile, lexfst, featsSpec, alignFile)
 
 
-  remove(alignFile)
+    logFile = open(path.join(hypdir, _randFilename(suffix=".log")), "w")
+    hypFile = open(transFile, "r")
 
+    try:
+      alignProc = _popen(alignCmd, stdin=hypFile, stdout=PIPE, stderr=PIPE)
+      (output, err) = alignProc.communicate()
+      logFile.write(output)
+      logFile.write(err)
+      retCode = alignProc.poll()
+      if retCode:
+        raise KaldiError(logFile.name)
 
-  return _cacheObject(hyp, idxFile)
+      search = "Overall log-likelihood per frame is "
+      for line in err.splitlines():
 
+        if line.startswith("LOG"):
+          if search in line:
+            ll = line[line.index(search) + len(search):]
+            frames = split(ll[ll.index(" over") + len(" over"):])[0]
+            likelihoods[featsSpec] = (ll[:ll.index(" over")], frames)
 
 
+      _align(config, logFile, mdlfile, transFile, lexfstalign,
+          alignFile, out.intphonelens, out.phonelens, out.intwordlens,
+          out.wordlens, phoneSymbols, wordSymbols, wordLeftSym, wordRightSym)
+        
+
+    finally:
+      hypFile.close()
+      logFile.close()
+      remove(alignFile)
+
+
+
+  # align shards of the features and transcripts concurrently
+  tmpFiles = []
+  try:
+    featsSpecs = _featShards(config, hypdir, featsfile, featsscp, numjobs, tmpFiles)
+    outs = _shardOutputs(hyp, len(featsSpecs), tmpFiles, _ALIGN_FILES)
+
+    transFiles = [hyp.intfilename]
+    if len(featsSpecs) > 1:
+      transFiles = _transcriptShards(hyp.intfilename, featsSpecs, tmpFiles)
+
+    _runConcurrently(alignShard, zip(featsSpecs, outs, transFiles))
+    _mergeOutputs(hyp, outs, _ALIGN_FILES)
+  finally:
+    for tmpFile in tmpFiles:
+      try:
+        remove(tmpFile)
+      except OSError:
+        pass
+
+
+  # average the log-likelihoods of the shards weighted by their frames
+  if len(likelihoods) == 1:
+    hyp.loglikelihood = likelihoods.values()[0][0]
+  elif likelihoods:
+    totalFrames = 0
+    total = 0.0
+    for (ll, frames) in likelihoods.itervalues():
+      totalFrames += int(frames)
+      total += float(ll) * int(frames)
+    if totalFrames:
+      hyp.loglikelihood = str(total / totalFrames)
+
+
+  return _cacheObject(hyp, idxFile)
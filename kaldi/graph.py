@@ -16,21 +16,28 @@
 Defines methods for creating Kaldi decoding graphs.
 """
 
+import re
 from os import path,remove
 from string import split,strip
-from shutil import copy2,rmtree
+from shutil import rmtree
+from sys import exc_info
 from collections import deque
-from subprocess import Popen
 from math import log
 from tempfile import mkdtemp,NamedTemporaryFile 
+from subprocess import PIPE
+from threading import Thread
 
 from skip.util import (KaldiObject, _randFilename, _getCachedObject,
-  _cacheObject, _refreshRequired, KaldiError)
+  _cacheObject, _refreshRequired, _singleFlight, _inputsChanged, _stampInputs,
+  _artifactKey, _fetchArtifact, _storeArtifact, _snapshot, _popen, _killTree,
+  KaldiError)
+from skip.kaldi import table, arpa
 
 
 
 
 
+@_singleFlight
 def makeLGraph(directory, config, phonesfile, wordsfile, lexiconfile,
   addsilence, silenceprobability):
   Ldir = path.join(directory, "L_graphs")
@@ -57,10 +64,17 @@ def makeLGraph(directory, config, phonesfile, wordsfile, lexiconfile,
   except AttributeError:
     copyNames.append(None)
 
-  if not _refreshRequired(zip(origNames, copyNames)):
+  if not _refreshRequired(zip(origNames, copyNames), config=config,
+    snapshots=getattr(L, "snapshot_times", None)):
     return L
 
 
+  # remove old file
+  try:
+    remove(L.filename)
+  except (OSError, AttributeError):
+    pass
+
 
   # copy source files
   L.phonesfile = path.join(Ldir, _randFilename("phones-", ".txt"))
@@ -68,26 +82,19 @@ def makeLGraph(directory, config, phonesfile, wordsfile, lexiconfile,
   L.lexiconfile = path.join(Ldir, _randFilename("lexicon-", ".txt"))
   L.filename = path.join(Ldir, _randFilename("L-", ".fst"))
 
-  copy2(phonesfile, L.phonesfile)
-  copy2(wordsfile, L.wordsfile)
-  copy2(lexiconfile, L.lexiconfile)
+  L.snapshot_times = {}
+  _snapshot(phonesfile, L.phonesfile, L, config)
+  _snapshot(wordsfile, L.wordsfile, L, config)
+  _snapshot(lexiconfile, L.lexiconfile, L, config)
   
   # prepare make L command
   makeCmd = "{0} --isymbols={1} --osymbols={2} --keep_isymbols=false \
   --keep_osymbols=false".format(config.fstcompile, L.phonesfile, L.wordsfile)
 
-  with open(L.phonesfile, "r") as f:
-    for line in f:
-      if line.startswith("{0} ".format(config.EPS_G)):
-        phoneWordDisambig = strip(line[line.index(" "):])
-        break
-  with open(L.wordsfile, "r") as f:
-    for line in f:
-      if line.startswith("{0} ".format(config.EPS_G)):
-        wordDisambig = strip(line[line.index(" "):])
-        break
-    makeCmd = "{0} | {1} \"echo {2}|\" \"echo {3}|\"".format(makeCmd,
-      config.fstaddselfloops, phoneWordDisambig, wordDisambig)
+  phoneWordDisambig = table.getSymbolTable(phonesfile).requiredId(config.EPS_G)
+  wordDisambig = table.getSymbolTable(wordsfile).requiredId(config.EPS_G)
+  makeCmd = "{0} | {1} \"echo {2}|\" \"echo {3}|\"".format(makeCmd,
+    config.fstaddselfloops, phoneWordDisambig, wordDisambig)
 
   makeCmd = "{0} | {1} --sort_type=olabel > \"{2}\"".format(makeCmd,
     config.fstarcsort, L.filename)
@@ -139,7 +146,7 @@ def makeLGraph(directory, config, phonesfile, wordsfile, lexiconfile,
   try:
     logFile = open(path.join(Ldir, _randFilename(suffix=".log")), "w")
     lexiconOut.seek(0)
-    makeProc = Popen(makeCmd, stdin=lexiconOut, stderr=logFile, shell=True)
+    makeProc = _popen(makeCmd, stdin=lexiconOut, stderr=logFile)
     makeProc.communicate()
     retCode = makeProc.poll()
     if retCode:
@@ -156,22 +163,20 @@ def makeLGraph(directory, config, phonesfile, wordsfile, lexiconfile,
 
 
 
+@_singleFlight
 def makeGGraphTextFst(directory, config, wordsfile, fstfile, arcsort):
   Gdir = path.join(directory, "G_graphs")
   (G, idxFile) = _getCachedObject(Gdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
 
   
-  # check file modification time to see if a refresh is required
-  refreshRequired = False
-  try:
-    if int(path.getmtime(fstfile)) > G.fstfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
+  # check input files to see if a refresh is required
+  inputs = (("fstfile_time", fstfile),)
+  refreshRequired = _inputsChanged(G, idxFile, inputs, config)
 
   try:
-    refreshRequired = (refreshRequired and 
-      _refreshRequired((wordsfile, G.wordsfile)))
+    refreshRequired = (_refreshRequired([(wordsfile, G.wordsfile)],
+      config=config, snapshots=getattr(G, "snapshot_times", None))
+      or refreshRequired)
   except AttributeError:
     refreshRequired = True
 
@@ -179,11 +184,23 @@ def makeGGraphTextFst(directory, config, wordsfile, fstfile, arcsort):
     return G
 
 
+  # remove old files
+  try:
+    remove(G.filename)
+  except (OSError, AttributeError):
+    pass
+  try:
+    remove(G.wordsfile)
+  except (OSError, AttributeError):
+    pass
+
+
   G.wordsfile = path.join(Gdir, _randFilename("words-", ".txt"))
   G.filename = path.join(Gdir, _randFilename("G-", ".fst"))
 
-  copy2(wordsfile, G.wordsfile)
-  G.fstfile_time = int(path.getmtime(fstfile))
+  G.snapshot_times = {}
+  _snapshot(wordsfile, G.wordsfile, G, config)
+  _stampInputs(G, inputs, config)
 
   if arcsort:
     compileFstCmd = "{0} --isymbols={1} --osymbols={1} \
@@ -200,7 +217,7 @@ def makeGGraphTextFst(directory, config, wordsfile, fstfile, arcsort):
 
   logFile = open(path.join(Gdir, _randFilename(suffix=".log")), "w")
   try:
-    compileFstProc = Popen(compileFstCmd, stderr=logFile, shell=True)
+    compileFstProc = _popen(compileFstCmd, stderr=logFile)
     compileFstProc.communicate()
     retCode = compileFstProc.poll()
     if retCode:
@@ -215,23 +232,105 @@ def makeGGraphTextFst(directory, config, wordsfile, fstfile, arcsort):
 
 
 
-def makeGGraphArpa(directory, config, wordsfile, arpafile, arcsort):
+def _legalArpaLines(config, lmIn, validWords):
+  """
+  Yields the lines of the ARPA LM file *lmIn* except n-grams with
+  illegal sentence boundary sequences or words not in the SymbolTable
+  *validWords*.
+  """
+  illegalSeqs = re.compile("|".join([re.escape(seq) for seq in (
+    "{0} {1}".format(config.SOS_WORD, config.SOS_WORD),
+    "{0} {1}".format(config.EOS_WORD, config.SOS_WORD),
+    "{0} {1}".format(config.EOS_WORD, config.EOS_WORD))]))
+
+  for line in lmIn:
+    lineParts = split(line)
+    if len(lineParts) > 1:
+      try:
+        float(lineParts[0])
+      except ValueError:
+        yield line # header line
+        continue
+
+      if illegalSeqs.search(line):
+        continue
+
+      # tokens must be words or numbers
+      legal = True
+      for w in lineParts[1:]:
+        if not w in validWords:
+          try:
+            float(w)
+          except ValueError:
+            legal = False
+            break
+      if not legal:
+        continue
+
+    yield line
+
+
+
+
+
+def _grammarArcs(config, lines):
+  """
+  Yields the text FST *lines* printed from an ARPA LM with its
+  epsilon input labels replaced by the grammar disambiguation symbol
+  and sentence boundaries by epsilons.
+  """
+  for line in lines:
+    parts = split(line)
+    if len(parts) >= 4:
+      if parts[2] == config.EPS:
+        parts[2] = config.EPS_G
+      elif parts[2] == config.SOS_WORD or parts[2] == config.EOS_WORD:
+        parts[2] = config.EPS
+      if parts[3] == config.SOS_WORD or parts[3] == config.EOS_WORD:
+        parts[3] = config.EPS
+    yield "{0}\n".format(" ".join(parts))
+
+
+
+
+
+def _writeLines(lines, fout):
+  """
+  Writes *lines* to the pipe *fout* and closes it, stopping early if
+  the process reading it exits.
+  """
+  try:
+    for line in lines:
+      try:
+        fout.write(line)
+      except IOError:
+        break # the reader exited, which its exit status reports
+  finally:
+    try:
+      fout.close()
+    except IOError:
+      pass
+
+
+
+
+
+@_singleFlight
+def makeGGraphArpa(directory, config, wordsfile, arpafile, arcsort,
+  prunethreshold=0, maxorder=None):
 
   Gdir = path.join(directory, "G_graphs")
   (G, idxFile) = _getCachedObject(Gdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
   
   
-  # check file modification time to see if a refresh is required
-  refreshRequired = False
-  try:
-    if int(path.getmtime(arpafile)) > G.arpafile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
+  # check input files to see if a refresh is required
+  inputs = (("arpafile_time", arpafile),)
+  refreshRequired = _inputsChanged(G, idxFile, inputs, config)
 
   try:
-    refreshRequired = (refreshRequired and 
-      _refreshRequired((wordsfile, G.wordsfile)))
+    refreshRequired = (_refreshRequired([(wordsfile, G.wordsfile)],
+      config=config, snapshots=getattr(G, "snapshot_times", None))
+      or refreshRequired)
   except AttributeError:
     refreshRequired = True
 
@@ -239,18 +338,35 @@ def makeGGraphArpa(directory, config, wordsfile, arpafile, arcsort):
     return G
 
 
+  # remove old files
+  try:
+    remove(G.filename)
+  except (OSError, AttributeError):
+    pass
+  try:
+    remove(G.wordsfile)
+  except (OSError, AttributeError):
+    pass
+
+
   G.wordsfile = path.join(Gdir, _randFilename("words-", ".txt"))
   G.filename = path.join(Gdir, _randFilename("G-", ".fst"))
 
-  copy2(wordsfile, G.wordsfile)
-  G.arpafile_time = int(path.getmtime(arpafile))
+  G.snapshot_times = {}
+  _snapshot(wordsfile, G.wordsfile, G, config)
+  _stampInputs(G, inputs, config)
+
+  # reuse the grammar if another context already made it
+  storeKey = None
+  if config.SHARED_STORE_DIR:
+    storeKey = _artifactKey("G_arpa", (arcsort, config.EPS, config.EPS_G,
+      config.SOS_WORD, config.EOS_WORD, prunethreshold, maxorder),
+      (wordsfile, arpafile))
+    if _fetchArtifact(config, storeKey, G.filename):
+      return _cacheObject(G, idxFile)
 
 
-  tmp = NamedTemporaryFile(suffix=".txt", delete=False)
-  fstFile = tmp.name
-  tmp.close()
-  makeFstCmd = "{0} - | {1} - \"{2}\"".format(config.arpa2fst,
-    config.fstprint, fstFile)
+  makeFstCmd = "{0} - | {1} -".format(config.arpa2fst, config.fstprint)
 
   if arcsort:
     compileFstCmd = "{0} --isymbols={1} --osymbols={1} \
@@ -264,87 +380,52 @@ def makeGGraphArpa(directory, config, wordsfile, arpafile, arcsort):
         wordsfile, config.fstrmepsilon, G.filename)
 
 
-  # remove illegal sos and eos sequences
-  illegalSeqs = []
-  illegalSeqs.append("{0} {1}".format(config.SOS_WORD, config.SOS_WORD))
-  illegalSeqs.append("{0} {1}".format(config.EOS_WORD, config.SOS_WORD))
-  illegalSeqs.append("{0} {1}".format(config.EOS_WORD, config.EOS_WORD))
-
-
+  # stream the pruned and filtered LM through arpa2fst and the symbol
+  # replacement into the compiler, without intermediate files
+  validWords = table.getSymbolTable(wordsfile)
+  lmIn = open(arpafile, "r")
   logFile = open(path.join(Gdir, _randFilename(suffix=".log")), "w")
-  fstInputFile = NamedTemporaryFile(mode="w+", suffix=".txt")
-  fstTextFile = NamedTemporaryFile(mode="w+", suffix=".txt")
-
-  try:
-    validWords = {}
-    with open(G.wordsfile, "r") as wordsIn:
-      for line in wordsIn:
-        if strip(line):
-          word = split(line)[0]
-          validWords[word] = True
-
-    with open(arpafile, "r") as lmIn:
-      for line in lmIn:
-        legal = True
-
-        # discard illegal sequences and lines without valid words
-        lineParts = split(line)
-        if len(lineParts) > 1:
-          try:
-            float(lineParts[0])
-            for seq in illegalSeqs:
-              if seq in line:
-                legal = False
-                break
-
-            for w in lineParts[1:]:
-              try:
-                float(w)
-              except ValueError:
-                if not w in validWords:
-                  legal = False
-                  break
-          except ValueError:
-            legal = True
-
-        if legal:
-          fstInputFile.write(line)
+  procs = []
+  errors = []
 
+  def filterArpa():
+    try:
+      _writeLines(_legalArpaLines(config, arpa.pruneArpa(lmIn,
+        prunethreshold, maxorder), validWords), makeFstProc.stdin)
+    except Exception:
+      errors.append(exc_info())
 
-    fstInputFile.seek(0)
-    makeFstProc = Popen(makeFstCmd, stdin=fstInputFile, stderr=logFile, shell=True)
-    makeFstProc.communicate()
-    retCode = makeFstProc.poll()
-    if retCode:
-      raise KaldiError(logFile.name)
-
-
-    # read text fst, replace symbols, and send to compiler process
-    with open(fstFile, "r") as fstIn:
-      for line in fstIn:
-        parts = split(line)
-        if len(parts) >= 4:
-          if parts[2] == config.EPS:
-            parts[2] = config.EPS_G
-          elif parts[2] == config.SOS_WORD or parts[2] == config.EOS_WORD:
-            parts[2] = config.EPS
-          if parts[3] == config.SOS_WORD or parts[3] == config.EOS_WORD:
-            parts[3] = config.EPS
-        fstTextFile.write("{0}\n".format(" ".join(parts)))
-
-    fstTextFile.seek(0)
-    compileFstProc = Popen(compileFstCmd, stdin=fstTextFile, stderr=logFile, shell=True)
-    compileFstProc.communicate()
-    retCode = compileFstProc.poll()
-    if retCode:
-      raise KaldiError(logFile.name)
+  try:
+    makeFstProc = _popen(makeFstCmd, stdin=PIPE, stdout=PIPE, stderr=logFile)
+    procs.append(makeFstProc)
+    compileFstProc = _popen(compileFstCmd, stdin=PIPE, stderr=logFile)
+    procs.append(compileFstProc)
+
+    filterThread = Thread(target=filterArpa)
+    filterThread.daemon = True
+    filterThread.start()
+
+    _writeLines(_grammarArcs(config,
+      iter(makeFstProc.stdout.readline, "")), compileFstProc.stdin)
+    makeFstProc.stdout.close()
+    filterThread.join()
+    if errors:
+      raise errors[0][0], errors[0][1], errors[0][2]
+
+    for proc in procs:
+      if proc.wait():
+        raise KaldiError(logFile.name)
 
   finally:
-    fstInputFile.close()
-    fstTextFile.close()
+    for proc in procs:
+      if proc.poll() is None:
+        _killTree(proc)
+        proc.wait()
+    lmIn.close()
     logFile.close()
 
-  remove(fstFile)
+  if storeKey:
+    _storeArtifact(config, storeKey, G.filename)
 
   return _cacheObject(G, idxFile)
 
@@ -353,6 +434,7 @@ def makeGGraphArpa(directory, config, wordsfile, arpafile, arcsort):
 
 
 
+@_singleFlight
 def makeHCLGGraph(directory, config, lexfst, phonesfile,
   grammarfst, mdlfile, treefile, transitionscale,
   loopscale, contextsize, centralposition):
@@ -361,36 +443,12 @@ def makeHCLGGraph(directory, config, lexfst, phonesfile,
   (HCLG, idxFile) = _getCachedObject(HCLGdir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
   
 
-  # check file modification times instead of copying like for other graphs
-  refreshRequired = False
-  try:
-    if int(path.getmtime(lexfst)) > HCLG.lexfst_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(phonesfile)) > HCLG.phonesfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(grammarfst)) > HCLG.grammarfst_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(treefile)) > HCLG.treefile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(mdlfile)) > HCLG.mdlfile_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
+  # check input files instead of copying like for other graphs
+  inputs = (("lexfst_time", lexfst), ("phonesfile_time", phonesfile),
+    ("grammarfst_time", grammarfst), ("treefile_time", treefile),
+    ("mdlfile_time", mdlfile))
 
-
-  if not refreshRequired:
+  if not _inputsChanged(HCLG, idxFile, inputs, config):
     return HCLG
 
 
@@ -401,13 +459,18 @@ def makeHCLGGraph(directory, config, lexfst, phonesfile,
     pass
 
 
-  HCLG.lexfst_time = int(path.getmtime(lexfst))
-  HCLG.phonesfile_time = int(path.getmtime(phonesfile))
-  HCLG.grammarfst_time = int(path.getmtime(grammarfst))
-  HCLG.treefile_time = int(path.getmtime(treefile))
-  HCLG.mdlfile_time = int(path.getmtime(mdlfile))
+  _stampInputs(HCLG, inputs, config)
   HCLG.filename = path.join(HCLGdir, _randFilename("HCLG-", ".fst"))
 
+  # reuse the graph if another context already built it
+  storeKey = None
+  if config.SHARED_STORE_DIR:
+    storeKey = _artifactKey("HCLG", (transitionscale, loopscale,
+      contextsize, centralposition), (lexfst, phonesfile, grammarfst,
+      mdlfile, treefile))
+    if _fetchArtifact(config, storeKey, HCLG.filename):
+      return _cacheObject(HCLG, idxFile)
+
 
   # create directory for temp files
   tmpDir = mkdtemp()
@@ -451,19 +514,19 @@ def makeHCLGGraph(directory, config, lexfst, phonesfile,
   logFile = open(path.join(HCLGdir, _randFilename(suffix=".log")), "w")
 
   try:
-    mkGraphProc = Popen(makeClgCmd, stderr=logFile, shell=True)
+    mkGraphProc = _popen(makeClgCmd, stderr=logFile)
     mkGraphProc.communicate()
     retCode = mkGraphProc.poll()
     if retCode:
       raise KaldiError(logFile.name)
 
-    mkGraphProc = Popen(makeHaCmd, stderr=logFile, shell=True)
+    mkGraphProc = _popen(makeHaCmd, stderr=logFile)
     mkGraphProc.communicate()
     retCode = mkGraphProc.poll()
     if retCode:
       raise KaldiError(logFile.name)
     
-    mkGraphProc = Popen(makeHclgCmd, stderr=logFile, shell=True)
+    mkGraphProc = _popen(makeHclgCmd, stderr=logFile)
     mkGraphProc.communicate()
     retCode = mkGraphProc.poll()
     if retCode:
@@ -473,7 +536,9 @@ def makeHCLGGraph(directory, config, lexfst, phonesfile,
     logFile.close()
 
   rmtree(tmpDir, True)
-  
+
+  if storeKey:
+    _storeArtifact(config, storeKey, HCLG.filename)
 
   return _cacheObject(HCLG, idxFile)
 
@@ -481,25 +546,16 @@ def makeHCLGGraph(directory, config, lexfst, phonesfile,
 
 
 
+@_singleFlight
 def composeGraphs(directory, config, leftfst, rightfst):
 
   composeDir = path.join(directory, "composed_graphs")
   (comp, idxFile) = _getCachedObject(composeDir, " ".join(["{0}:{1}".format(k,v) for k,v in locals().iteritems()]))
   
 
-  refreshRequired = False
-  try:
-    if int(path.getmtime(leftfst)) > comp.leftfst_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
-  try:
-    if int(path.getmtime(rightfst)) > comp.rightfst_time:
-      refreshRequired = True
-  except AttributeError:
-    refreshRequired = True
+  inputs = (("leftfst_time", leftfst), ("rightfst_time", rightfst))
 
-  if not refreshRequired:
+  if not _inputsChanged(comp, idxFile, inputs, config):
     return comp
 
 
@@ -509,8 +565,7 @@ def composeGraphs(directory, config, leftfst, rightfst):
   except (OSError, AttributeError):
     pass
 
-  comp.leftfst_time = int(path.getmtime(leftfst))
-  comp.rightfst_time = int(path.getmtime(rightfst))
+  _stampInputs(comp, inputs, config)
   comp.filename = path.join(composeDir, _randFilename("comp-", ".fst"))
 
 
@@ -521,7 +576,7 @@ def composeGraphs(directory, config, leftfst, rightfst):
   logFile = open(path.join(composeDir, _randFilename(suffix=".log")), "w")
 
   try:
-    composeProc = Popen(composeCmd, stderr=logFile, shell=True)
+    composeProc = _popen(composeCmd, stderr=logFile)
     composeProc.communicate()
     retCode = composeProc.poll()
     if retCode:
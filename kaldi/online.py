@@ -0,0 +1,246 @@
+# Copyright 2013 Signal Analysis and Interpretation Laboratory,
+# University of Southern California
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Defines methods for decoding audio while it arrives with Kaldi's
+online audio server.
+
+The server reads audio from a TCP client in chunks, each a 4-byte
+little-endian length followed by that many bytes of 16 kHz, 16-bit
+mono PCM. A zero-length chunk ends the stream. It replies with a line
+"PARTIAL:<word>" for each word as it is recognized and, for each
+utterance it detects, a line "RESULT:NUM=<n>,..." followed by n lines
+"<word>,<start>,<end>". "RESULT:DONE" ends the replies for a stream.
+"""
+
+import socket
+from os import path,makedirs
+from struct import pack
+from threading import Thread,Event,Lock
+from time import time,sleep
+from atexit import register
+
+from skip.util import _randFilename, _popen, _killTree, KaldiError
+
+
+
+# running servers, which are stopped when Python exits
+_servers = set()
+_serversLock = Lock()
+
+
+
+
+class OnlineSession(object):
+  """
+  Represents one audio stream sent to an online decoder. Audio is
+  given to push as it arrives. Partial words are passed to
+  *onPartial* and the words of each finished utterance, as a list of
+  (word, start, end) tuples with times in seconds, to *onResult*.
+  Callbacks run in the session's reader thread.
+  """
+
+  def __init__(self, decoder, sock, onPartial, onResult):
+    self.partial = []
+    self.results = []
+    self._decoder = decoder
+    self._sock = sock
+    self._onPartial = onPartial
+    self._onResult = onResult
+    self._done = Event()
+    self._closed = False
+
+    reader = Thread(target=self._read)
+    reader.daemon = True
+    reader.start()
+
+
+  def _read(self):
+    try:
+      replies = self._sock.makefile("r")
+      while True:
+        line = replies.readline()
+        if not line or line.startswith("RESULT:DONE"):
+          break
+        line = line.strip()
+
+        if line.startswith("PARTIAL:"):
+          word = line[len("PARTIAL:"):]
+          self.partial.append(word)
+          if self._onPartial:
+            self._onPartial(word)
+
+        elif line.startswith("RESULT:"):
+          fields = dict([f.split("=", 1) for f in line[len("RESULT:"):].split(",")
+            if "=" in f])
+          words = []
+          for i in range(int(fields.get("NUM", 0))):
+            parts = replies.readline().strip().rsplit(",", 2)
+            words.append((parts[0], float(parts[1]), float(parts[2])))
+          self.partial = []
+          self.results.extend(words)
+          if self._onResult:
+            self._onResult(words)
+    except (socket.error, IOError, ValueError, IndexError):
+      pass # the server closed the connection or failed
+    finally:
+      self._done.set()
+
+
+  def push(self, audio):
+    """
+    Sends the 16 kHz, 16-bit mono PCM bytes *audio* to the decoder.
+    """
+    if audio:
+      self._sock.sendall(pack("<i", len(audio)) + audio)
+
+
+  def finish(self, timeout=None):
+    """
+    Ends the audio stream and waits up to *timeout* seconds, or until
+    the decoder replied, for the final results. Returns the list of
+    (word, start, end) tuples of all utterances in the stream.
+    """
+    if not self._closed:
+      try:
+        self._sock.sendall(pack("<i", 0))
+      except socket.error:
+        pass
+      self._done.wait(timeout)
+      self.close()
+    return self.results
+
+
+  def close(self):
+    """
+    Closes the session without waiting for results, making the
+    decoder available for the next session.
+    """
+    if self._closed:
+      return
+    self._closed = True
+    try:
+      self._sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self._sock.close()
+    self._decoder._sessionLock.release()
+
+
+
+
+class OnlineDecoder(object):
+  """
+  Keeps Kaldi's online audio server running with the decoding graph
+  *graphfile*, word symbol table *wordsfile* and GMM model *mdlfile*
+  loaded, so sessions start without loading them again. Features use
+  online CMVN over *cmnwindow* frames, at least *mincmnwindow* at the
+  start of a stream, and deltas, or the LDA transform *ldafile* if
+  given. *silencephones* is the colon-separated list of silence phone
+  ids and *wordboundaryfile* the word boundary table of the phones.
+
+  Partial results are output every *batchsize* frames, which bounds
+  their latency, and utterances end after *interutt* frames of
+  silence. *beam*, *maxactive* and *acousticscale* are passed to the
+  decoder. The server handles one session at a time; session waits
+  for the previous one to finish.
+  """
+
+  def __init__(self, config, logdir, graphfile, wordsfile, mdlfile,
+    silencephones, wordboundaryfile, ldafile=None, beam=16, maxactive=7000,
+    acousticscale=0.1, batchsize=27, interutt=50, cmnwindow=600,
+    mincmnwindow=100):
+    self.config = config
+    self._sessionLock = Lock()
+
+    try:
+      makedirs(logdir)
+    except OSError:
+      pass
+
+    # find a free port for the server
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    self.port = probe.getsockname()[1]
+    probe.close()
+
+    cmd = "{0} --beam={1} --max-active={2} --acoustic-scale={3} \
+      --batch-size={4} --inter-utt-sil={5} --cmn-window={6} \
+      --min-cmn-window={7} \"{8}\" \"{9}\" \"{10}\" {11} \"{12}\" \
+      {13}".format(config.onlineaudioserver, beam, maxactive, acousticscale,
+      batchsize, interutt, cmnwindow, mincmnwindow, mdlfile, graphfile,
+      wordsfile, silencephones, wordboundaryfile, self.port)
+    if ldafile:
+      cmd = "{0} \"{1}\"".format(cmd, ldafile)
+
+    self.logFile = open(path.join(logdir, _randFilename(suffix=".log")), "w")
+    self.proc = _popen(cmd, leadGroup=True, stderr=self.logFile)
+    with _serversLock:
+      _servers.add(self)
+
+
+  def _connect(self):
+    """
+    Returns a socket connected to the server, waiting up to
+    config.ONLINE_START_TIMEOUT seconds for it to load.
+    """
+    deadline = time() + self.config.ONLINE_START_TIMEOUT
+    while True:
+      if self.proc.poll() is not None:
+        raise KaldiError(self.logFile.name)
+      try:
+        return socket.create_connection(("127.0.0.1", self.port))
+      except socket.error:
+        if time() > deadline:
+          self.close()
+          raise KaldiError(self.logFile.name)
+        sleep(0.1)
+
+
+  def session(self, onPartial=None, onResult=None):
+    """
+    Starts a new audio stream and returns its session, as for
+    OnlineSession with the callbacks *onPartial* and *onResult*.
+    Waits for the previous session to be finished or closed.
+    """
+    self._sessionLock.acquire()
+    try:
+      sock = self._connect()
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except:
+      self._sessionLock.release()
+      raise
+    return OnlineSession(self, sock, onPartial, onResult)
+
+
+  def close(self):
+    """
+    Stops the server.
+    """
+    if self.proc.poll() is None:
+      _killTree(self.proc)
+    self.proc.wait()
+    self.logFile.close()
+    with _serversLock:
+      _servers.discard(self)
+
+
+
+
+@register
+def _closeServers():
+  with _serversLock:
+    servers = list(_servers)
+  for server in servers:
+    server.close()
@@ -0,0 +1,366 @@
+# Copyright 2013 Signal Analysis and Interpretation Laboratory,
+# University of Southern California
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Defines pools of long-lived Kaldi decoders that keep their decoding
+graph and model loaded between calls.
+"""
+
+from os import path,stat
+from struct import pack
+from shutil import copyfileobj
+from subprocess import PIPE,STDOUT
+from threading import Thread,Lock,Condition
+from Queue import Queue,Empty
+from time import time,sleep
+from atexit import register
+
+from skip.util import _randFilename, _popen, _killTree, KaldiError
+
+
+
+# pools by decoder command and graph and model stamps, see getPool
+_pools = {}
+_poolsLock = Lock()
+_reaper = None
+
+# running decoders, which are shut down when Python exits
+_decoders = set()
+_decodersLock = Lock()
+
+# prefixes of Kaldi log lines
+_LOG_PREFIXES = ("LOG ", "VLOG", "WARNING ", "ERROR ", "ASSERTION_FAILED ")
+
+# log messages naming utterances the decoder did not output
+_FAILED_MESSAGES = ("Did not successfully decode utterance ",
+  "Zero-length utterance: ")
+
+
+
+
+def _sentinel(key):
+  """
+  Returns a Kaldi binary archive entry with an empty matrix for the
+  utterance *key*, which decoders report as a zero-length utterance.
+  """
+  size = "\x04{0}".format(pack("<i", 0))
+  return "{0} \0BFM {1}{1}".format(key, size)
+
+
+
+
+def _isResult(line):
+  """
+  Returns True if *line* from the decoder's merged output is a
+  decoded utterance in text archive format, rather than a log line.
+  """
+  parts = line.split()
+  if not parts or line.startswith(_LOG_PREFIXES) or "(" in parts[0]:
+    return False
+  for part in parts[1:]:
+    if not part.isdigit():
+      return False
+  return True
+
+
+
+
+class _Decoder(object):
+  """
+  Represents one running decoder reading utterances from its
+  standard input as a Kaldi archive and writing their results.
+  """
+
+  def __init__(self, cmd, logdir):
+    self.logFile = open(path.join(logdir, _randFilename(suffix=".log")), "w")
+    self.proc = _popen(cmd, leadGroup=True, stdin=PIPE, stdout=PIPE,
+      stderr=STDOUT)
+    with _decodersLock:
+      _decoders.add(self)
+    self.lines = Queue()
+    self.lastUse = time()
+
+    self.reader = Thread(target=self._read)
+    self.reader.daemon = True
+    self.reader.start()
+
+
+  def _read(self):
+    for line in iter(self.proc.stdout.readline, ""):
+      self.lines.put(line)
+    self.lines.put(None)
+
+
+  def _write(self, featsfile, key):
+    try:
+      if featsfile:
+        with open(featsfile, "rb") as featsIn:
+          copyfileobj(featsIn, self.proc.stdin)
+      self.proc.stdin.write(_sentinel(key))
+      self.proc.stdin.flush()
+    except (IOError, ValueError):
+      pass # the decoder exited, which the reader reports
+
+
+  def alive(self):
+    return self.proc.poll() is None
+
+
+  def decode(self, featsfile, timeout):
+    """
+    Decodes the utterances in the Kaldi archive *featsfile*, or
+    none if it is None. Returns a tuple of the list of result lines
+    in text archive format and the list of utterances the decoder did
+    not output. Raises KaldiError if the decoder exits or produces no
+    output for *timeout* seconds.
+    """
+    key = _randFilename("skip-sentinel-")
+    writer = Thread(target=self._write, args=(featsfile, key))
+    writer.daemon = True
+    writer.start()
+
+    results = []
+    failed = []
+    while True:
+      try:
+        line = self.lines.get(True, timeout)
+      except Empty:
+        line = None
+      if line is None:
+        self.close()
+        raise KaldiError(self.logFile.name)
+
+      if _isResult(line):
+        results.append(line)
+        continue
+
+      self.logFile.write(line)
+      if key in line:
+        break
+      for message in _FAILED_MESSAGES:
+        if message in line:
+          failed.append(line[line.index(message) + len(message):].split(",")[0].strip())
+
+    writer.join()
+    self.logFile.flush()
+    self.lastUse = time()
+    return (results, failed)
+
+
+  def close(self):
+    try:
+      self.proc.stdin.close()
+    except IOError:
+      pass
+    if self.alive():
+      _killTree(self.proc)
+    self.proc.wait()
+    self.reader.join()
+    self.logFile.close()
+    with _decodersLock:
+      _decoders.discard(self)
+
+
+
+
+class DecoderPool(object):
+  """
+  Keeps up to *size* decoders started with the shell command *cmd*
+  loaded, writing their logs to *logdir*. Decoders that exit or stop
+  responding for *timeout* seconds are restarted, and decoders idle
+  for *idletimeout* seconds are shut down until they are needed again.
+  """
+
+  def __init__(self, cmd, logdir, size, idletimeout, timeout):
+    self.cmd = cmd
+    self.logdir = logdir
+    self.size = max(size, 1)
+    self.idletimeout = idletimeout
+    self.timeout = timeout
+    self._idle = []
+    self._count = 0
+    self._closed = False
+    self._cond = Condition(Lock())
+
+
+  def _acquire(self):
+    with self._cond:
+      while not self._idle and self._count >= self.size:
+        self._cond.wait()
+      if self._idle:
+        decoder = self._idle.pop()
+      else:
+        decoder = None
+        self._count += 1
+
+    # health check before handing the decoder out
+    if decoder is not None and not decoder.alive():
+      decoder.close()
+      decoder = None
+
+    if decoder is None:
+      try:
+        decoder = _Decoder(self.cmd, self.logdir)
+      except Exception:
+        with self._cond:
+          self._count -= 1
+          self._cond.notify()
+        raise
+    return decoder
+
+
+  def _release(self, decoder, healthy):
+    with self._cond:
+      keep = healthy and not self._closed
+      if keep:
+        self._idle.append(decoder)
+      else:
+        self._count -= 1
+      self._cond.notify()
+    if healthy and not keep:
+      decoder.close()
+
+
+  def decode(self, featsfile):
+    """
+    Decodes the utterances in the Kaldi archive *featsfile* with the
+    next free decoder, as _Decoder.decode does. If the decoder fails,
+    the archive is decoded once more with a restarted decoder.
+    """
+    for attempt in (0, 1):
+      decoder = self._acquire()
+      try:
+        result = decoder.decode(featsfile, self.timeout)
+      except KaldiError:
+        self._release(decoder, False)
+        if attempt:
+          raise
+        continue
+      self._release(decoder, True)
+      return result
+
+
+  def check(self):
+    """
+    Sends an empty request to each idle decoder. Decoders that do not
+    respond are shut down, to be restarted when next needed.
+    """
+    with self._cond:
+      decoders = self._idle
+      self._idle = []
+    for decoder in decoders:
+      lastUse = decoder.lastUse
+      try:
+        decoder.decode(None, self.timeout)
+        decoder.lastUse = lastUse
+        self._release(decoder, True)
+      except KaldiError:
+        self._release(decoder, False)
+
+
+  def shutdownIdle(self):
+    """
+    Shuts down the decoders idle for longer than the pool's idle
+    timeout.
+    """
+    cutoff = time() - self.idletimeout
+    with self._cond:
+      expired = [d for d in self._idle if d.lastUse < cutoff]
+      self._idle = [d for d in self._idle if d.lastUse >= cutoff]
+      self._count -= len(expired)
+      self._cond.notify_all()
+    for decoder in expired:
+      decoder.close()
+
+
+  def close(self):
+    """
+    Shuts down all idle decoders, and the busy ones once they are
+    released.
+    """
+    with self._cond:
+      self._closed = True
+      decoders = self._idle
+      self._idle = []
+      self._count -= len(decoders)
+      self._cond.notify_all()
+    for decoder in decoders:
+      decoder.close()
+
+
+
+
+def _reap(interval):
+  while True:
+    sleep(interval)
+    with _poolsLock:
+      pools = [pool for (pool, stamps) in _pools.itervalues()]
+    for pool in pools:
+      pool.shutdownIdle()
+      pool.check()
+
+
+
+
+@register
+def _closeDecoders():
+  with _decodersLock:
+    decoders = list(_decoders)
+  for decoder in decoders:
+    decoder.close()
+
+
+
+
+def getPool(config, logdir, graphfile, mdlfile, beam, allowpartial,
+  acousticscale):
+  """
+  Returns the decoder pool for the graph *graphfile*, the model
+  *mdlfile* and the decoding options *beam*, *allowpartial* and
+  *acousticscale*, creating it if needed. Pools are shared by all
+  contexts in the process and replaced when the graph or model
+  changes. Pool sizes and timeouts are given by config.DECODER_POOL_SIZE,
+  config.DECODER_POOL_IDLE and config.DECODER_POOL_TIMEOUT.
+  """
+  global _reaper
+
+  stamps = []
+  for fname in (graphfile, mdlfile):
+    st = stat(fname)
+    stamps.append((st.st_size, st.st_mtime))
+
+  cmd = "{0} --beam={1} --allow-partial={2} --acoustic-scale={3} \
+    \"{4}\" \"{5}\" ark:- ark,t,f:-".format(config.gmmdecode, beam,
+    str(allowpartial).lower(), acousticscale, mdlfile, graphfile)
+  key = cmd
+
+  with _poolsLock:
+    try:
+      (pool, poolStamps) = _pools[key]
+    except KeyError:
+      pool = None
+
+    if pool is None or poolStamps != stamps:
+      if pool is not None:
+        pool.close()
+      pool = DecoderPool(cmd, logdir, config.DECODER_POOL_SIZE,
+        config.DECODER_POOL_IDLE, config.DECODER_POOL_TIMEOUT)
+      _pools[key] = (pool, stamps)
+
+    if _reaper is None:
+      _reaper = Thread(target=_reap, args=(min(config.DECODER_POOL_IDLE, 60),))
+      _reaper.daemon = True
+      _reaper.start()
+
+  return pool
@@ -0,0 +1,427 @@
+# Copyright 2013 Signal Analysis and Interpretation Laboratory,
+# University of Southern California
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Defines methods for reading Kaldi archives and symbol tables without
+running Kaldi.
+"""
+
+from os import path,stat
+from array import array
+from struct import unpack
+from hashlib import sha1
+from mmap import mmap,ACCESS_READ
+from string import split,strip
+from threading import Lock
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+
+# bytes read at the start of each entry, enough for any key
+_HEAD_SIZE = 1024
+
+# bytes read at the start of binary objects, enough for any header
+_BINARY_HEADER_SIZE = 64
+
+# block size for hashing entries
+_HASH_BLOCK_SIZE = 1 << 20
+
+# element sizes of full binary matrices and vectors by token
+_MATRIX_TOKENS = {"FM": 4, "DM": 8}
+_VECTOR_TOKENS = {"FV": 4, "DV": 8}
+
+# NumPy types of full binary matrices and vectors by token
+_DTYPES = {"FM": "<f4", "DM": "<f8", "FV": "<f4", "DV": "<f8"}
+
+# scale of the 16-bit values in compressed matrices, as used by Kaldi
+_UINT16_SCALE = 1.52590218966964e-05
+
+# symbol tables by file name with their stamps, see getSymbolTable
+_symbolTables = {}
+_symbolTablesLock = Lock()
+
+
+
+
+def _binaryHeader(head):
+  """
+  Parses the header of the binary Kaldi matrix or vector starting at
+  *head*, which must hold at least its header. Full and compressed
+  matrices and full vectors are supported. Returns a tuple of the
+  object's token, the size of its header in bytes, its shape and the
+  size of its data in bytes.
+  """
+  end = head.index(" ", 2)
+  token = head[2:end]
+  pos = end + 1
+
+  if token in _MATRIX_TOKENS:
+    (rows, cols) = unpack("<xixi", head[pos:pos + 10])
+    return (token, pos + 10, (rows, cols), rows * cols * _MATRIX_TOKENS[token])
+
+  if token in _VECTOR_TOKENS:
+    (dim,) = unpack("<xi", head[pos:pos + 5])
+    return (token, pos + 5, (dim,), dim * _VECTOR_TOKENS[token])
+
+  if token in ("CM", "CM2", "CM3"):
+    (minValue, valueRange, rows, cols) = unpack("<ffii", head[pos:pos + 16])
+    if token == "CM": # one byte per value with per-column headers
+      data = cols * (8 + rows)
+    elif token == "CM2":
+      data = 2 * rows * cols
+    else:
+      data = rows * cols
+    return (token, pos + 16, (rows, cols), data)
+
+  raise ValueError("unsupported Kaldi object {0}".format(token))
+
+
+
+
+def _binarySize(head):
+  """
+  Returns the size in bytes of the binary Kaldi object starting at
+  *head*, as parsed by _binaryHeader.
+  """
+  (token, headerSize, shape, dataSize) = _binaryHeader(head)
+  return headerSize + dataSize
+
+
+
+
+def _textSize(f, offset):
+  """
+  Returns the size in bytes of the text Kaldi object starting at
+  *offset* in the file *f*, up to and including the line holding its
+  closing bracket, or its only line if it has no brackets.
+  """
+  f.seek(offset)
+  line = f.readline()
+  size = len(line)
+  if "[" in line and "]" not in line:
+    for line in f:
+      size += len(line)
+      if "]" in line:
+        break
+  return size
+
+
+
+
+def scanArchive(fname):
+  """
+  Yields a tuple of the key, offset and size in bytes of each entry
+  of the Kaldi archive *fname*. The offset is that of the entry's
+  object after its key, as an scp index gives it. Raises ValueError
+  if an entry cannot be parsed.
+  """
+  with open(fname, "rb") as f:
+    start = 0
+    while True:
+      f.seek(start)
+      head = f.read(_HEAD_SIZE)
+      stripped = head.lstrip()
+      if not stripped:
+        break
+      start += len(head) - len(stripped)
+      head = stripped
+
+      sp = head.find(" ")
+      if sp <= 0:
+        raise ValueError("bad archive entry at offset {0} of {1}".format(start, fname))
+      key = head[:sp]
+      offset = start + sp + 1
+
+      if head[sp + 1:sp + 3] == "\0B":
+        f.seek(offset)
+        size = _binarySize(f.read(_BINARY_HEADER_SIZE))
+      else:
+        size = _textSize(f, offset)
+
+      yield (key, offset, size)
+      start = offset + size
+
+
+
+
+def fingerprints(fname):
+  """
+  Yields a tuple of the key, offset and hex digest of the object of
+  each entry of the Kaldi archive *fname*, as for scanArchive.
+  Entries holding identical objects have identical digests.
+  """
+  with open(fname, "rb") as f:
+    for (key, offset, size) in scanArchive(fname):
+      digest = sha1()
+      f.seek(offset)
+      while size > 0:
+        block = f.read(min(size, _HASH_BLOCK_SIZE))
+        if not block:
+          raise ValueError("truncated archive entry {0} in {1}".format(key, fname))
+        digest.update(block)
+        size -= len(block)
+      yield (key, offset, digest.hexdigest())
+
+
+
+
+def _decompress(token, buf, start, shape):
+  """
+  Returns a new float32 NumPy array with the values of the compressed
+  Kaldi matrix of *shape* and format *token* whose data starts at
+  *start* in *buf*, decompressed as Kaldi does.
+  """
+  (rows, cols) = shape
+  (minValue, valueRange) = unpack("<ff", buf[start - 16:start - 8])
+
+  if token == "CM2":
+    data = numpy.frombuffer(buf, "<u2", rows * cols, start).reshape(shape)
+    values = minValue + valueRange * _UINT16_SCALE * data
+  elif token == "CM3":
+    data = numpy.frombuffer(buf, "u1", rows * cols, start).reshape(shape)
+    values = minValue + valueRange / 255.0 * data
+  else:
+    # percentiles 0, 25, 75 and 100 of each column, then its bytes
+    headers = numpy.frombuffer(buf, "<u2", 4 * cols, start).reshape((cols, 4))
+    percentiles = minValue + valueRange * _UINT16_SCALE * headers
+    (p0, p25, p75, p100) = [percentiles[:, i:i + 1] for i in range(4)]
+    data = numpy.frombuffer(buf, "u1", rows * cols,
+      start + 8 * cols).reshape((cols, rows)).astype(numpy.float64)
+    values = numpy.where(data <= 64, p0 + (p25 - p0) * data / 64.0,
+      numpy.where(data <= 192, p25 + (p75 - p25) * (data - 64) / 128.0,
+        p75 + (p100 - p75) * (data - 192) / 63.0)).T
+
+  return numpy.ascontiguousarray(values, dtype=numpy.float32)
+
+
+
+
+def _parseText(text):
+  """
+  Returns a new float32 NumPy array with the values of the text Kaldi
+  matrix or vector *text*, including its brackets.
+  """
+  inner = text[text.index("[") + 1:text.rindex("]")]
+  lines = [split(line) for line in inner.split("\n") if strip(line)]
+  if strip(text.split("\n", 1)[0]) == "[": # matrices start a new line
+    return numpy.array(lines, dtype=numpy.float32)
+  return numpy.array(lines[0] if lines else [], dtype=numpy.float32)
+
+
+
+
+class TableReader(object):
+  """
+  Reads the matrices and vectors of Kaldi archives by key through the
+  scp index *scpfile*, such as the scpfile of a features object,
+  without running Kaldi. Archives are mapped into memory, so reading
+  one object touches only its own pages.
+
+  reader[key] returns a read-only NumPy array that is a view of the
+  mapped archive, without copying, for binary full matrices and
+  vectors. Compressed matrices are decompressed and text objects
+  parsed into new float32 arrays. Requires NumPy.
+  """
+
+  def __init__(self, scpfile):
+    if numpy is None:
+      raise ImportError("TableReader requires NumPy")
+
+    self._keys = []
+    self._index = {}
+    with open(scpfile, "r") as scpIn:
+      for line in scpIn:
+        if strip(line):
+          (key, location) = split(line, None, 1)
+          (arkfile, offset) = strip(location).rsplit(":", 1)
+          self._keys.append(key)
+          self._index[key] = (arkfile, int(offset))
+    self._maps = {}
+
+
+  def _map(self, arkfile):
+    try:
+      return self._maps[arkfile]
+    except KeyError:
+      pass
+    with open(arkfile, "rb") as f:
+      self._maps[arkfile] = mmap(f.fileno(), 0, access=ACCESS_READ)
+    return self._maps[arkfile]
+
+
+  def keys(self):
+    """
+    Returns the list of keys in the index, in order.
+    """
+    return list(self._keys)
+
+
+  def __len__(self):
+    return len(self._keys)
+
+
+  def __contains__(self, key):
+    return key in self._index
+
+
+  def __iter__(self):
+    return iter(self._keys)
+
+
+  def __getitem__(self, key):
+    (arkfile, offset) = self._index[key]
+    buf = self._map(arkfile)
+
+    if buf[offset:offset + 2] != "\0B":
+      return _parseText(buf[offset:buf.find("]", offset) + 1])
+
+    (token, headerSize, shape, dataSize) = _binaryHeader(
+      buf[offset:offset + _BINARY_HEADER_SIZE])
+    start = offset + headerSize
+    if token in _DTYPES:
+      count = 1
+      for n in shape:
+        count *= n
+      return numpy.frombuffer(buf, _DTYPES[token], count, start).reshape(shape)
+    return _decompress(token, buf, start, shape)
+
+
+
+
+class SymbolTable(object):
+  """
+  Holds the OpenFst text symbol table *fname*, mapping symbols to
+  integer ids and back. Symbols are kept in one contiguous string
+  indexed by an array of offsets, so tables of large vocabularies
+  take little more memory than the file itself.
+  """
+
+  def __init__(self, fname):
+    self.filename = fname
+
+    # the last line giving an id names its symbol, as in OpenFst
+    self._ids = {}
+    byId = {}
+    with open(fname, "r") as symTableIn:
+      for line in symTableIn:
+        parts = split(line)
+        if len(parts) >= 2:
+          self._ids[parts[0]] = int(parts[1])
+          byId[int(parts[1])] = parts[0]
+
+    # symbol i is _buffer[_offsets[i]:_offsets[i + 1]], empty if unused
+    size = max(byId) + 1 if byId else 0
+    symbols = [""] * size
+    for (i, symbol) in byId.iteritems():
+      symbols[i] = symbol
+    del byId
+    self._buffer = "".join(symbols)
+    self._offsets = array("l", [0]) * (size + 1)
+    offset = 0
+    for i in xrange(size):
+      offset += len(symbols[i])
+      self._offsets[i + 1] = offset
+
+
+  def symbol(self, i, default=None):
+    """
+    Returns the symbol of the integer id *i*, which may be given as a
+    string, or *default* if the table has none or *i* is no integer.
+    """
+    try:
+      i = int(i)
+    except ValueError:
+      return default
+    if 0 <= i < len(self._offsets) - 1:
+      start = self._offsets[i]
+      end = self._offsets[i + 1]
+      if end > start:
+        return self._buffer[start:end]
+    return default
+
+
+  def id(self, symbol, default=None):
+    """
+    Returns the integer id of *symbol*, or *default* if the table has
+    none.
+    """
+    return self._ids.get(symbol, default)
+
+
+  def requiredId(self, symbol):
+    """
+    Returns the integer id of *symbol*. Raises ValueError if the table
+    has none.
+    """
+    try:
+      return self._ids[symbol]
+    except KeyError:
+      raise ValueError("symbol {0} is not in {1}".format(symbol,
+        self.filename))
+
+
+  def symbols(self, ids, default=None):
+    """
+    Returns the list of symbols of the integer *ids*, with *default*
+    for those the table has none.
+    """
+    return [self.symbol(i, default) for i in ids]
+
+
+  def iteritems(self):
+    """
+    Yields a tuple of the id and symbol of each entry, in id order.
+    """
+    for i in xrange(len(self._offsets) - 1):
+      start = self._offsets[i]
+      end = self._offsets[i + 1]
+      if end > start:
+        yield (i, self._buffer[start:end])
+
+
+  def __len__(self):
+    return len(self._ids)
+
+
+  def __contains__(self, symbol):
+    return symbol in self._ids
+
+
+
+
+def getSymbolTable(fname):
+  """
+  Returns the SymbolTable of the file *fname*, loading it only if it
+  was not loaded before or the file changed since. Tables are shared
+  by all callers in the process.
+  """
+  fname = path.abspath(fname)
+  st = stat(fname)
+  stamp = (st.st_ino, st.st_size, st.st_mtime)
+
+  with _symbolTablesLock:
+    try:
+      (symbolTable, tableStamp) = _symbolTables[fname]
+      if tableStamp == stamp:
+        return symbolTable
+    except KeyError:
+      pass
+
+    symbolTable = SymbolTable(fname)
+    _symbolTables[fname] = (symbolTable, stamp)
+    return symbolTable
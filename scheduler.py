@@ -0,0 +1,312 @@
+# Copyright 2013 Signal Analysis and Interpretation Laboratory,
+# University of Southern California
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Defines handles and a scheduler for running Kaldi context methods
+concurrently.
+"""
+
+from sys import exc_info
+from threading import Thread, Condition, Event, Lock
+
+from util import _threadState, _CancelScope, CancelledError
+
+
+
+
+class Handle(object):
+  """
+  Represents the pending result of a call run by a Scheduler.
+
+  Members of the result can be passed on before the call finishes:
+  the handle's attribute *name* is a handle to the result's member
+  *name*, so handle.wordsfile for a lexicon handle may be given to
+  a method expecting a words file.
+  """
+
+  def __init__(self):
+    self._done = Event()
+    self._result = None
+    self._error = None
+    self._scope = _CancelScope()
+    self._callbacks = []
+    self._callbacksLock = Lock()
+
+
+
+  def _finish(self, result=None, error=None):
+    """
+    Sets the *result* of the call, or the *error* it raised as
+    returned by sys.exc_info, wakes up waiting threads and calls
+    the done callbacks.
+    """
+    self._result = result
+    self._error = error
+    with self._callbacksLock:
+      self._done.set()
+      callbacks = self._callbacks
+      self._callbacks = []
+    for callback in callbacks:
+      _callback(callback, self)
+
+
+
+  def addDoneCallback(self, callback):
+    """
+    Arranges for *callback* to be called with the handle when the
+    call finishes, in the thread that ran the call, or right away
+    if it has already finished. Exceptions raised by *callback*
+    are ignored. An event loop can pass a callback that schedules
+    its own work in the loop's thread.
+    """
+    with self._callbacksLock:
+      if not self._done.is_set():
+        self._callbacks.append(callback)
+        return
+    _callback(callback, self)
+
+
+
+  def cancel(self):
+    """
+    Cancels the call. A call that has not started never runs, and
+    the Kaldi processes of a running call are killed along with
+    their children. The call then finishes with CancelledError.
+    Returns False if the call had already finished.
+    """
+    if self.done():
+      return False
+    self._scope.cancel()
+    return True
+
+
+
+  def cancelled(self):
+    """
+    Returns True if the call finished because it was cancelled.
+    """
+    return (self.done() and self._error is not None
+      and isinstance(self._error[1], CancelledError))
+
+
+
+  def done(self):
+    """
+    Returns True if the call has finished.
+    """
+    return self._done.is_set()
+
+
+
+  def wait(self):
+    """
+    Waits for the call to finish.
+    """
+    self._done.wait()
+
+
+
+  def result(self):
+    """
+    Waits for the call to finish and returns its result. If the
+    call raised an exception, the exception is raised again.
+    """
+    self.wait()
+    if self._error is not None:
+      raise self._error[0], self._error[1], self._error[2]
+    return self._result
+
+
+
+  def exception(self):
+    """
+    Waits for the call to finish and returns the exception it
+    raised, or None if it returned.
+    """
+    self.wait()
+    if self._error is not None:
+      return self._error[1]
+    return None
+
+
+
+  def __getattr__(self, name):
+    if name.startswith("_"):
+      raise AttributeError(name)
+    return _MemberHandle(self, name)
+
+
+
+
+class _MemberHandle(Handle):
+  """
+  Represents the member *name* of the result of *parent*.
+  """
+
+  def __init__(self, parent, name):
+    self._parent = parent
+    self._name = name
+
+
+
+  def addDoneCallback(self, callback):
+    self._parent.addDoneCallback(lambda parent: callback(self))
+
+
+
+  def cancel(self):
+    return False
+
+
+
+  def cancelled(self):
+    return self._parent.cancelled()
+
+
+
+  def done(self):
+    return self._parent.done()
+
+
+
+  def wait(self):
+    self._parent.wait()
+
+
+
+  def result(self):
+    return getattr(self._parent.result(), self._name)
+
+
+
+  def exception(self):
+    try:
+      self.result()
+    except Exception as e:
+      return e
+    return None
+
+
+
+
+def _callback(callback, handle):
+  """
+  Calls the done *callback* of *handle*, ignoring its exceptions.
+  """
+  try:
+    callback(handle)
+  except Exception:
+    pass
+
+
+
+
+def _resolve(value):
+  """
+  Returns the result of *value* if it is a handle, or *value*
+  itself otherwise.
+  """
+  if isinstance(value, Handle):
+    return value.result()
+  return value
+
+
+
+
+class Scheduler(object):
+  """
+  Runs calls concurrently, each in its own thread, once the handles
+  passed as their arguments have finished. Each call takes a number
+  of jobs from a budget of *maxjobs* while it runs and waits until
+  enough jobs are free before starting.
+  """
+
+  def __init__(self, maxjobs):
+    self.maxjobs = max(maxjobs, 1)
+    self._budget = Condition(Lock())
+    self._free = self.maxjobs
+    self._handles = set()
+    self._handlesLock = Lock()
+
+
+
+  def submit(self, func, args=(), kwargs=None, jobs=1):
+    """
+    Schedules *func* to be called with *args* and keyword arguments
+    *kwargs*, after any handles among them finish, and replaced by
+    their results. *jobs* is the number of jobs the call takes from
+    the budget, at most the whole budget. Returns a handle to the
+    result of the call. If a handle argument finishes with an
+    exception, the call is skipped and finishes with that exception.
+    """
+    handle = Handle()
+    with self._handlesLock:
+      self._handles.add(handle)
+    handle.addDoneCallback(self._discard)
+
+    thread = Thread(target=self._run,
+      args=(handle, func, args, kwargs or {}, jobs))
+    thread.start()
+    return handle
+
+
+
+  def wait(self):
+    """
+    Waits for all calls submitted so far to finish.
+    """
+    with self._handlesLock:
+      handles = list(self._handles)
+    for handle in handles:
+      handle.wait()
+
+
+
+  def _discard(self, handle):
+    with self._handlesLock:
+      self._handles.discard(handle)
+
+
+
+  def _run(self, handle, func, args, kwargs, jobs):
+    jobs = min(max(jobs, 1), self.maxjobs)
+    scope = handle._scope
+    _threadState.scope = scope
+    try:
+      args = [_resolve(arg) for arg in args]
+      kwargs = dict([(k, _resolve(v)) for (k, v) in kwargs.iteritems()])
+
+      with self._budget:
+        while self._free < jobs and not scope.cancelled:
+          self._budget.wait(1.0)
+        if scope.cancelled:
+          raise CancelledError()
+        self._free -= jobs
+
+      try:
+        result = func(*args, **kwargs)
+      finally:
+        with self._budget:
+          self._free += jobs
+          self._budget.notify_all()
+    except Exception:
+      error = exc_info()
+      if scope.cancelled and not isinstance(error[1], CancelledError):
+        try:
+          raise CancelledError()
+        except CancelledError:
+          error = exc_info()
+      handle._finish(error=error)
+    else:
+      handle._finish(result)
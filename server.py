@@ -0,0 +1,438 @@
+# Copyright 2013 Signal Analysis and Interpretation Laboratory,
+# University of Southern California
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#  http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Defines a local HTTP service decoding audio and features with a
+Kaldi context, and a client and load generator for it.
+"""
+
+import json
+from os import path,makedirs,listdir
+from shutil import rmtree
+from threading import Thread,Event,Lock
+from Queue import Queue,Empty,Full
+from BaseHTTPServer import HTTPServer,BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urllib2 import urlopen,Request,HTTPError
+from time import time
+
+from util import KaldiObject, _randFilename, _removeFiles
+from kaldi.feat import _featsPipe, _readTable
+from kaldi.gmmdecode import _decode
+
+
+
+# content type of requests holding one Kaldi feature matrix
+FEATS_CONTENT_TYPE = "application/x-kaldi-matrix"
+
+
+
+
+class ServerBusyError(Exception):
+  """
+  Raised when a request arrives while the server's queue is full.
+  """
+  pass
+
+
+
+
+class _Request(object):
+  """
+  Represents one utterance waiting to be decoded, either wave file
+  data or a Kaldi feature matrix as given by *kind*.
+  """
+
+  def __init__(self, uttId, kind, data):
+    self.uttId = uttId
+    self.kind = kind
+    self.data = data
+    self.result = None
+    self.error = None
+    self.done = Event()
+
+
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+
+
+
+class _Handler(BaseHTTPRequestHandler):
+  """
+  Handles POST requests to /decode. The body is a wave file, or a
+  Kaldi feature matrix if the content type is FEATS_CONTENT_TYPE.
+  Replies with the result as JSON, or 503 if the server is busy.
+  """
+
+  def do_POST(self):
+    if self.path.split("?")[0] != "/decode":
+      self._reply(404, {"error": "unknown path {0}".format(self.path)})
+      return
+
+    kind = "wav"
+    if self.headers.get("Content-Type", "").startswith(FEATS_CONTENT_TYPE):
+      kind = "feats"
+    data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    try:
+      result = self.server.decodeServer.decode(data, kind)
+    except ServerBusyError as e:
+      self._reply(503, {"error": str(e)}, {"Retry-After": "1"})
+    except ValueError as e:
+      self._reply(422, {"error": str(e)})
+    except Exception as e:
+      self._reply(500, {"error": "{0}: {1}".format(type(e).__name__, e)})
+    else:
+      self._reply(200, result)
+
+
+  def _reply(self, code, obj, headers={}):
+    body = json.dumps(obj)
+    self.send_response(code)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    for (name, value) in headers.iteritems():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+
+  def log_message(self, format, *args):
+    pass
+
+
+
+
+class DecodeServer(object):
+  """
+  Serves decoding requests on *host* and *port*, decoding with the
+  graph *HCLG*, word symbol table *wordsfile* and acoustic model *mdl*
+  of the Kaldi context *context*. If *Lalign* is given, replies include
+  word timings.
+
+  Requests arriving within *maxwait* seconds of the first request of
+  a batch are decoded together in one Kaldi invocation, up to
+  *maxbatch* requests. At most *maxqueue* requests wait for a batch;
+  further requests are rejected with ServerBusyError, or HTTP status
+  503, until the queue drains.
+
+  Wave files are converted to features as KaldiContext.makeFeatures
+  does with the given options, normalized per utterance. Feature
+  matrices are decoded as given.
+  """
+
+  def __init__(self, context, HCLG, wordsfile, mdl, Lalign=None,
+    host="127.0.0.1", port=0, maxbatch=16, maxwait=0.05, maxqueue=64,
+    samplefreq=16000, useenergy=False, framelength=25, frameshift=10,
+    numceps=13, applycmvn=True, normvars=False, deltaorder=2, beam=16,
+    allowpartial=True, acousticscale=0.1):
+    self.context = context
+    self.HCLG = HCLG
+    self.wordsfile = wordsfile
+    self.mdl = mdl
+    self.Lalign = Lalign
+    self.maxbatch = max(maxbatch, 1)
+    self.maxwait = maxwait
+    self.samplefreq = samplefreq
+    self.useenergy = useenergy
+    self.framelength = framelength
+    self.frameshift = frameshift
+    self.numceps = numceps
+    self.applycmvn = applycmvn
+    self.normvars = normvars
+    self.deltaorder = deltaorder
+    self.beam = beam
+    self.allowpartial = allowpartial
+    self.acousticscale = acousticscale
+
+    self.batchesdir = path.join(context.dirname, "server")
+    self._queue = Queue(max(maxqueue, 1))
+    self._count = 0
+    self._countLock = Lock()
+    self._threads = []
+
+    self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+    self._httpd.decodeServer = self
+    (host, port) = self._httpd.server_address[:2]
+    self.url = "http://{0}:{1}/decode".format(host, port)
+
+
+
+  def start(self):
+    """
+    Starts serving requests in background threads and returns the
+    server.
+    """
+    for target in (self._httpd.serve_forever, self._batches):
+      thread = Thread(target=target)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+    return self
+
+
+
+  def close(self):
+    """
+    Stops accepting requests, finishes the queued ones and stops the
+    background threads.
+    """
+    self._httpd.shutdown()
+    self._httpd.server_close()
+    self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+
+
+  def submit(self, data, kind="wav"):
+    """
+    Queues the wave file or feature matrix *data*, as given by *kind*
+    ("wav" or "feats"), for the next batch and returns the request.
+    Raises ServerBusyError if the queue is full.
+    """
+    if kind not in ("wav", "feats"):
+      raise ValueError("unknown request kind {0}".format(kind))
+    with self._countLock:
+      self._count += 1
+      uttId = "utt-{0:010d}".format(self._count)
+
+    request = _Request(uttId, kind, data)
+    try:
+      self._queue.put_nowait(request)
+    except Full:
+      raise ServerBusyError("decoding queue is full")
+    return request
+
+
+
+  def decode(self, data, kind="wav"):
+    """
+    Decodes the wave file or feature matrix *data*, as for submit,
+    and returns a dictionary with the hypothesis words and, if the
+    server was given alignment symbols, the word timings in seconds.
+    Raises ValueError if the utterance could not be decoded.
+    """
+    request = self.submit(data, kind)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.result
+
+
+
+  def _batches(self):
+    stop = False
+    while not stop:
+      batch = [self._queue.get()]
+      if batch[0] is None:
+        break
+
+      deadline = time() + self.maxwait
+      while len(batch) < self.maxbatch:
+        remaining = deadline - time()
+        if remaining <= 0:
+          break
+        try:
+          request = self._queue.get(True, remaining)
+        except Empty:
+          break
+        if request is None:
+          stop = True
+          break
+        batch.append(request)
+
+      self._decodeBatch(batch)
+
+
+
+  def _decodeBatch(self, batch):
+    """
+    Decodes the requests in *batch* with one decoder invocation and
+    sets their results. If decoding fails, the logs the error names
+    are kept in the batch's directory.
+    """
+    config = self.context.config
+    batchdir = path.join(self.batchesdir, _randFilename("batch-"))
+    makedirs(batchdir)
+    failed = False
+
+    try:
+      # write the batch's audio and features for the decoder
+      featsSpecs = []
+      wavs = [r for r in batch if r.kind == "wav"]
+      if wavs:
+        wavscp = path.join(batchdir, "wav.scp")
+        with open(wavscp, "w") as scpOut:
+          for request in wavs:
+            wavfile = path.join(batchdir, "{0}.wav".format(request.uttId))
+            with open(wavfile, "wb") as wavOut:
+              wavOut.write(request.data)
+            scpOut.write("{0} {1}\n".format(request.uttId, wavfile))
+        featsSpecs.append(_featsPipe(config, wavscp, None, None, None,
+          self.samplefreq, self.useenergy, self.framelength, self.frameshift,
+          self.numceps, self.applycmvn, self.normvars, self.deltaorder))
+
+      feats = [r for r in batch if r.kind == "feats"]
+      if feats:
+        featsfile = path.join(batchdir, "feats.ark")
+        with open(featsfile, "wb") as featsOut:
+          for request in feats:
+            featsOut.write("{0} {1}".format(request.uttId, request.data))
+            if not request.data.startswith("\0B"):
+              featsOut.write("\n")
+        featsSpecs.append("ark:{0}".format(featsfile))
+
+      phonesfilealign = None
+      lexfstalign = None
+      if self.Lalign:
+        phonesfilealign = self.Lalign.phonesfile
+        lexfstalign = self.Lalign.filename
+
+      hyp = KaldiObject()
+      _decode(config, hyp, batchdir, featsSpecs, self.HCLG.filename,
+        self.wordsfile, self.mdl.filename, phonesfilealign, lexfstalign,
+        self.beam, self.allowpartial, self.acousticscale)
+
+
+      # collect the hypotheses and word timings
+      words = dict(_readTable(hyp.filename))
+      timings = {}
+      if self.Lalign:
+        for (uttId, lens) in _readTable(hyp.wordlens):
+          timings[uttId] = self._timings(lens)
+
+      for request in batch:
+        try:
+          result = {"words": words[request.uttId].split()}
+        except KeyError:
+          request.error = ValueError("utterance could not be decoded")
+          continue
+        if self.Lalign:
+          result["timings"] = timings.get(request.uttId, [])
+        request.result = result
+
+    except Exception as e:
+      failed = True
+      for request in batch:
+        request.error = e
+
+    finally:
+      if failed:
+        _removeFiles([path.join(batchdir, f) for f in listdir(batchdir)
+          if not f.endswith(".log")])
+      else:
+        rmtree(batchdir, True)
+      for request in batch:
+        request.done.set()
+
+
+
+  def _timings(self, lens):
+    """
+    Returns a list of (word, start, end) tuples in seconds from the
+    word lengths *lens* in frames, as written to hyp.wordlens,
+    skipping silence.
+    """
+    timings = []
+    start = 0
+    for pair in lens.split(";"):
+      parts = pair.split()
+      if len(parts) != 2:
+        continue
+      end = start + int(parts[1])
+      if parts[0] != "<eps>":
+        timings.append((parts[0], start * self.frameshift / 1000.0,
+          end * self.frameshift / 1000.0))
+      start = end
+    return timings
+
+
+
+
+def decodeRemote(url, data, kind="wav", timeout=None):
+  """
+  Sends the wave file or feature matrix *data*, as given by *kind*,
+  to the decode server at *url* and returns its reply as a dictionary.
+  Raises urllib2.HTTPError for errors, with code 503 if the server
+  is busy.
+  """
+  headers = {"Content-Type": "audio/wav"}
+  if kind == "feats":
+    headers["Content-Type"] = FEATS_CONTENT_TYPE
+  reply = urlopen(Request(url, data, headers), timeout=timeout)
+  try:
+    return json.loads(reply.read())
+  finally:
+    reply.close()
+
+
+
+
+def generateLoad(url, files, clients=4, requests=100, kind="wav"):
+  """
+  Sends *requests* requests to the decode server at *url* from
+  *clients* concurrent clients, cycling through the wave or feature
+  *files* as given by *kind*. Returns a dictionary with the number of
+  requests completed, rejected as busy and failed, the total seconds,
+  the throughput in requests per second and the sorted latencies of
+  the completed requests.
+  """
+  datas = []
+  for fname in files:
+    with open(fname, "rb") as f:
+      datas.append(f.read())
+
+  stats = {"completed": 0, "rejected": 0, "failed": 0, "latencies": []}
+  lock = Lock()
+  counter = [0]
+
+  def client():
+    while True:
+      with lock:
+        if counter[0] >= requests:
+          return
+        data = datas[counter[0] % len(datas)]
+        counter[0] += 1
+
+      begin = time()
+      try:
+        decodeRemote(url, data, kind)
+        outcome = "completed"
+      except HTTPError as e:
+        outcome = "rejected" if e.code == 503 else "failed"
+      except Exception:
+        outcome = "failed"
+      latency = time() - begin
+
+      with lock:
+        stats[outcome] += 1
+        if outcome == "completed":
+          stats["latencies"].append(latency)
+
+  begin = time()
+  threads = [Thread(target=client) for i in range(clients)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  stats["seconds"] = time() - begin
+
+  stats["latencies"].sort()
+  stats["throughput"] = stats["completed"] / max(stats["seconds"], 1e-9)
+  return stats
@@ -0,0 +1,58 @@
+import unittest
+from tempfile import NamedTemporaryFile
+
+from skip.kaldi.arpa import pruneArpa
+
+
+
+# toy bigram model in which "<s> a" carries most of the sentence starts
+_MODEL = """\\data\\
+ngram 1=4
+ngram 2=3
+
+\\1-grams:
+-99\t<s>\t-0.3
+-0.5\ta\t-0.2
+-0.6\tb\t-0.2
+-0.4\t</s>
+
+\\2-grams:
+-0.05\t<s> a
+-0.3\ta b
+-0.2\tb </s>
+
+\\end\\
+"""
+
+
+
+
+def _bigrams(threshold):
+  lmIn = NamedTemporaryFile(mode="w+", suffix=".arpa")
+  try:
+    lmIn.write(_MODEL)
+    lmIn.seek(0)
+    text = "".join(pruneArpa(lmIn, threshold))
+  finally:
+    lmIn.close()
+  section = text.split("\\2-grams:\n")[1].split("\\end\\")[0]
+  return [" ".join(line.split()[1:3]) for line in section.splitlines()
+    if line.strip()]
+
+
+
+
+class PruneArpaTest(unittest.TestCase):
+
+  def testSentenceStartSurvivesTinyThreshold(self):
+    self.assertTrue("<s> a" in _bigrams(1e-8))
+
+
+  def testLargeThresholdPrunes(self):
+    self.assertFalse("<s> a" in _bigrams(10))
+
+
+
+
+if __name__ == "__main__":
+  unittest.main()
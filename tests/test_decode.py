@@ -0,0 +1,156 @@
+import unittest
+from os import path,makedirs,chmod,rename,utime
+from shutil import rmtree
+from tempfile import mkdtemp
+from sys import executable
+from time import time
+
+from skip.context import KaldiContext
+
+
+
+# fake Kaldi binaries: features are one row per character of the wave
+# file, and the decoder records the utterances it reads in calls.txt
+_BINARIES = {}
+
+_BINARIES["featbin/compute-mfcc-feats"] = """
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+entries = []
+for line in open(args[0].split(":", 1)[1]):
+  (utt, wav) = line.split()
+  entries.append((utt, [float(ord(c)) for c in open(wav).read()]))
+writeFeats(args[1], entries)
+"""
+
+_BINARIES["featbin/copy-feats"] = """
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+writeFeats(args[1], readFeats(args[0]))
+"""
+
+_BINARIES["gmmbin/gmm-decode-faster"] = """
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+entries = readFeats(args[2])
+with open(path.join(path.dirname(sys.argv[0]), "calls.txt"), "a") as calls:
+  calls.write(" ".join([utt for (utt, rows) in entries]) + "\\n")
+for (utt, rows) in entries:
+  sys.stdout.write("{0} 1\\n".format(utt))
+open(args[4].split(":", 1)[1], "w").close()
+"""
+
+_COMMON = """#!{0}
+import sys
+from os import path
+from struct import pack, unpack
+
+def readMatrix(f):
+  f.read(6)
+  rows = unpack("<i", f.read(4))[0]
+  f.read(1)
+  cols = unpack("<i", f.read(4))[0]
+  return [unpack("<f", f.read(4))[0] for i in range(rows * cols)]
+
+def readFeats(spec):
+  (kind, fname) = spec.split(":", 1)
+  entries = []
+  if kind.startswith("scp"):
+    for line in open(fname):
+      (utt, location) = line.split()
+      (ark, offset) = location.rsplit(":", 1)
+      f = open(ark, "rb")
+      f.seek(int(offset))
+      entries.append((utt, readMatrix(f)))
+    return entries
+  f = open(fname, "rb")
+  while True:
+    utt = ""
+    c = f.read(1)
+    while c and c != " ":
+      utt += c
+      c = f.read(1)
+    if not utt:
+      return entries
+    entries.append((utt, readMatrix(f)))
+
+def writeFeats(spec, entries):
+  (ark, scp) = spec.split(":", 1)[1].split(",")
+  with open(ark, "wb") as arkOut:
+    with open(scp, "w") as scpOut:
+      for (utt, rows) in entries:
+        arkOut.write(utt + " ")
+        scpOut.write("{{0}} {{1}}:{{2}}\\n".format(utt, ark, arkOut.tell()))
+        arkOut.write("\\0BFM \\x04" + pack("<i", len(rows)) + "\\x04" +
+          pack("<i", 1) + "".join([pack("<f", v) for v in rows]))
+"""
+
+
+
+
+class IncrementalDecodeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dirname = mkdtemp()
+    kaldiDir = path.join(self.dirname, "kaldi")
+    for (name, body) in _BINARIES.iteritems():
+      fname = path.join(kaldiDir, "src", name)
+      if not path.isdir(path.dirname(fname)):
+        makedirs(path.dirname(fname))
+      with open(fname, "w") as f:
+        f.write(_COMMON.format(executable) + body)
+      chmod(fname, 0755)
+    self.calls = path.join(kaldiDir, "src", "gmmbin", "calls.txt")
+
+    self.context = KaldiContext("test", kaldiDir,
+      {"CONTEXTS_DIR": path.join(self.dirname, "contexts")})
+    for name in ("HCLG.fst", "final.mdl", "tree"):
+      open(path.join(self.dirname, name), "w").close()
+    self.wordsfile = path.join(self.dirname, "words.txt")
+    with open(self.wordsfile, "w") as f:
+      f.write("<eps> 0\nhello 1\n")
+
+
+  def tearDown(self):
+    rmtree(self.dirname, True)
+
+
+  def _writeWavs(self, utts, mtime):
+    wavscp = path.join(self.dirname, "wav.scp")
+    with open(wavscp + ".tmp", "w") as scpOut:
+      for utt in utts:
+        wav = path.join(self.dirname, utt + ".wav")
+        if not path.isfile(wav):
+          with open(wav, "w") as wavOut:
+            wavOut.write(utt)
+        scpOut.write("{0} {1}\n".format(utt, wav))
+    rename(wavscp + ".tmp", wavscp)
+    utime(wavscp, (mtime, mtime))
+    return wavscp
+
+
+  def _decode(self, wavscp):
+    open(self.calls, "w").close()
+    feats = self.context.makeFeatures(wavscp, applycmvn=False,
+      deltaorder=0)
+    HCLG = self.context.addHCLG(path.join(self.dirname, "HCLG.fst"))
+    mdl = self.context.addGMM(path.join(self.dirname, "final.mdl"),
+      path.join(self.dirname, "tree"))
+    hyp = self.context.decode(feats, HCLG, self.wordsfile, mdl)
+    with open(self.calls) as callsIn:
+      decoded = callsIn.read().split()
+    with open(hyp.filename) as hypIn:
+      utts = [line.split()[0] for line in hypIn]
+    return (decoded, utts)
+
+
+  def testAppendedUtteranceIsDecodedAlone(self):
+    now = time()
+    wavscp = self._writeWavs(["a", "b", "c"], now - 20)
+    self.assertEqual(self._decode(wavscp), (["a", "b", "c"], ["a", "b", "c"]))
+
+    wavscp = self._writeWavs(["a", "b", "c", "d"], now - 10)
+    self.assertEqual(self._decode(wavscp), (["d"], ["a", "b", "c", "d"]))
+
+
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -16,10 +16,56 @@
 Defines utility methods for caching kaldi objects.
 """
 
-from os import path,listdir,makedirs,remove
+from os import path,listdir,makedirs,remove,rename,stat,fstat,utime,link
+from sys import platform,exc_info
+from shutil import copy2,copystat
 from ast import literal_eval
 from uuid import uuid4
 from string import strip
+from hashlib import sha1
+from functools import wraps
+from threading import local,Thread,Lock
+from subprocess import Popen
+from signal import SIGTERM
+from tempfile import NamedTemporaryFile
+
+try:
+  from fcntl import flock, LOCK_EX, LOCK_NB
+except ImportError:
+  flock = None
+
+try:
+  from fcntl import ioctl
+except ImportError:
+  ioctl = None
+
+try:
+  from os import setsid, killpg, getpgid
+except ImportError:
+  setsid = None
+
+
+# name of the file in each cache directory that indexes its .idx files
+_INDEX_FILENAME = "skipidx.tab"
+
+# name of the file in each cache directory locked while changing its index
+_INDEX_LOCKNAME = "skipidx.lock"
+
+# build locks held by each thread, see _singleFlight
+_threadState = local()
+
+# in-memory directory indexes, see _loadIndex
+_indexes = {}
+_indexesLock = Lock()
+
+# content hashes of input files, see _fileHash
+_fileHashes = {}
+_MAX_FILE_HASHES = 10000
+_HASH_BLOCK_SIZE = 1 << 20
+
+# Linux ioctl request that clones the extents of one file into another
+_FICLONE = 0x40049409
+
 
 
 class KaldiError(Exception):
@@ -34,6 +80,16 @@ class KaldiError(Exception):
     return self.msg
 
 
+
+
+class CancelledError(Exception):
+  """
+  Raised by calls that were cancelled before or while running Kaldi.
+  """
+  def __str__(self):
+    return "call was cancelled"
+
+
 class KaldiObject(object):
   """
   Represents a Kaldi object, typically a file.
@@ -49,6 +105,370 @@ def _randFilename(prefix="", suffix=""):
 
 
 
+def _tmpFilename(suffix, tmpFiles):
+  """
+  Returns the name of a new temporary file, adding it to the
+  list *tmpFiles* of files to remove when done.
+  """
+  tmp = NamedTemporaryFile(suffix=suffix, delete=False)
+  tmp.close()
+  tmpFiles.append(tmp.name)
+  return tmp.name
+
+
+
+
+def _removeFiles(fnames):
+  """
+  Removes the files in *fnames* that exist, skipping None.
+  """
+  for fname in fnames:
+    try:
+      remove(fname)
+    except (OSError, TypeError):
+      pass
+
+
+
+
+class _CancelScope(object):
+  """
+  Tracks the Kaldi processes started for a call, as by _popen, so
+  they can be killed if the call is cancelled.
+  """
+
+  def __init__(self):
+    self.cancelled = False
+    self.procs = []
+    self.lock = Lock()
+
+
+  def cancel(self):
+    """
+    Marks the call cancelled and kills its running processes and
+    their children.
+    """
+    with self.lock:
+      self.cancelled = True
+      procs = list(self.procs)
+    for proc in procs:
+      _killTree(proc)
+
+
+
+
+def _killTree(proc):
+  """
+  Terminates the process *proc* started by _popen, along with the
+  rest of its process group if it leads one.
+  """
+  try:
+    if setsid is not None and getpgid(proc.pid) == proc.pid:
+      killpg(proc.pid, SIGTERM)
+    else:
+      proc.terminate()
+  except OSError:
+    pass
+
+
+
+
+def _cancelScope():
+  """
+  Returns the _CancelScope of the call the current thread runs,
+  or None if the call cannot be cancelled.
+  """
+  return getattr(_threadState, "scope", None)
+
+
+
+
+def _popen(cmd, leadGroup=False, **kwargs):
+  """
+  Starts the shell command *cmd* with subprocess.Popen and the
+  keyword arguments *kwargs*. If the call the current thread runs
+  can be cancelled, or *leadGroup* is True, the shell leads a new
+  process group so that _killTree can kill the whole pipeline. Other
+  commands stay in the process group of Python, so interrupting
+  Python interrupts them too. Callers passing *leadGroup* must kill
+  the command themselves when Python exits. Raises CancelledError if
+  the call was cancelled.
+  """
+  scope = _cancelScope()
+  if setsid is not None and (leadGroup or scope is not None):
+    kwargs["preexec_fn"] = setsid
+  if scope is None:
+    return Popen(cmd, shell=True, **kwargs)
+
+  with scope.lock:
+    if scope.cancelled:
+      raise CancelledError()
+    scope.procs = [p for p in scope.procs if p.returncode is None]
+    proc = Popen(cmd, shell=True, **kwargs)
+    scope.procs.append(proc)
+  return proc
+
+
+
+
+def _lock(fname, blocking=True):
+  """
+  Opens and exclusively locks the lock file *fname*, waiting for
+  other processes and threads to release it. Returns the open file,
+  which holds the lock until it is closed. If *blocking* is False
+  and the lock is held elsewhere, returns None instead of waiting.
+  Where file locking is unsupported, the file is only opened.
+  """
+  while True:
+    f = open(fname, "a")
+    if flock is None:
+      return f
+    try:
+      if blocking:
+        flock(f.fileno(), LOCK_EX)
+      else:
+        flock(f.fileno(), LOCK_EX | LOCK_NB)
+    except IOError:
+      f.close()
+      return None
+
+    # lock again if _removeLock removed the file while we waited
+    try:
+      if fstat(f.fileno()).st_ino == stat(fname).st_ino:
+        return f
+    except OSError:
+      pass
+    f.close()
+
+
+
+
+def _removeLock(fname):
+  """
+  Removes the lock file *fname* if no one holds it. Returns True if
+  it was removed. Where file locking is unsupported, lock files are
+  never removed.
+  """
+  if flock is None:
+    return False
+  f = _lock(fname, False)
+  if f is None:
+    return False
+  try:
+    remove(fname)
+  except OSError:
+    return False
+  finally:
+    f.close()
+  return True
+
+
+
+
+def _paramsLockFile(directory, params):
+  """
+  Returns the name of the lock file in *directory* that serializes
+  builds of the object cached from *params*.
+  """
+  return path.join(directory, "{0}.lock".format(sha1(params).hexdigest()))
+
+
+
+
+def _heldLocks():
+  """
+  Returns the list of build locks held by the current thread,
+  as tuples of the lock file name and the open file.
+  """
+  try:
+    return _threadState.locks
+  except AttributeError:
+    _threadState.locks = []
+    return _threadState.locks
+
+
+
+
+def _singleFlight(func):
+  """
+  Decorates the Kaldi stage function *func* so the build locks
+  taken by _getCachedObject during a call are released when the
+  call returns or raises. Concurrent calls with the same params,
+  in any process, then run one at a time and the later calls find
+  the object cached by the first.
+  """
+  @wraps(func)
+  def stage(*args, **kwargs):
+    held = _heldLocks()
+    mark = len(held)
+    try:
+      return func(*args, **kwargs)
+    finally:
+      while len(held) > mark:
+        held.pop()[1].close()
+  return stage
+
+
+
+
+def _readIdxFile(fname):
+  """
+  Reads the cache index file *fname*. Returns a tuple containing
+  the params string and the string of object members, which is
+  empty if the object was never cached. Returns None if *fname*
+  is not a valid index file.
+  """
+  with open(fname, "r") as f:
+    if strip(f.readline()) != "$skipidx":
+      return None
+    params = strip(f.readline())
+    objMembers = strip(f.readline())
+  return (params, objMembers)
+
+
+
+
+def _writeIndex(directory, entries):
+  """
+  Writes a new directory index to *directory* containing *entries*,
+  a dictionary mapping params strings to index file names. The file
+  is written to a temporary name and renamed into place so a crash
+  never leaves a partially written index.
+  """
+  indexFile = path.join(directory, _INDEX_FILENAME)
+  tmpFile = path.join(directory, _randFilename(".", ".tmp"))
+  with open(tmpFile, "w") as f:
+    f.write("$skipindex\n")
+    for (params, fname) in entries.iteritems():
+      f.write("{0}\t{1}\n".format(fname, params))
+  rename(tmpFile, indexFile)
+
+
+
+
+def _migrateIndex(directory):
+  """
+  Builds the directory index for *directory* by scanning the existing
+  .idx files, as done before directory indexes were introduced.
+  Returns the dictionary of entries written.
+  """
+  entries = {}
+  for fname in listdir(directory):
+    if fname.endswith(".idx"):
+      try:
+        idx = _readIdxFile(path.join(directory, fname))
+      except IOError:
+        continue
+      if idx is None:
+        continue
+      (params, objMembers) = idx
+      if params not in entries or len(objMembers) > 0:
+        entries[params] = fname
+  _writeIndex(directory, entries)
+  return entries
+
+
+
+
+def _loadIndex(directory):
+  """
+  Returns the dictionary mapping params strings to .idx file names
+  for the cache *directory*, creating the directory and migrating
+  existing .idx files if no index exists yet.
+
+  Indexes are kept in memory and only the lines appended to the
+  index file since it was last read are parsed. Incomplete trailing
+  lines, e.g. from a crash during an append, are ignored.
+
+  The returned dictionary is shared between threads and must not be
+  modified; newly read lines are added to a copy, so callers can
+  safely iterate over it while other threads reload the index.
+  """
+  indexFile = path.join(directory, _INDEX_FILENAME)
+  try:
+    st = stat(indexFile)
+  except OSError:
+    try:
+      makedirs(directory)
+    except OSError:
+      pass
+    indexLock = _lock(path.join(directory, _INDEX_LOCKNAME))
+    try:
+      if not path.isfile(indexFile):
+        _migrateIndex(directory)
+    finally:
+      indexLock.close()
+    st = stat(indexFile)
+
+  with _indexesLock:
+    try:
+      (ino, offset, entries) = _indexes[directory]
+      if ino != st.st_ino or offset > st.st_size:
+        raise KeyError(directory)
+    except KeyError:
+      (ino, offset, entries) = (st.st_ino, 0, {})
+
+    if offset < st.st_size:
+      entries = dict(entries)
+      with open(indexFile, "r") as f:
+        f.seek(offset)
+        for line in f:
+          if not line.endswith("\n"):
+            break
+          offset += len(line)
+          if "\t" in line:
+            (fname, params) = line[:-1].split("\t", 1)
+            entries[params] = fname
+
+    _indexes[directory] = (ino, offset, entries)
+    return entries
+
+
+
+
+def _appendIndex(directory, params, fname):
+  """
+  Adds the entry mapping *params* to the index file *fname* to
+  the index of *directory*.
+  """
+  indexFile = path.join(directory, _INDEX_FILENAME)
+  line = "{0}\t{1}\n".format(fname, params)
+  indexLock = _lock(path.join(directory, _INDEX_LOCKNAME))
+  try:
+    with open(indexFile, "a+") as f:
+      f.seek(0, 2)
+      if f.tell() > 0:
+        f.seek(-1, 2)
+        if f.read(1) != "\n":
+          line = "\n" + line
+      f.seek(0, 2)
+      f.write(line)
+  finally:
+    indexLock.close()
+
+
+
+
+def _removeIndexEntries(directory, fnames):
+  """
+  Removes the entries for the .idx files named in *fnames* from
+  the index of *directory*. The .idx files themselves are not
+  removed.
+  """
+  _loadIndex(directory)
+  indexLock = _lock(path.join(directory, _INDEX_LOCKNAME))
+  try:
+    entries = {}
+    for (params, fname) in _loadIndex(directory).iteritems():
+      if fname not in fnames:
+        entries[params] = fname
+    _writeIndex(directory, entries)
+  finally:
+    indexLock.close()
+
+
+
+
 def _getCachedObject(directory, params):
   """
   Returns a tuple containing in the first element an object
@@ -56,29 +476,44 @@ def _getCachedObject(directory, params):
   object doesn't exist. The second element in the tuple is
   the name of the file in *directory* to be used for caching
   updates to the object. *params* should be a string.
+
+  Lookups go through the directory index, so only the matching
+  .idx file is opened. Its params are checked against *params*
+  before the object is used. The modification time of the .idx
+  file records the last access of the object.
+
+  The calling thread holds the build lock for *params* until the
+  stage function, which must be decorated with _singleFlight,
+  returns. Other callers with the same params wait for it.
   """
   try:
-    for fname in listdir(directory):
-      fname = path.join(directory, fname)
-      if fname.endswith(".idx"):
-        with open(fname, "r") as f:
-          if strip(f.readline()) == "$skipidx":
-            if strip(f.readline()) == params:
-              objMembers = strip(f.readline())
-              if len(objMembers) > 0:
-                obj = KaldiObject()
-                obj.__dict__.update(literal_eval(objMembers))
-                return (obj, fname)
+    makedirs(directory)
   except OSError:
-    try:
-      makedirs(directory)
-    except OSError:
-      pass
+    pass
+  lockFile = _paramsLockFile(directory, params)
+  held = _heldLocks()
+  if lockFile not in [fname for (fname, f) in held]:
+    held.append((lockFile, _lock(lockFile)))
+
+  entries = _loadIndex(directory)
+
+  try:
+    idxFile = path.join(directory, entries[params])
+    idx = _readIdxFile(idxFile)
+    if idx is not None and idx[0] == params:
+      obj = KaldiObject()
+      if len(idx[1]) > 0:
+        obj.__dict__.update(literal_eval(idx[1]))
+      utime(idxFile, None)
+      return (obj, idxFile)
+  except (KeyError, IOError, OSError):
+    pass
 
   idxFile = path.join(directory, _randFilename(suffix=".idx"))
   with open(idxFile, "w") as f:
     f.write("$skipidx\n")
     f.write("{0}\n".format(params))
+  _appendIndex(directory, params, path.basename(idxFile))
 
   return (KaldiObject(), idxFile)
 
@@ -89,15 +524,18 @@ def _getCachedObject(directory, params):
 def _cacheObject(obj, idxFile):
   """
   Updates the specified *idxFile* with *obj*.
-  Returns the object.
+  Returns the object. The file is replaced by renaming a new
+  file over it, so readers never see a partial update.
   """
   with open(idxFile, "r") as f:
     if strip(f.readline()) == "$skipidx":
       params = strip(f.readline())
-  with open(idxFile, "w") as f:
+  tmpFile = path.join(path.dirname(idxFile), _randFilename(".", ".tmp"))
+  with open(tmpFile, "w") as f:
     f.write("$skipidx\n")
     f.write("{0}\n".format(params))
     f.write("{0}\n".format(str(obj.__dict__)))
+  rename(tmpFile, idxFile)
 
   return obj
 
@@ -105,24 +543,175 @@ def _cacheObject(obj, idxFile):
 
 
 
-def _refreshRequired(fnamepairs, deleteOld=True):
+def _mtimeNs(st):
+  """
+  Returns the modification time in nanoseconds from the stat
+  result *st*.
+  """
+  try:
+    return st.st_mtime_ns
+  except AttributeError:
+    return int(st.st_mtime * 1000000000)
+
+
+
+
+def _fileHash(fname):
+  """
+  Returns the hex digest of the content of *fname*, which is
+  read in blocks so large files are never held in memory.
+  Digests are remembered for as long as the file's stat data
+  is unchanged.
+  """
+  st = stat(fname)
+  key = (path.abspath(fname), st.st_size, _mtimeNs(st))
+  try:
+    return _fileHashes[key]
+  except KeyError:
+    pass
+
+  digest = sha1()
+  with open(fname, "rb") as f:
+    while True:
+      block = f.read(_HASH_BLOCK_SIZE)
+      if not block:
+        break
+      digest.update(block)
+
+  if len(_fileHashes) >= _MAX_FILE_HASHES:
+    _fileHashes.clear()
+  _fileHashes[key] = digest.hexdigest()
+  return _fileHashes[key]
+
+
+
+
+def _fileStamp(fname, config):
+  """
+  Returns the stamp to store in a cached object for the input
+  file *fname*. If config.CACHE_VALIDATION is "content", the stamp
+  is a tuple of the file size, modification time in nanoseconds
+  and content hash, otherwise it is the integer modification time.
+  """
+  if config.CACHE_VALIDATION == "content":
+    st = stat(fname)
+    return (st.st_size, _mtimeNs(st), _fileHash(fname))
+  return int(path.getmtime(fname))
+
+
+
+
+def _fileChanged(fname, stamp, config):
+  """
+  Tests the file *fname* against the *stamp* returned by _fileStamp
+  when the file was last used. Returns a tuple containing True in the
+  first element if the file has changed. The second element is the
+  stamp to keep for the file, which is renewed when only the file's
+  stat data changed but its content did not.
+  """
+  if not isinstance(stamp, tuple):
+    return (int(path.getmtime(fname)) > stamp, stamp)
+
+  st = stat(fname)
+  if (st.st_size, _mtimeNs(st)) == stamp[:2]:
+    return (False, stamp)
+  if config.CACHE_VALIDATION != "content" or st.st_size != stamp[0]:
+    return (True, stamp)
+
+  newStamp = (st.st_size, _mtimeNs(st), _fileHash(fname))
+  return (newStamp[2] != stamp[2], newStamp)
+
+
+
+
+def _inputsChanged(obj, idxFile, inputs, config):
+  """
+  Tests the input files of the cached *obj* to see if a refresh
+  is required. *inputs* must be a sequence of (attribute, filename)
+  pairs, where attribute names the member of *obj* holding the stamp
+  of filename. A refresh is required if any stamp is missing or any
+  file has changed.
+
+  Stamps renewed because only stat data changed are saved to
+  *idxFile* so the files are not hashed again.
+  """
+  renewed = False
+  for (attr, fname) in inputs:
+    try:
+      oldStamp = getattr(obj, attr)
+    except AttributeError:
+      return True
+    (changed, stamp) = _fileChanged(fname, oldStamp, config)
+    if changed:
+      return True
+    if stamp != oldStamp:
+      setattr(obj, attr, stamp)
+      renewed = True
+
+  if renewed:
+    _cacheObject(obj, idxFile)
+  return False
+
+
+
+
+def _stampInputs(obj, inputs, config):
+  """
+  Stores the stamps of the input files in *inputs* in *obj*.
+  *inputs* must be a sequence of (attribute, filename) pairs
+  as for _inputsChanged.
+  """
+  for (attr, fname) in inputs:
+    setattr(obj, attr, _fileStamp(fname, config))
+
+
+
+
+def _refreshRequired(fnamepairs, deleteOld=True, config=None,
+  snapshots=None):
   """
   Tests the filename pairs in *fnamepairs* to see if a refresh
   of the cached files is required. A refresh is required
   if the first element is newer than the second element
-  or if the second element does not exist. If *deleteOld*
-  is True, when a refresh is required the existing old files,
-  which are the second elements in the pairs, are deleted.
+  or if the second element does not exist. If *config* is given
+  and config.CACHE_VALIDATION is "content", a refresh is instead
+  required if the elements' stat data and content differ. A refresh
+  is also required if a second element that is a hard linked
+  snapshot no longer matches its stamp in *snapshots*, as recorded
+  by _snapshot. If *deleteOld* is True, when a refresh is required the
+  existing old files, which are the second elements in the pairs,
+  are deleted.
   """
   refreshRequired = False
+  compareContent = config is not None and config.CACHE_VALIDATION == "content"
 
   for pair in fnamepairs:
+    if snapshots and pair[1] in snapshots:
+      try:
+        if _fileChanged(pair[1], snapshots[pair[1]], config)[0]:
+          refreshRequired = True
+          break
+      except OSError:
+        refreshRequired = True
+        break
+
     if pair[1] is None:
       refreshRequired = True
       break
     elif not pair[0] or not pair[1]:
       refreshRequired = True
       break
+    elif compareContent:
+      st = stat(pair[0])
+      try:
+        copySt = stat(pair[1])
+        if ((st.st_size, _mtimeNs(st)) != (copySt.st_size, _mtimeNs(copySt))
+          and _fileHash(pair[0]) != _fileHash(pair[1])):
+          refreshRequired = True
+          break
+      except OSError:
+        refreshRequired = True
+        break
     else:
       mtime = int(path.getmtime(pair[0]))
       try:
@@ -142,3 +731,199 @@ def _refreshRequired(fnamepairs, deleteOld=True):
 
   return refreshRequired
 
+
+
+
+
+def _shardBounds(weights, numjobs, cuts=None):
+  """
+  Splits a sequence of items with *weights* into at most *numjobs*
+  contiguous shards of about equal total weight. If *cuts* is given,
+  a shard may only end after an item whose element in *cuts* is
+  True. Returns a list of (start, end) index tuples.
+  """
+  total = float(sum(weights))
+  bounds = []
+  start = 0
+  cumulative = 0.0
+
+  for (i, weight) in enumerate(weights[:-1]):
+    cumulative += weight
+    if len(bounds) >= numjobs - 1:
+      break
+    if ((cuts is None or cuts[i])
+      and cumulative >= total * (len(bounds) + 1) / numjobs):
+      bounds.append((start, i + 1))
+      start = i + 1
+
+  bounds.append((start, len(weights)))
+  return bounds
+
+
+
+
+def _runConcurrently(func, argsList):
+  """
+  Calls *func* with each tuple of arguments in *argsList*, each
+  call in its own thread, and waits for all calls to return. If
+  any call raises, the exception of the first such call in
+  *argsList* is raised again.
+  """
+  if len(argsList) == 1:
+    func(*argsList[0])
+    return
+
+  errors = [None] * len(argsList)
+  scope = _cancelScope()
+  def run(i):
+    _threadState.scope = scope
+    try:
+      func(*argsList[i])
+    except Exception:
+      errors[i] = exc_info()
+
+  threads = [Thread(target=run, args=(i,)) for i in range(len(argsList))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for error in errors:
+    if error is not None:
+      raise error[0], error[1], error[2]
+
+
+
+
+def _reflink(src, dest):
+  """
+  Makes *dest* a reflink of *src*, sharing its data blocks until
+  either file is written. Returns False if the platform or the file
+  system does not support reflinks.
+  """
+  if ioctl is None or not platform.startswith("linux"):
+    return False
+
+  try:
+    with open(src, "rb") as fin:
+      with open(dest, "wb") as fout:
+        ioctl(fout.fileno(), _FICLONE, fin.fileno())
+  except IOError:
+    try:
+      remove(dest)
+    except OSError:
+      pass
+    return False
+
+  copystat(src, dest)
+  return True
+
+
+
+
+def _snapshot(src, dest, obj, config):
+  """
+  Makes *dest* a snapshot of the input file *src* for the cached
+  object *obj*, with the same content and modification time. If
+  config.LINK_INPUTS is True a reflink is tried first, then a hard
+  link, before falling back to a copy. A hard link shares later
+  in-place writes to *src*, so its size and modification time are
+  recorded in obj.snapshot_times for _refreshRequired to detect them.
+  """
+  if config.LINK_INPUTS:
+    if _reflink(src, dest):
+      return
+    try:
+      link(src, dest)
+    except OSError:
+      pass
+    else:
+      st = stat(dest)
+      stamp = (st.st_size, _mtimeNs(st), None)
+      if config.CACHE_VALIDATION == "content":
+        stamp = (st.st_size, _mtimeNs(st), _fileHash(dest))
+      obj.__dict__.setdefault("snapshot_times", {})[dest] = stamp
+      return
+
+  copy2(src, dest)
+
+
+
+
+
+def _artifactKey(stage, params, inputs):
+  """
+  Returns the key under which the shared store keeps the artifact
+  made by the stage named *stage*. *params* must be a sequence of
+  values whose string forms, along with the content of the files
+  in *inputs*, fully determine the artifact. Inputs that are None
+  are skipped.
+  """
+  digest = sha1(stage)
+  for value in params:
+    digest.update("\0{0}".format(value))
+  for fname in inputs:
+    if fname is None:
+      digest.update("\0")
+    else:
+      digest.update("\0{0}".format(_fileHash(fname)))
+  return digest.hexdigest()
+
+
+
+
+def _artifactFile(config, key, suffix=""):
+  """
+  Returns the name of the file in config.SHARED_STORE_DIR that
+  holds the artifact with *key*.
+  """
+  return path.join(config.SHARED_STORE_DIR, key[:2],
+    "{0}{1}".format(key, suffix))
+
+
+
+
+def _fetchArtifact(config, key, dest):
+  """
+  Links the artifact with *key* from the shared store to *dest*,
+  copying it if a hard link is not possible. Returns True if the
+  artifact was found, or False if it is not in the store or the
+  store is disabled because config.SHARED_STORE_DIR is None.
+  """
+  if not config.SHARED_STORE_DIR:
+    return False
+
+  src = _artifactFile(config, key, path.splitext(dest)[1])
+  try:
+    link(src, dest)
+  except OSError:
+    if not path.isfile(src):
+      return False
+    copy2(src, dest)
+  return True
+
+
+
+
+def _storeArtifact(config, key, src):
+  """
+  Adds the file *src* to the shared store as the artifact with
+  *key*. Does nothing if config.SHARED_STORE_DIR is None. The
+  artifact is linked under a temporary name and renamed into
+  place, so readers never see a partial file.
+  """
+  if not config.SHARED_STORE_DIR:
+    return
+
+  dest = _artifactFile(config, key, path.splitext(src)[1])
+  try:
+    makedirs(path.dirname(dest))
+  except OSError:
+    pass
+
+  tmpFile = path.join(path.dirname(dest), _randFilename(".", ".tmp"))
+  try:
+    link(src, tmpFile)
+  except OSError:
+    copy2(src, tmpFile)
+  rename(tmpFile, dest)